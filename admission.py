@@ -0,0 +1,117 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: the limit only applies within one process
+    fcntl = None
+
+from file_lock import LOCK_DIR
+from metrics import LLM_ADMISSION_SECONDS
+
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv('SENECA_MAX_CONCURRENT_LLM_CALLS', '16'))  # Across all worker processes
+ADMISSION_TIMEOUT_SECONDS = 120  # Longest an LLM call waits for a free slot before failing
+ADMISSION_POLL_SECONDS = 0.05  # How often a waiting call retries when all slots are taken
+MAX_RETRY_AFTER_SECONDS = 60  # Longest pause accepted from a retry-after header
+
+
+class AdmissionTimeout(Exception):
+    pass
+
+
+class AdmissionController:
+    """Limits the number of LLM calls running at once across all worker processes. Each slot is a lock file that
+    a call holds (with flock) while it runs. After a 429 with retry-after, pause() holds back new calls in every
+    process until the time is up"""
+
+    def __init__(self, name, slots):
+        self.name = name
+        self.slots = slots
+        self._semaphore = threading.BoundedSemaphore(slots) if fcntl is None else None
+
+    def _slot_path(self, slot):
+        return os.path.join(LOCK_DIR, f'{self.name}.slot{slot}.lock')
+
+    def _pause_path(self):
+        return os.path.join(LOCK_DIR, f'{self.name}.paused_until')
+
+    def paused_for(self):
+        """Seconds left in the current pause, or 0"""
+        try:
+            with open(self._pause_path(), 'r') as f:
+                return max(0.0, float(f.read()) - time.time())
+        except (FileNotFoundError, ValueError):
+            return 0.0
+
+    def pause(self, seconds):
+        """Hold back new calls for seconds (e.g. from a retry-after header). A longer pause already set is kept"""
+        seconds = min(seconds, MAX_RETRY_AFTER_SECONDS)
+        if seconds <= self.paused_for():
+            return
+        os.makedirs(LOCK_DIR, exist_ok=True)
+        path = self._pause_path()
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(time.time() + seconds))
+        os.replace(tmp_path, path)
+
+    def _try_acquire(self):
+        """Take a free slot without waiting. Returns the slot handle, or None if all slots are taken or calls are paused"""
+        if self.paused_for() > 0:
+            return None
+        if fcntl is None:
+            return self._semaphore if self._semaphore.acquire(blocking=False) else None
+        os.makedirs(LOCK_DIR, exist_ok=True)
+        # flock locks belong to the open file, so threads of one process also exclude each other
+        for slot in random.sample(range(self.slots), self.slots):
+            slot_file = open(self._slot_path(slot), 'a')
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot_file
+            except BlockingIOError:
+                slot_file.close()
+        return None
+
+    def _release(self, handle):
+        if fcntl is None:
+            handle.release()
+            return
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+
+    def _wait_seconds(self):
+        return max(ADMISSION_POLL_SECONDS, self.paused_for())
+
+    @contextmanager
+    def slot(self, timeout=ADMISSION_TIMEOUT_SECONDS):
+        """Hold a slot while the block runs. Raises AdmissionTimeout if none is free within timeout seconds"""
+        start = time.monotonic()
+        deadline = start + timeout
+        while (handle := self._try_acquire()) is None:
+            if time.monotonic() >= deadline:
+                raise AdmissionTimeout(f'No free LLM call slot after {timeout} seconds')
+            time.sleep(min(self._wait_seconds(), max(0.0, deadline - time.monotonic())))
+        LLM_ADMISSION_SECONDS.observe(time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release(handle)
+
+
+def retry_after_seconds(error):
+    """Seconds to wait from the retry-after header of a rate limit (429) or overloaded (529) error, or None"""
+    response = getattr(error, 'response', None)
+    if getattr(error, 'status_code', None) not in (429, 529) or response is None:
+        return None
+    try:
+        if 'retry-after-ms' in response.headers:
+            return float(response.headers['retry-after-ms']) / 1000
+        return float(response.headers['retry-after'])
+    except (KeyError, ValueError):
+        return None
+
+
+llm_calls = AdmissionController('llm_calls', MAX_CONCURRENT_LLM_CALLS)
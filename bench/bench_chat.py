@@ -0,0 +1,221 @@
+"""Benchmarks for the tutoring request path, run against a local fake Anthropic server.
+
+Usage: python bench/bench_chat.py [--students 4] [--turns 5] [--latency 0.05] [--json]
+
+Runs the new_student, select_student, /chat, /chat_stream and new_chat flows for several concurrent students
+and reports p50/p95/p99 latency and throughput, then measures the cost of extract_chat_messages, chat history
+I/O and notes I/O as the history grows. Everything runs in a temporary data directory.
+"""
+import argparse
+import json
+import os
+import pickle
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_anthropic import FakeAnthropicServer
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def summarize(latencies):
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 2) if latencies else 0.0,
+    }
+
+
+def run_student(app, student_name, turns, latencies, lock):
+    """One simulated student: create, select, stream the opening, chat for some turns (plain and streamed),
+    then start a new chat and stream its opening (which waits for the previous session's note finalization)"""
+    client = app.test_client()
+
+    def timed(flow, func):
+        start = time.perf_counter()
+        response = func()
+        response.get_data()  # Read streamed bodies to the end
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise RuntimeError(f'{flow} returned HTTP {response.status_code}')
+        with lock:
+            latencies.setdefault(flow, []).append(elapsed)
+
+    timed('new_student', lambda: client.post('/new_student', data={'student_name': student_name, 'student_info': 'Benchmark student'}))
+    timed('select_student', lambda: client.get(f'/select_student/{student_name}'))
+    timed('chat_get', lambda: client.get('/chat'))
+    timed('chat_opening', lambda: client.post('/chat_stream'))
+    for turn in range(turns):
+        timed('chat_post', lambda: client.post('/chat', data={'user_input': f'My answer is {turn}'}))
+        timed('chat_stream', lambda: client.post('/chat_stream', data={'user_input': f'Streamed answer {turn}'}))
+    timed('new_chat', lambda: client.post('/chat', data={'action': 'new_chat'}))
+    timed('new_chat_opening', lambda: client.post('/chat_stream'))
+
+
+def bench_flows(tutor, students, turns):
+    app = tutor.create_app()
+    latencies = {}
+    lock = threading.Lock()
+    errors = []
+
+    def target(i):
+        try:
+            run_student(app, f'bench-student-{i}', turns, latencies, lock)
+        except Exception as e:
+            errors.append(e)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(students)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+
+    total_requests = sum(len(values) for values in latencies.values())
+    return {
+        'students': students,
+        'turns_per_student': turns,
+        'wall_time_s': round(wall_time, 3),
+        'throughput_rps': round(total_requests / wall_time, 2),
+        'errors': [str(e) for e in errors],
+        'flows': {flow: summarize(values) for flow, values in sorted(latencies.items())},
+    }
+
+
+def make_history(tutor, n_messages):
+    """Synthetic chat history with n_messages messages, including tool calls and SVG"""
+    from anthropic.types import TextBlock, ToolUseBlock
+    messages = [{"role": "user", "content": tutor.make_first_user_message('bench-history')}]
+    svg = '<svg width="100" height="100"><circle cx="50" cy="50" r="40" fill="red"></circle></svg>'
+    i = 0
+    while len(messages) < n_messages:
+        messages.append({"role": "assistant", "content": [
+            TextBlock(type='text', text=f'<problem>Problem {i}</problem><to_student><p>Problem <strong>{i}</strong></p>{svg}<ul><li>hint</li></ul></to_student>'),
+            ToolUseBlock(type='tool_use', id=f'toolu_{i}', name='calculator', input={'expression': f'{i} * 3'}),
+        ]})
+        messages.append({"role": "user", "content": [{"type": "tool_result", "tool_use_id": f'toolu_{i}', "content": str(i * 3)}]})
+        messages.append({"role": "user", "content": f"Timestamp: {tutor.get_timestamp()}\n<from_student>Answer {i}</from_student>"})
+        i += 1
+    return messages[:n_messages]
+
+
+def time_call(func, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return round(min(times) * 1000, 3)
+
+
+def bench_growth(tutor, sizes):
+    """Per-turn cost of rendering, chat history I/O and notes I/O as the history grows"""
+    import chat_store
+    from utils import get_notes, edit_notes
+    from notes_store import write_notes
+    write_notes('bench-history', 'lesson_plan', 'Lesson plan\n' * 50)
+    results = []
+    for size in sizes:
+        messages = make_history(tutor, size)
+        chat_id = f'{size:06d}'
+        chat_store.save_chat_history('bench-history', chat_id, messages[:-1])
+
+        def append_turn():
+            path = chat_store.chat_log_path('bench-history', chat_id)
+            chat_store._written_counts[path] = (len(messages) - 1, os.path.getsize(path))
+            chat_store.save_chat_history('bench-history', chat_id, messages)
+
+        pickle_path = os.path.join('data', 'bench_history.pkl')
+
+        def pickle_save():
+            with open(pickle_path, 'wb') as f:
+                pickle.dump(messages, f)
+
+        def pickle_load():
+            with open(pickle_path, 'rb') as f:
+                pickle.load(f)
+
+        results.append({
+            'messages': size,
+            'extract_chat_messages_ms': time_call(lambda: tutor.extract_chat_messages(messages)),
+            'chat_log_append_ms': time_call(append_turn),
+            'chat_log_load_ms': time_call(lambda: chat_store.load_chat_history('bench-history', chat_id)),
+            'pickle_save_ms': time_call(pickle_save),
+            'pickle_load_ms': time_call(pickle_load),
+            'get_notes_ms': time_call(lambda: get_notes('bench-history', 'lesson_plan')),
+            'edit_notes_ms': time_call(lambda: edit_notes('bench-history', 'lesson_plan', 'Lesson plan', 'Lesson plan')),
+        })
+    return results
+
+
+def print_report(report):
+    flows = report['flows']
+    print(f"\nRequest flows: {flows['students']} students x {flows['turns_per_student']} turns, "
+          f"{flows['wall_time_s']}s wall time, {flows['throughput_rps']} requests/s")
+    print(f"{'flow':<18}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for flow, stats in flows['flows'].items():
+        print(f"{flow:<18}{stats['count']:>7}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    if flows['errors']:
+        print(f"Errors: {flows['errors']}")
+
+    print('\nPer-turn cost as history grows (best of 5, ms)')
+    columns = list(report['growth'][0].keys())
+    print(''.join(f'{column:>26}' for column in columns))
+    for row in report['growth']:
+        print(''.join(f'{row[column]:>26}' for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--students', type=int, default=4, help='Number of concurrent simulated students')
+    parser.add_argument('--turns', type=int, default=5, help='Chat turns per student')
+    parser.add_argument('--latency', type=float, default=0.05, help='Fake API latency per Messages call, in seconds')
+    parser.add_argument('--response-chars', type=int, default=500, help='Extra characters in each final tutor response')
+    parser.add_argument('--sizes', default='10,100,500,2000', help='History sizes (messages) for the growth benchmark')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    fake_server = FakeAnthropicServer(latency=args.latency, response_chars=args.response_chars).start()
+    os.environ['ANTHROPIC_BASE_URL'] = fake_server.base_url
+    os.environ.setdefault('ANTHROPIC_API_KEY', 'bench-key')
+
+    work_dir = tempfile.mkdtemp(prefix='seneca-bench-')
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        import tutor
+        tutor.VERBOSE_OUTPUT = False
+        report = {
+            'flows': bench_flows(tutor, args.students, args.turns),
+            'growth': bench_growth(tutor, [int(size) for size in args.sizes.split(',')]),
+            'fake_api_requests': fake_server.request_counts,
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        fake_server.stop()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Throughput of the transcript render pipeline (render.extract_chat_messages) on large transcripts with SVG.
+
+Usage: python bench/bench_render.py [--sizes 100,1000,5000] [--svg-shapes 40] [--json]
+
+For comparison it also times the previous pipeline (BeautifulSoup html.parser, a str.replace per Tailwind class
+and a sanitizer config built on every call), if beautifulsoup4 is installed.
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import nh3
+import render
+from anthropic.types import TextBlock, ToolUseBlock
+
+
+def make_svg(shapes):
+    parts = ['<svg width="300" height="200" viewBox="0 0 300 200" xmlns="http://www.w3.org/2000/svg">']
+    for i in range(shapes):
+        parts.append(f'<line x1="{i}" y1="0" x2="{i * 2}" y2="100" stroke="black" stroke-width="1"></line>')
+        parts.append(f'<circle cx="{i * 5}" cy="50" r="4" fill="blue"></circle>')
+        parts.append(f'<text x="{i * 5}" y="70" font-size="10">{i}</text>')
+    parts.append('<polygon points="0,0 10,10 0,10" fill="red"></polygon></svg>')
+    return ''.join(parts)
+
+
+def make_transcript(n_messages, svg_shapes):
+    svg = make_svg(svg_shapes)
+    messages = []
+    i = 0
+    while len(messages) < n_messages:
+        messages.append({"role": "assistant", "content": [
+            TextBlock(type='text', text=(f'<problem>Problem {i}</problem><solution>{i * 3}</solution>'
+                                         f'<to_student><h2>Problem {i}</h2><p>What is <strong>{i} * 3</strong>? '
+                                         f'See <a href="https://example.com/{i}">this</a>.</p>{svg}'
+                                         f'<ul><li><em>hint</em></li></ul><pre><code>x = {i}</code></pre></to_student>')),
+            ToolUseBlock(type='tool_use', id=f'toolu_{i}', name='calculator', input={'expression': f'{i} * 3'}),
+        ]})
+        messages.append({"role": "user", "content": [{"type": "tool_result", "tool_use_id": f'toolu_{i}', "content": str(i * 3)}]})
+        messages.append({"role": "user", "content": f"Timestamp: 2025-01-01 10:00:00\n<from_student>I think it's {i * 3}\nmaybe</from_student>"})
+        i += 1
+    return messages[:n_messages]
+
+
+def legacy_extract_chat_messages(messages):
+    """The render pipeline before render.py, kept here as the baseline"""
+    from bs4 import BeautifulSoup
+
+    def sanitize_html(html_text):
+        tags = set(nh3.ALLOWED_TAGS) | render.SVG_TAGS
+        attributes = copy.deepcopy(nh3.ALLOWED_ATTRIBUTES)
+        for tag, attrs in render.SVG_ATTRIBUTES.items():
+            attributes.setdefault(tag, set()).update(attrs)
+        return nh3.clean(html_text, tags=tags, attributes=attributes)
+
+    def format_html_w_tailwind(html_text):
+        for tag, attrs in render.TAILWIND_ATTRIBUTES.items():
+            html_text = html_text.replace('<a ', f'<a {attrs} ') if tag == 'a' else html_text.replace(f'<{tag}>', f'<{tag} {attrs}>')
+        return html_text
+
+    chat_messages = []
+    for message in messages:
+        if isinstance(message.get('content'), str):
+            content = message['content']
+        else:
+            content = ''.join(item.text + '\n\n' for item in message.get('content', []) if hasattr(item, 'text'))
+        soup = BeautifulSoup(content, 'html.parser')
+        filtered_messages = None
+        if message['role'] == 'assistant':
+            filtered_messages = [sanitize_html(format_html_w_tailwind(str(msg))) for msg in soup.find_all('to_student')]
+        elif message['role'] == 'user':
+            filtered_messages = [str(msg).replace('\n', '<br>') for msg in soup.find_all('from_student')]
+        if filtered_messages:
+            chat_messages.append({'role': message['role'], 'content': '\n'.join(filtered_messages)})
+    return chat_messages
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_size(n_messages, svg_shapes, repeat, include_legacy):
+    messages = make_transcript(n_messages, svg_shapes)
+    input_bytes = sum(len(block.text) for message in messages if message['role'] == 'assistant' for block in message['content'] if hasattr(block, 'text'))
+    result = {'messages': n_messages, 'input_mb': round(input_bytes / 1e6, 2)}
+    pipelines = {'render': render.extract_chat_messages}
+    if include_legacy:
+        pipelines['legacy'] = legacy_extract_chat_messages
+    for name, func in pipelines.items():
+        elapsed = best_time(lambda: func(messages), repeat)
+        result[f'{name}_ms'] = round(elapsed * 1000, 2)
+        result[f'{name}_messages_per_s'] = round(n_messages / elapsed)
+        result[f'{name}_mb_per_s'] = round(input_bytes / 1e6 / elapsed, 2)
+    if include_legacy:
+        result['speedup'] = round(result['legacy_ms'] / result['render_ms'], 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000,5000', help='Transcript sizes (messages)')
+    parser.add_argument('--svg-shapes', type=int, default=40, help='Shape groups in the SVG of each tutor message')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per size (the best is reported)')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    try:
+        import bs4  # noqa: F401
+        include_legacy = True
+    except ImportError:
+        include_legacy = False
+
+    results = [bench_size(int(size), args.svg_shapes, args.repeat, include_legacy) for size in args.sizes.split(',')]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    columns = list(results[0].keys())
+    print(''.join(f'{column:>24}' for column in columns))
+    for row in results:
+        print(''.join(f'{row[column]:>24}' for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Cold start time of the app, checked against a budget.
+
+Usage: python bench/bench_startup.py [--runs 5] [--import-budget 0.5] [--ready-budget 0.8] [--json]
+
+Each run starts a fresh Python process (so nothing is cached in sys.modules) that imports tutor, creates the app and
+serves / once with the test client. It reports the median time to import, to create the app and until the first
+response, and whether the Anthropic SDK was imported before the first response (it should only load in the background
+or on the first LLM call). Exits with status 1 if a median is over its budget, so it can run in CI.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_BUDGET_SECONDS = 0.5  # Budget for `import tutor` in a fresh process
+READY_BUDGET_SECONDS = 0.8  # Budget from the start of the import until the first response to /
+
+CHILD_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {repo_dir!r})
+import tutor
+imported = time.perf_counter()
+tutor.PRELOAD_LLM_CLIENT = {preload!r}
+app = tutor.create_app()
+created = time.perf_counter()
+anthropic_loaded = 'anthropic' in sys.modules
+response = app.test_client().get('/')
+ready = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'create_app': created - imported, 'ready': ready - start,
+                  'status': response.status_code, 'anthropic_loaded_before_first_response': anthropic_loaded}}))
+"""
+
+
+def run_once(preload):
+    """Time one cold start in a new process, in an empty data directory"""
+    with tempfile.TemporaryDirectory(prefix='seneca-startup-') as work_dir:
+        output = subprocess.run([sys.executable, '-c', CHILD_SCRIPT.format(repo_dir=REPO_DIR, preload=preload)],
+                                cwd=work_dir, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(count):
+    """The modules with the largest cumulative import time for `import tutor`, from python -X importtime"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import tutor'], cwd=REPO_DIR,
+                            capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            rows.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='Cold starts to time (the median is reported)')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET_SECONDS, help='Budget for importing tutor, in seconds')
+    parser.add_argument('--ready-budget', type=float, default=READY_BUDGET_SECONDS, help='Budget until the first response, in seconds')
+    parser.add_argument('--no-preload', action='store_true', help='Run without the background import of the Anthropic SDK')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    runs = [run_once(not args.no_preload) for _ in range(args.runs)]
+    report = {
+        'median_import_seconds': statistics.median(run['import'] for run in runs),
+        'median_create_app_seconds': statistics.median(run['create_app'] for run in runs),
+        'median_ready_seconds': statistics.median(run['ready'] for run in runs),
+        'anthropic_loaded_before_first_response': any(run['anthropic_loaded_before_first_response'] for run in runs),
+        'slowest_imports': slowest_imports(10),
+    }
+    over_budget = [name for name, value, budget in (('import', report['median_import_seconds'], args.import_budget),
+                                                    ('ready', report['median_ready_seconds'], args.ready_budget))
+                   if value > budget]
+
+    if args.json:
+        print(json.dumps({**report, 'over_budget': over_budget}, indent=2))
+    else:
+        print(f"import tutor:     {report['median_import_seconds']:.3f}s (budget {args.import_budget}s)")
+        print(f"create_app:       {report['median_create_app_seconds']:.3f}s")
+        print(f"first response:   {report['median_ready_seconds']:.3f}s (budget {args.ready_budget}s)")
+        print(f"anthropic loaded before first response: {report['anthropic_loaded_before_first_response']}")
+        print('Slowest imports (cumulative):')
+        for seconds, name in report['slowest_imports']:
+            print(f'  {seconds:8.3f}s  {name}')
+        if over_budget:
+            print(f"Over budget: {', '.join(over_budget)}")
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""Local stand-in for the Anthropic Messages, count_tokens and Message Batches APIs, for benchmarks.
+
+Point the app at it with ANTHROPIC_BASE_URL=http://127.0.0.1:<port>. Responses follow a script: a list of
+responses for one student turn, each a list of content blocks ({"type": "text", "text": ...} or
+{"type": "tool_use", "name": ..., "input": {...}}). The server picks the response by counting the assistant
+messages since the last message from the student, so tool follow-up calls get the next response in the script.
+A request that forces a tool with tool_choice gets a call to that tool, with the input from tool_inputs.
+
+Message batches are answered the same way. A batch ends batch_latency seconds after it is created, and its results
+are served from results_url as JSON Lines.
+
+Run standalone with: python bench/fake_anthropic.py --port 8010 --latency 0.5
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_SCRIPT = [
+    [
+        {"type": "text", "text": "<problem>What is 12 * 7?</problem><solution>84</solution>"},
+        {"type": "tool_use", "name": "calculator", "input": {"expression": "12 * 7"}},
+    ],
+    [
+        {"type": "tool_use", "name": "edit_notes", "input": {"note_topic": "lesson_plan", "old_excerpt": "", "new_excerpt": "Working on multiplication."}},
+    ],
+    [
+        {"type": "text", "text": "<to_student><p>Nice work! Here is the next one: <strong>what is 12 * 7?</strong></p>{padding}</to_student>"},
+    ],
+]
+
+# Input of the tool call made when a request forces a tool (see notes_maintenance.py)
+DEFAULT_TOOL_INPUTS = {
+    'edit_notes_batch': {'edits': [{'note_topic': 'lesson_plan', 'section': 'Next steps', 'new_excerpt': 'Practice multiplication facts up to 12 * 12.'}]},
+}
+
+
+def iso_time(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def estimate_tokens(value):
+    return max(1, len(json.dumps(value, default=str)) // 4)
+
+
+class FakeAnthropicServer:
+    """Threaded HTTP server that answers /v1/messages, /v1/messages/count_tokens and /v1/messages/batches"""
+
+    def __init__(self, port=0, latency=0.0, stream_chunk_delay=0.0, script=None, response_chars=0, tool_inputs=None, batch_latency=0.0):
+        self.latency = latency
+        self.stream_chunk_delay = stream_chunk_delay
+        self.script = script or DEFAULT_SCRIPT
+        self.response_chars = response_chars
+        self.tool_inputs = tool_inputs or DEFAULT_TOOL_INPUTS
+        self.batch_latency = batch_latency
+        self.request_counts = {'messages': 0, 'count_tokens': 0, 'batches': 0}
+        self._counts_lock = threading.Lock()
+        self.batches = {}  # Batch ID -> (created_at, list of result lines)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                path = self.path.split('?')[0]
+                if path == '/v1/messages/count_tokens':
+                    server._count('count_tokens')
+                    self._send_json({'input_tokens': estimate_tokens(body.get('messages', [])) + estimate_tokens(body.get('tools', []))})
+                elif path == '/v1/messages':
+                    server._count('messages')
+                    time.sleep(server.latency)
+                    message = server.make_message(body)
+                    if body.get('stream'):
+                        self._send_stream(message)
+                    else:
+                        self._send_json(message)
+                elif path == '/v1/messages/batches':
+                    server._count('batches')
+                    self._send_json(server.create_batch(body))
+                else:
+                    self._send_not_found(path)
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                parts = path.split('/')
+                if len(parts) < 5 or parts[1:4] != ['v1', 'messages', 'batches'] or parts[4] not in server.batches:
+                    self._send_not_found(path)
+                elif len(parts) == 5:
+                    self._send_json(server.batch_status(parts[4]))
+                elif parts[5:] == ['results'] and server.batch_status(parts[4])['processing_status'] == 'ended':
+                    payload = ''.join(json.dumps(line) + '\n' for line in server.batches[parts[4]][1]).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/binary')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                else:
+                    self._send_not_found(path)
+
+            def _send_not_found(self, path):
+                self._send_json({'type': 'error', 'error': {'type': 'not_found_error', 'message': path}}, status=404)
+
+            def _send_json(self, data, status=200):
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_event(self, event, data):
+                chunk = f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode()
+                self.wfile.write(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n')
+                self.wfile.flush()
+
+            def _send_stream(self, message):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                start = {**message, 'content': [], 'stop_reason': None, 'usage': {**message['usage'], 'output_tokens': 0}}
+                self._send_event('message_start', {'type': 'message_start', 'message': start})
+                for index, block in enumerate(message['content']):
+                    if block['type'] == 'text':
+                        self._send_event('content_block_start', {'type': 'content_block_start', 'index': index, 'content_block': {'type': 'text', 'text': ''}})
+                        for i in range(0, len(block['text']), 20):
+                            time.sleep(server.stream_chunk_delay)
+                            self._send_event('content_block_delta', {'type': 'content_block_delta', 'index': index, 'delta': {'type': 'text_delta', 'text': block['text'][i:i + 20]}})
+                    else:
+                        self._send_event('content_block_start', {'type': 'content_block_start', 'index': index, 'content_block': {**block, 'input': {}}})
+                        self._send_event('content_block_delta', {'type': 'content_block_delta', 'index': index, 'delta': {'type': 'input_json_delta', 'partial_json': json.dumps(block['input'])}})
+                    self._send_event('content_block_stop', {'type': 'content_block_stop', 'index': index})
+                self._send_event('message_delta', {'type': 'message_delta', 'delta': {'stop_reason': message['stop_reason'], 'stop_sequence': None},
+                                                   'usage': {'output_tokens': message['usage']['output_tokens']}})
+                self._send_event('message_stop', {'type': 'message_stop'})
+                self.wfile.write(b'0\r\n\r\n')
+                self.wfile.flush()
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.base_url = f'http://127.0.0.1:{self.port}'
+
+    def _count(self, key):
+        with self._counts_lock:
+            self.request_counts[key] += 1
+
+    def create_batch(self, body):
+        """Answer every request of a batch now; the results are served once batch_latency has passed"""
+        results = [{'custom_id': request['custom_id'], 'result': {'type': 'succeeded', 'message': self.make_message(request['params'])}}
+                   for request in body.get('requests', [])]
+        batch_id = f'msgbatch_{uuid.uuid4().hex[:24]}'
+        self.batches[batch_id] = (time.time(), results)
+        return self.batch_status(batch_id)
+
+    def batch_status(self, batch_id):
+        created_at, results = self.batches[batch_id]
+        ended = time.time() >= created_at + self.batch_latency
+        return {
+            'id': batch_id,
+            'type': 'message_batch',
+            'processing_status': 'ended' if ended else 'in_progress',
+            'request_counts': {'processing': 0 if ended else len(results), 'succeeded': len(results) if ended else 0,
+                               'errored': 0, 'canceled': 0, 'expired': 0},
+            'created_at': iso_time(created_at),
+            'ended_at': iso_time(created_at + self.batch_latency) if ended else None,
+            'expires_at': iso_time(created_at + 24 * 3600),
+            'archived_at': None,
+            'cancel_initiated_at': None,
+            'results_url': f'{self.base_url}/v1/messages/batches/{batch_id}/results' if ended else None,
+        }
+
+    def make_message(self, body):
+        """Build the scripted response for a Messages API request body"""
+        messages = body.get('messages', [])
+        step = 0
+        for message in reversed(messages):
+            content = message['content']
+            is_tool_result = isinstance(content, list) and any(item.get('type') == 'tool_result' for item in content)
+            if message['role'] == 'user' and not is_tool_result:
+                break
+            if message['role'] == 'assistant':
+                step += 1
+        blocks = self.script[min(step, len(self.script) - 1)]
+        tool_choice = body.get('tool_choice') or {}
+        if tool_choice.get('type') == 'tool':
+            blocks = [{'type': 'tool_use', 'name': tool_choice['name'], 'input': self.tool_inputs.get(tool_choice['name'], {})}]
+
+        content = []
+        for block in blocks:
+            if block['type'] == 'text':
+                content.append({'type': 'text', 'text': block['text'].replace('{padding}', '<p>' + 'x' * self.response_chars + '</p>' if self.response_chars else '')})
+            else:
+                content.append({**block, 'id': f'toolu_{uuid.uuid4().hex[:24]}'})
+        stop_reason = 'tool_use' if any(block['type'] == 'tool_use' for block in content) else 'end_turn'
+        input_tokens = estimate_tokens(messages) + estimate_tokens(body.get('system', '')) + estimate_tokens(body.get('tools', []))
+        return {
+            'id': f'msg_{uuid.uuid4().hex[:24]}',
+            'type': 'message',
+            'role': 'assistant',
+            'model': body.get('model', 'fake-model'),
+            'content': content,
+            'stop_reason': stop_reason,
+            'stop_sequence': None,
+            'usage': {'input_tokens': input_tokens, 'output_tokens': estimate_tokens(content),
+                      'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0},
+        }
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Anthropic Messages API server')
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before each Messages response')
+    parser.add_argument('--stream-chunk-delay', type=float, default=0.0, help='Seconds between streamed text deltas')
+    parser.add_argument('--script', help='JSON file with the scripted responses for one student turn')
+    parser.add_argument('--response-chars', type=int, default=0, help='Extra characters of text in the final response')
+    parser.add_argument('--batch-latency', type=float, default=0.0, help='Seconds until a message batch ends')
+    args = parser.parse_args()
+
+    script = None
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+    fake_server = FakeAnthropicServer(args.port, args.latency, args.stream_chunk_delay, script, args.response_chars, batch_latency=args.batch_latency)
+    print(f'Fake Anthropic API listening on {fake_server.base_url}')
+    fake_server.httpd.serve_forever()
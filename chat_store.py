@@ -0,0 +1,375 @@
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+from termcolor import colored
+import history_search
+import student_index
+from metrics import span
+from file_lock import student_lock
+
+DATA_DIR = 'data'
+CHAT_CACHE_SIZE = 64  # Number of parsed chat logs kept in memory (see load_chat_history)
+CACHE_CHECK_BYTES = 64  # Bytes before the parsed offset compared to tell an appended log from a replaced one
+
+# Assistant content blocks (TextBlock, ToolUseBlock) are stored as dicts and turned back into objects on load.
+# The adapter is built on first use (see get_content_block_adapter), since importing anthropic is slow
+_content_block_adapter = None
+
+# (number of messages, file size) of each chat log as last written or read by this process, so a save only has to
+# append the new ones. The size shows whether another worker process has changed the log since
+_written_counts = {}
+
+# path -> (inode, offset, mtime_ns, last CACHE_CHECK_BYTES bytes before offset, messages): the parsed messages of
+# the first offset bytes of a chat log. When the log has only been appended to, just the new lines are parsed
+_history_cache = OrderedDict()
+_history_cache_lock = threading.Lock()
+
+
+def chat_log_path(student_name_safe, chat_id):
+    return os.path.join(DATA_DIR, f'{student_name_safe}_chathistory_{chat_id}.jsonl')
+
+
+def chat_lock(student_name_safe):
+    """Lock held while writing a student's chat logs or allocating a chat ID. Works across worker processes"""
+    return student_lock(student_name_safe, 'chats')
+
+
+def legacy_pickle_path(student_name_safe, chat_id):
+    return os.path.join(DATA_DIR, f'{student_name_safe}_chathistory_{chat_id}.pkl')
+
+
+def chat_history_path(student_name_safe, chat_id):
+    """Path of the file holding a chat's history (the chat log, or a legacy pickle file), or None if there isn't one"""
+    for path in (chat_log_path(student_name_safe, chat_id), legacy_pickle_path(student_name_safe, chat_id)):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def serialize_message(message):
+    """Convert a message to a JSON-compatible dict"""
+    content = message['content']
+    if not isinstance(content, str):
+        content = [item.model_dump(mode='json') if hasattr(item, 'model_dump') else item for item in content]
+    return {**message, 'content': content}
+
+
+def get_content_block_adapter():
+    global _content_block_adapter
+    if _content_block_adapter is None:
+        from pydantic import TypeAdapter
+        from anthropic.types import ContentBlock
+        _content_block_adapter = TypeAdapter(ContentBlock)
+    return _content_block_adapter
+
+
+def deserialize_message(data):
+    """Convert a dict written by serialize_message back into a message"""
+    content = data['content']
+    if data['role'] == 'assistant' and isinstance(content, list):
+        content = [get_content_block_adapter().validate_python(item) for item in content]
+    return {**data, 'content': content}
+
+
+def _count_complete_lines(path):
+    """Returns the number of complete lines, or None if the file ends with a partial line"""
+    with open(path, 'rb') as f:
+        count = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                return None
+            count += 1
+        return count
+
+
+def _rewrite_chat_log(path, messages):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for message in messages:
+            f.write(json.dumps(serialize_message(message)) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def save_chat_history(student_name_safe, chat_id, messages):
+    """Append any messages that are not yet in the chat log"""
+    with span('save_chat_history'):
+        _save_chat_history(student_name_safe, chat_id, messages)
+
+
+def _save_chat_history(student_name_safe, chat_id, messages):
+    with chat_lock(student_name_safe):
+        path = chat_log_path(student_name_safe, chat_id)
+        if not os.path.exists(path):
+            student_index.add_chat(student_name_safe, chat_id)
+            written = 0
+        elif path in _written_counts and _written_counts[path][1] == os.path.getsize(path):
+            written = _written_counts[path][0]
+        else:
+            written = _count_complete_lines(path)
+        if written is None or len(messages) < written:
+            # History was shortened or the log has a partial last line, so it can't just be appended to
+            _rewrite_chat_log(path, messages)
+            _index_messages(student_name_safe, chat_id, messages)
+        elif len(messages) > written:
+            with open(path, 'a') as f:
+                f.write(''.join(json.dumps(serialize_message(message)) + '\n' for message in messages[written:]))
+                f.flush()
+                os.fsync(f.fileno())
+            _index_messages(student_name_safe, chat_id, messages, start=written)
+        _written_counts[path] = (len(messages), os.path.getsize(path))
+
+
+def _index_messages(student_name_safe, chat_id, messages, start=0):
+    """Add saved messages to the search index. The chat log is already written, so an error is only logged
+    (python history_search.py rebuild fills in what is missing)"""
+    try:
+        history_search.index_messages(student_name_safe, chat_id, messages, start)
+    except Exception as e:
+        print(colored(f'Error indexing chat {chat_id} of {student_name_safe} for search: {e}', 'red'))
+
+
+def iter_chat_history(student_name_safe, chat_id):
+    """Yield the messages of a chat log one at a time. Falls back to a legacy pickle file if there is no log"""
+    path = chat_log_path(student_name_safe, chat_id)
+    if not os.path.exists(path):
+        with open(legacy_pickle_path(student_name_safe, chat_id), 'rb') as f:
+            yield from pickle.load(f)
+        return
+
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                # Partial line left by a crash during an append
+                print(colored(f'Ignoring incomplete last line in {path}', 'red'))
+                break
+            yield deserialize_message(json.loads(line))
+
+
+def _copy_message(message):
+    """Copy of a cached message that the caller can change without changing the cache"""
+    content = message['content']
+    return {**message, 'content': content if isinstance(content, str) else list(content)}
+
+
+def _cached_messages(path, stat):
+    """The cached messages of a chat log if the log hasn't changed since it was parsed, otherwise None"""
+    with _history_cache_lock:
+        entry = _history_cache.get(path)
+        if entry is None or entry[:3] != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            return None
+        _history_cache.move_to_end(path)
+        return entry[4]
+
+
+def _load_chat_log(path):
+    """Parse a chat log, reusing the cached messages if the log was only appended to since they were parsed"""
+    with _history_cache_lock:
+        entry = _history_cache.get(path)
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        messages, offset, check = [], 0, b''
+        if entry is not None and entry[0] == stat.st_ino and entry[1] <= stat.st_size:
+            f.seek(entry[1] - len(entry[3]))
+            if f.read(len(entry[3])) == entry[3]:
+                messages, offset, check = list(entry[4]), entry[1], entry[3]
+            else:
+                f.seek(0)
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Partial line left by a crash during an append
+                print(colored(f'Ignoring incomplete last line in {path}', 'red'))
+                break
+            messages.append(deserialize_message(json.loads(line)))
+            offset += len(line)
+            check = line[-CACHE_CHECK_BYTES:]
+    with _history_cache_lock:
+        _history_cache[path] = (stat.st_ino, offset, stat.st_mtime_ns, check, messages)
+        _history_cache.move_to_end(path)
+        if len(_history_cache) > CHAT_CACHE_SIZE:
+            _history_cache.popitem(last=False)
+    if offset == stat.st_size:
+        _written_counts[path] = (len(messages), offset)
+    return messages
+
+
+def load_chat_history(student_name_safe, chat_id):
+    """Load chat history from the chat log. Parsed messages are cached, so a log is only parsed again where it
+    has grown since the last load"""
+    path = chat_log_path(student_name_safe, chat_id)
+    with span('load_chat_history'):
+        if not os.path.exists(path):
+            return list(iter_chat_history(student_name_safe, chat_id))
+        return [_copy_message(message) for message in _load_chat_log(path)]
+
+
+def load_chat_history_since(student_name_safe, chat_id, after):
+    """The messages of a chat after the first `after`, and the total number of messages. Only the messages after
+    `after` are parsed, so this is cheap when nothing was added"""
+    path = chat_log_path(student_name_safe, chat_id)
+    if not os.path.exists(path):
+        messages = load_chat_history(student_name_safe, chat_id)
+        return messages[after:], len(messages)
+    with span('load_chat_history', source='since'):
+        with open(path, 'rb') as f:
+            cached = _cached_messages(path, os.fstat(f.fileno()))
+            if cached is not None:
+                return [_copy_message(message) for message in cached[after:]], len(cached)
+            messages = []
+            count = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                if count >= after:
+                    messages.append(deserialize_message(json.loads(line)))
+                count += 1
+    return messages, count
+
+
+def allocate_chat_id(student_name_safe):
+    """Reserve the next chat ID for a student by creating its (empty) chat log. Safe when several workers
+    start a new chat for the same student at once"""
+    with chat_lock(student_name_safe):
+        chat_ids = list_chat_ids(student_name_safe)
+        chat_id = (max(chat_ids) if chat_ids else 0) + 1
+        while True:
+            path = chat_log_path(student_name_safe, f'{chat_id:06d}')
+            if not os.path.exists(legacy_pickle_path(student_name_safe, f'{chat_id:06d}')):
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    break
+                except FileExistsError:
+                    pass
+            chat_id += 1
+        student_index.add_chat(student_name_safe, chat_id)
+        _written_counts[path] = (0, 0)
+    return f'{chat_id:06d}'
+
+
+def prefetched_opening_path(student_name_safe):
+    return os.path.join(DATA_DIR, f'{student_name_safe}_prefetched_opening.json')
+
+
+def save_prefetched_opening(student_name_safe, notes_key, messages):
+    """Store opening messages generated ahead of time for a student's next session, with a key for the notes they were made from"""
+    path = prefetched_opening_path(student_name_safe)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'notes_key': notes_key, 'created_at': time.time(), 'messages': [serialize_message(m) for m in messages]}, f)
+    os.replace(tmp_path, path)
+
+
+def take_prefetched_opening(student_name_safe, notes_key, max_age_seconds):
+    """Remove and return the prefetched opening messages. None if there are none, or they were made from other notes
+    or more than max_age_seconds ago"""
+    path = prefetched_opening_path(student_name_safe)
+    with chat_lock(student_name_safe):
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        os.remove(path)
+    if data['notes_key'] != notes_key or time.time() - data['created_at'] > max_age_seconds:
+        return None
+    return [deserialize_message(m) for m in data['messages']]
+
+
+def pending_finalization_path(student_name_safe):
+    return os.path.join(DATA_DIR, f'{student_name_safe}_pending_finalization.json')
+
+
+def save_pending_finalization(student_name_safe, chat_id, message_count, messages, notes, notes_hashes):
+    """Store finalization turns made ahead of time for a chat that had message_count messages, with the draft notes
+    they wrote (topic -> text) and the notes_hash of each note they started from. They are kept out of the chat log
+    and the notes files until the student starts a new question, since the student may carry on with the session"""
+    path = pending_finalization_path(student_name_safe)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'chat_id': chat_id, 'message_count': message_count, 'messages': [serialize_message(m) for m in messages],
+                   'notes': notes, 'notes_hashes': notes_hashes}, f)
+    os.replace(tmp_path, path)
+
+
+def _read_pending_finalization(student_name_safe, chat_id=None, message_count=None):
+    try:
+        with open(pending_finalization_path(student_name_safe), 'r') as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if chat_id is not None and (data['chat_id'] != chat_id or data['message_count'] != message_count):
+        return None
+    return data
+
+
+def pending_finalization_notes(student_name_safe, chat_id=None, message_count=None):
+    """The draft notes of the pending finalization (of the chat as it is now, with message_count messages, if
+    chat_id is given). None if there is none"""
+    data = _read_pending_finalization(student_name_safe, chat_id, message_count)
+    return data['notes'] if data is not None else None
+
+
+def take_pending_finalization(student_name_safe, chat_id, message_count):
+    """Remove and return the finalization stored by save_pending_finalization, as a dict with its messages, notes
+    and notes_hashes. None if there is none, or it was made for another chat or before the student sent more messages"""
+    with chat_lock(student_name_safe):
+        data = _read_pending_finalization(student_name_safe, chat_id, message_count)
+        discard_pending_finalization(student_name_safe)
+    if data is None:
+        return None
+    return {**data, 'messages': [deserialize_message(m) for m in data['messages']]}
+
+
+def discard_pending_finalization(student_name_safe):
+    try:
+        os.remove(pending_finalization_path(student_name_safe))
+    except FileNotFoundError:
+        pass
+
+
+def list_chat_ids(student_name_safe):
+    """Get the sorted chat IDs (as ints) for a student"""
+    return student_index.list_chat_ids(student_name_safe)
+
+
+def migrate_pickles(keep_pickles=False):
+    """Convert every legacy .pkl chat history in the data directory to a chat log"""
+    if not os.path.exists(DATA_DIR):
+        return 0
+
+    migrated = 0
+    for file in sorted(os.listdir(DATA_DIR)):
+        if '_chathistory_' not in file or not file.endswith('.pkl'):
+            continue
+        student_name_safe, chat_id = file[:-len('.pkl')].rsplit('_chathistory_', 1)
+        pkl_path = legacy_pickle_path(student_name_safe, chat_id)
+        path = chat_log_path(student_name_safe, chat_id)
+        with open(pkl_path, 'rb') as f:
+            messages = pickle.load(f)
+
+        _rewrite_chat_log(path, messages)
+        _written_counts.pop(path, None)
+        # Only remove the pickle once the new log reads back the same
+        if [serialize_message(m) for m in load_chat_history(student_name_safe, chat_id)] != [serialize_message(m) for m in messages]:
+            print(colored(f'Round trip check failed for {file}; keeping the pickle file', 'red'))
+            continue
+        student_index.add_chat(student_name_safe, chat_id)
+        if not keep_pickles:
+            os.remove(pkl_path)
+        migrated += 1
+        print(colored(f'Migrated {file} -> {os.path.basename(path)}', 'green'))
+    return migrated
+
+
+if __name__ == '__main__':
+    # Usage: python chat_store.py migrate [--keep-pickles]
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print('Usage: python chat_store.py migrate [--keep-pickles]')
+        sys.exit(1)
+    count = migrate_pickles(keep_pickles='--keep-pickles' in sys.argv[2:])
+    print(f'Migrated {count} chat histories')
@@ -0,0 +1,297 @@
+"""Export all chat sessions and notes for analytics.
+
+Usage: python export.py [--out export] [--format jsonl|parquet] [--workers 4] [--full]
+
+Writes one shard per student for each table: turns/<student>.jsonl.gz (one row per chat history message) and
+notes/<student>.jsonl.gz (a snapshot of each notes file), or .parquet files with --format parquet (needs pyarrow).
+Chat histories are read one message at a time, and students are exported in parallel in a process pool.
+
+The export is incremental: export_state.json in the output directory keeps a high-water mark for each student (the
+newest modification time of their chat logs and notes), and only students with newer files are exported again.
+Shards of deleted students are removed. Use --full to export everyone.
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from termcolor import colored
+import student_index
+from chat_store import chat_history_path, iter_chat_history
+from notes_store import notes_path
+from render import find_tagged
+
+EXPORT_DIR = 'export'
+STATE_FILENAME = 'export_state.json'
+FORMATS = ('jsonl', 'parquet')
+EXPORT_WORKERS = 4  # Default size of the process pool
+
+TURN_COLUMNS = {  # Column name -> pyarrow type name, for the Parquet schema
+    'student': 'string',
+    'chat_id': 'int64',
+    'message_index': 'int64',
+    'role': 'string',  # user, assistant or compaction
+    'kind': 'string',  # notes_preamble, student, tutor, tool_results, instruction or summary
+    'timestamp': 'string',  # ISO 8601, from the "Timestamp:" prefix of student messages (or the preamble's timestamp)
+    'visible_text': 'string',  # What the student saw (tutor text is HTML) or wrote
+    'text': 'string',  # All text of the message, including the tutor's hidden reasoning
+    'tool_calls': 'string',  # JSON list of {"name", "input"} for the tutor's tool calls
+    'model': 'string',
+    'input_tokens': 'int64',
+    'cache_creation_input_tokens': 'int64',
+    'cache_read_input_tokens': 'int64',
+    'output_tokens': 'int64',
+}
+NOTE_COLUMNS = {
+    'student': 'string',
+    'topic': 'string',
+    'text': 'string',
+    'modified_at': 'string',  # ISO 8601
+}
+USAGE_COLUMNS = ('model', 'input_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens', 'output_tokens')
+
+_timestamp_pattern = re.compile(r'(?:^Timestamp|Here is the current timestamp): (\d{4}-\d{2}-\d{2}) (\d{2}:\d{2}:\d{2})', re.MULTILINE)
+
+
+def block_text(block):
+    """Text of a content block: an assistant TextBlock, or a text or tool_result dict in a user message"""
+    if isinstance(block, dict):
+        return str(block.get('content', '')) if block.get('type') == 'tool_result' else block.get('text', '')
+    return getattr(block, 'text', '')
+
+
+def message_text(message):
+    content = message['content']
+    if isinstance(content, str):
+        return content
+    return '\n'.join(text for text in (block_text(block) for block in content) if text)
+
+
+def message_kind(message, index):
+    if message['role'] == 'compaction':
+        return 'summary'
+    if message['role'] == 'assistant':
+        return 'tutor'
+    if not isinstance(message['content'], str):
+        return 'tool_results'
+    if index == 0:
+        return 'notes_preamble'
+    return 'student' if '<from_student>' in message['content'] else 'instruction'
+
+
+def message_row(student_name_safe, chat_id, index, message):
+    """One row of the turns table"""
+    text = message_text(message)
+    kind = message_kind(message, index)
+    timestamp = None
+    if message['role'] == 'user' and isinstance(message['content'], str):
+        match = _timestamp_pattern.search(text)
+        if match:
+            timestamp = f'{match.group(1)}T{match.group(2)}'
+    visible_tag = {'tutor': 'to_student', 'student': 'from_student'}.get(kind)
+    visible_text = '\n'.join(find_tagged(text, visible_tag)) if visible_tag else ''
+    tool_calls = None
+    if kind == 'tutor' and not isinstance(message['content'], str):
+        calls = [{'name': block.name, 'input': block.input} for block in message['content'] if getattr(block, 'type', None) == 'tool_use']
+        tool_calls = json.dumps(calls) if calls else None
+    usage = message.get('usage') or {}
+    return {
+        'student': student_name_safe,
+        'chat_id': int(chat_id),
+        'message_index': index,
+        'role': message['role'],
+        'kind': kind,
+        'timestamp': timestamp,
+        'visible_text': visible_text or None,
+        'text': text,
+        'tool_calls': tool_calls,
+        **{column: usage.get(column) for column in USAGE_COLUMNS},
+    }
+
+
+class JsonlShardWriter:
+    """Writes rows to a gzipped JSON Lines file, replacing it atomically on close"""
+
+    def __init__(self, path, columns):
+        self.path = path + '.jsonl.gz'
+        self._tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        self._file = gzip.open(self._tmp_path, 'wt', encoding='utf-8')
+
+    def write_rows(self, rows):
+        for row in rows:
+            self._file.write(json.dumps(row) + '\n')
+
+    def close(self):
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+
+class ParquetShardWriter:
+    """Writes rows to a Parquet file (one row group per write_rows call), replacing it atomically on close"""
+
+    def __init__(self, path, columns):
+        import pyarrow
+        import pyarrow.parquet
+        self.path = path + '.parquet'
+        self._tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema([(name, getattr(pyarrow, type_name)()) for name, type_name in columns.items()])
+        self._writer = pyarrow.parquet.ParquetWriter(self._tmp_path, self._schema, compression='zstd')
+
+    def write_rows(self, rows):
+        if rows:
+            self._writer.write_table(self._pyarrow.Table.from_pylist(rows, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+        os.replace(self._tmp_path, self.path)
+
+
+SHARD_WRITERS = {'jsonl': JsonlShardWriter, 'parquet': ParquetShardWriter}
+
+
+def student_files(student_name_safe, chat_ids):
+    """Paths of a student's chat histories and notes files"""
+    paths = [chat_history_path(student_name_safe, f'{chat_id:06d}') for chat_id in chat_ids]
+    paths += [notes_path(student_name_safe, topic) for topic in student_index.NOTE_TOPICS]
+    return [path for path in paths if path is not None and os.path.exists(path)]
+
+
+def high_water_mark(paths):
+    """Newest modification time (ns) of the files, or 0"""
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            pass
+    return max(mtimes, default=0)
+
+
+def export_student(out_dir, export_format, student_name_safe, chat_ids):
+    """Write the turns and notes shards for one student. Runs in a worker process; it reads the files directly, so
+    it doesn't use the parent's student index connection. Returns the number of sessions and turn rows written"""
+    writer_class = SHARD_WRITERS[export_format]
+    sessions = rows = 0
+    turns = writer_class(os.path.join(out_dir, 'turns', student_name_safe), TURN_COLUMNS)
+    try:
+        for chat_id in chat_ids:
+            try:
+                # One session at a time, so memory use doesn't grow with the number of sessions
+                session_rows = [message_row(student_name_safe, chat_id, i, message)
+                                for i, message in enumerate(iter_chat_history(student_name_safe, f'{chat_id:06d}'))]
+            except (FileNotFoundError, ValueError) as e:
+                print(colored(f'Skipping chat {chat_id:06d} of {student_name_safe}: {e}', 'red'))
+                continue
+            turns.write_rows(session_rows)
+            sessions += 1
+            rows += len(session_rows)
+    finally:
+        turns.close()
+
+    notes = writer_class(os.path.join(out_dir, 'notes', student_name_safe), NOTE_COLUMNS)
+    try:
+        note_rows = []
+        for topic in student_index.NOTE_TOPICS:
+            path = notes_path(student_name_safe, topic)
+            try:
+                with open(path, 'r') as f:
+                    text = f.read()
+                modified_at = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(os.path.getmtime(path)))
+            except FileNotFoundError:
+                continue
+            note_rows.append({'student': student_name_safe, 'topic': topic, 'text': text, 'modified_at': modified_at})
+        notes.write_rows(note_rows)
+    finally:
+        notes.close()
+    return sessions, rows
+
+
+def load_state(out_dir):
+    try:
+        with open(os.path.join(out_dir, STATE_FILENAME), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'format': None, 'students': {}}
+
+
+def save_state(out_dir, state):
+    path = os.path.join(out_dir, STATE_FILENAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def remove_shards(out_dir, student_name_safe):
+    for table in ('turns', 'notes'):
+        for extension in ('.jsonl.gz', '.parquet'):
+            try:
+                os.remove(os.path.join(out_dir, table, student_name_safe + extension))
+            except FileNotFoundError:
+                pass
+
+
+def run_export(out_dir=EXPORT_DIR, export_format='jsonl', workers=EXPORT_WORKERS, full=False):
+    """Export the students whose files changed since the last export. Returns the number of students exported"""
+    if export_format not in FORMATS:
+        raise ValueError(f'format must be one of {", ".join(FORMATS)}')
+    if export_format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise SystemExit('Parquet export needs pyarrow: pip install pyarrow (or use --format jsonl)')
+    for table in ('turns', 'notes'):
+        os.makedirs(os.path.join(out_dir, table), exist_ok=True)
+
+    state = load_state(out_dir)
+    if state['format'] != export_format:
+        full = True
+        for student_name_safe in state['students']:
+            remove_shards(out_dir, student_name_safe)
+        state = {'format': export_format, 'students': {}}
+
+    students = student_index.list_students()
+    for student_name_safe in set(state['students']) - set(students):
+        remove_shards(out_dir, student_name_safe)
+        del state['students'][student_name_safe]
+
+    # The high-water mark is taken before exporting, so a file changed during the export is exported again next time
+    todo = {}
+    for student_name_safe in students:
+        chat_ids = student_index.list_chat_ids(student_name_safe)
+        mark = high_water_mark(student_files(student_name_safe, chat_ids))
+        if full or mark > state['students'].get(student_name_safe, {}).get('high_water_mark', -1):
+            todo[student_name_safe] = (chat_ids, mark)
+    print(colored(f'Exporting {len(todo)} of {len(students)} students to {out_dir} ({export_format})', 'green'))
+
+    start_time = time.perf_counter()
+    total_sessions = total_rows = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(export_student, out_dir, export_format, student_name_safe, chat_ids): student_name_safe
+                   for student_name_safe, (chat_ids, _) in todo.items()}
+        for future in as_completed(futures):
+            student_name_safe = futures[future]
+            try:
+                sessions, rows = future.result()
+            except Exception as e:
+                print(colored(f'Error exporting {student_name_safe}: {e}', 'red'))
+                continue
+            total_sessions += sessions
+            total_rows += rows
+            state['students'][student_name_safe] = {'high_water_mark': todo[student_name_safe][1], 'sessions': sessions, 'rows': rows}
+            save_state(out_dir, state)  # After each student, so an interrupted export resumes where it stopped
+    save_state(out_dir, state)
+    print(colored(f'Exported {total_sessions} sessions ({total_rows} turns) in {time.perf_counter() - start_time:.1f}s', 'green'))
+    return len(todo)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default=EXPORT_DIR, help='Output directory')
+    parser.add_argument('--format', default='jsonl', choices=FORMATS, help='jsonl (gzipped JSON Lines) or parquet (needs pyarrow)')
+    parser.add_argument('--workers', type=int, default=EXPORT_WORKERS, help='Number of worker processes')
+    parser.add_argument('--full', action='store_true', help='Export all students, not only those changed since the last export')
+    args = parser.parse_args()
+    run_export(args.out, args.format, args.workers, args.full)
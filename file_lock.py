@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only work between threads of one process
+    fcntl = None
+
+LOCK_DIR = os.path.join('data', 'locks')
+LOCK_POLL_SECONDS = 0.05  # How often a lock with a timeout is retried
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+class InterProcessLock:
+    """Reentrant lock shared by the threads of this process (a threading.RLock) and by other worker processes
+    (an flock on a lock file, held while any thread of this process holds the lock)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self, timeout=None):
+        """Returns False if the lock couldn't be acquired within timeout seconds"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._thread_lock.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+        if self._depth == 0 and fcntl is not None:
+            try:
+                lock_file = self._lock_file(deadline)
+            except BaseException:
+                self._thread_lock.release()
+                raise
+            if lock_file is None:
+                self._thread_lock.release()
+                return False
+            self._file = lock_file
+        self._depth += 1
+        return True
+
+    def _lock_file(self, deadline):
+        """Open and flock the lock file, or return None if the deadline passes first. If the file was deleted while
+        waiting for it (see remove_student_locks), the new file at the path is locked instead"""
+        while True:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            try:
+                lock_file = open(self.path, 'a')
+            except FileNotFoundError:
+                continue  # The directory was removed after makedirs
+            try:
+                if deadline is None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                else:
+                    while True:
+                        try:
+                            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            break
+                        except BlockingIOError:
+                            if time.monotonic() >= deadline:
+                                lock_file.close()
+                                return None
+                            time.sleep(LOCK_POLL_SECONDS)
+                try:
+                    if os.stat(self.path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                        return lock_file
+                except FileNotFoundError:
+                    pass
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _get_lock(path):
+    with _locks_guard:
+        if path not in _locks:
+            _locks[path] = InterProcessLock(path)
+        return _locks[path]
+
+
+def named_lock(name):
+    """The InterProcessLock for a name, e.g. 'llm_calls'. The same object is returned for the same name, so threads
+    of this process share it"""
+    return _get_lock(os.path.join(LOCK_DIR, f'{name}.lock'))
+
+
+def student_lock_dir(student_name_safe):
+    return os.path.join(LOCK_DIR, 'students', student_name_safe)
+
+
+def student_lock(student_name_safe, name):
+    """The InterProcessLock for one of a student's resources, e.g. student_lock(student_name_safe, 'notes'). Kept
+    in the student's own directory, so remove_student_locks can't touch other locks"""
+    return _get_lock(os.path.join(student_lock_dir(student_name_safe), f'{name}.lock'))
+
+
+def remove_student_locks(student_name_safe):
+    """Delete a deleted student's lock files. Each file is deleted while holding its flock, and acquire locks the
+    path again if its file was deleted, so this is safe while other workers still use the locks. Files that are in
+    use are left in place"""
+    directory = student_lock_dir(student_name_safe)
+    with _locks_guard:
+        for path in [path for path, lock in _locks.items() if os.path.dirname(path) == directory and lock._depth == 0]:
+            del _locks[path]
+    try:
+        files = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for file in files:
+        path = os.path.join(directory, file)
+        try:
+            with open(path, 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(path)
+        except OSError:
+            pass  # In use (BlockingIOError)
+    try:
+        os.rmdir(directory)
+    except OSError:
+        pass
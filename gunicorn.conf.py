@@ -0,0 +1,8 @@
+import multiprocessing
+
+bind = '0.0.0.0:8001'
+workers = multiprocessing.cpu_count()
+# Each streamed chat turn holds a thread for as long as the LLM takes, so use threaded workers
+worker_class = 'gthread'
+threads = 8
+timeout = 300  # Longer than a chat turn with several tool calls and retries
@@ -0,0 +1,175 @@
+import re
+import sys
+import threading
+from termcolor import colored
+import jobs
+import student_index
+from render import find_tagged
+
+SEARCHABLE_NOTE_TOPICS = ['past_problems']  # Notes files that search_history also searches
+SNIPPET_TOKENS = 24  # Approximate length of each search result snippet, in words
+
+_tag_pattern = re.compile(r'<[^>]+>')
+_word_pattern = re.compile(r'\w+')
+_local = threading.local()
+
+
+def _create_table(connection):
+    """Create the full-text search table if needed. Returns True if it is new"""
+    is_new = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'history_fts'").fetchone() is None
+    # chat_id is NULL for notes; message_index is the position of the message in the chat log
+    connection.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+        text, student UNINDEXED, chat_id UNINDEXED, message_index UNINDEXED, role UNINDEXED, tokenize = 'porter unicode61')''')
+    _local.connection = connection
+    return is_new
+
+
+def get_connection():
+    """The student index connection, with the full-text search table created if needed. A new table is filled from
+    the data directory by background jobs (see index_student), so the request that creates it doesn't wait"""
+    connection = student_index.get_connection()
+    if getattr(_local, 'connection', None) is connection:
+        return connection
+    if _create_table(connection):
+        for student_name_safe in student_index.list_students():
+            jobs.submit(student_name_safe, index_student, student_name_safe)
+    return connection
+
+
+def message_search_text(message):
+    """The searchable text of a message: what the student wrote, or the tutor's text (problems, solutions and what
+    it told the student). Tool calls, tool results and the notes preamble are left out"""
+    content = message['content']
+    if message['role'] == 'user':
+        if not isinstance(content, str):
+            return ''
+        return ' '.join(find_tagged(content, 'from_student'))
+    if message['role'] == 'assistant':
+        if isinstance(content, str):
+            text = content
+        else:
+            text = ' '.join(block.text for block in content if getattr(block, 'type', None) == 'text')
+        return ' '.join(_tag_pattern.sub(' ', text).split())
+    return ''
+
+
+def _message_rows(student_name_safe, chat_id, messages, start=0):
+    rows = []
+    for i, message in enumerate(messages[start:], start):
+        text = message_search_text(message)
+        if text:
+            rows.append((text, student_name_safe, int(chat_id), i, message['role']))
+    return rows
+
+
+def index_messages(student_name_safe, chat_id, messages, start=0):
+    """Add messages[start:] of a chat to the search index. If start is 0, the chat's existing rows are replaced"""
+    connection = get_connection()
+    rows = _message_rows(student_name_safe, chat_id, messages, start)
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        if start == 0:
+            connection.execute('DELETE FROM history_fts WHERE student = ? AND chat_id = ?', (student_name_safe, int(chat_id)))
+        connection.executemany('INSERT INTO history_fts VALUES (?, ?, ?, ?, ?)', rows)
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+
+
+def index_notes(student_name_safe, note_topic, text):
+    if note_topic not in SEARCHABLE_NOTE_TOPICS:
+        return
+    connection = get_connection()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute('DELETE FROM history_fts WHERE student = ? AND chat_id IS NULL AND role = ?', (student_name_safe, note_topic))
+        connection.execute('INSERT INTO history_fts VALUES (?, ?, NULL, NULL, ?)', (text, student_name_safe, note_topic))
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+
+
+def remove_student(student_name_safe):
+    get_connection().execute('DELETE FROM history_fts WHERE student = ?', (student_name_safe,))
+
+
+def search(student_name_safe, query, limit=5):
+    """Best matches for query in a student's past sessions and searchable notes, as (chat_id, role, snippet) tuples"""
+    words = _word_pattern.findall(query)
+    if not words:
+        return []
+    match = ' OR '.join('"' + word + '"' for word in words)
+    return get_connection().execute(
+        'SELECT chat_id, role, snippet(history_fts, 0, \'[\', \']\', \'…\', ?) FROM history_fts '
+        'WHERE history_fts MATCH ? AND student = ? ORDER BY bm25(history_fts) LIMIT ?',
+        (SNIPPET_TOKENS, match, student_name_safe, limit)).fetchall()
+
+
+def _student_rows(student_name_safe):
+    """Search index rows for all of a student's chat logs and searchable notes, and the number of chats read"""
+    import chat_store
+    from notes_store import read_notes
+    rows, chats = [], 0
+    for chat_id in student_index.list_chat_ids(student_name_safe):
+        try:
+            messages = chat_store.load_chat_history(student_name_safe, f'{chat_id:06d}')
+        except (FileNotFoundError, ValueError) as e:
+            print(colored(f'Skipping chat {chat_id:06d} of {student_name_safe} in search index: {e}', 'red'))
+            continue
+        rows.extend(_message_rows(student_name_safe, chat_id, messages))
+        chats += 1
+    for topic in SEARCHABLE_NOTE_TOPICS:
+        try:
+            rows.append((read_notes(student_name_safe, topic), student_name_safe, None, None, topic))
+        except FileNotFoundError:
+            pass
+    return rows, chats
+
+
+def index_student(student_name_safe):
+    """Replace a student's rows in the search index. Holds the student's chat and notes locks, so messages and
+    notes saved meanwhile are not lost"""
+    import chat_store
+    from notes_store import notes_lock
+    connection = get_connection()
+    with chat_store.chat_lock(student_name_safe), notes_lock(student_name_safe):
+        rows, _ = _student_rows(student_name_safe)
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM history_fts WHERE student = ?', (student_name_safe,))
+            connection.executemany('INSERT INTO history_fts VALUES (?, ?, ?, ?, ?)', rows)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+
+def rebuild_search_index():
+    """Index every chat log and searchable notes file in the data directory"""
+    connection = student_index.get_connection()
+    _create_table(connection)
+    rows, chats = [], 0
+    for student_name_safe in student_index.list_students():
+        student_rows, student_chats = _student_rows(student_name_safe)
+        rows.extend(student_rows)
+        chats += student_chats
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute('DELETE FROM history_fts')
+        connection.executemany('INSERT INTO history_fts VALUES (?, ?, ?, ?, ?)', rows)
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    print(colored(f'Rebuilt search index: {chats} chats', 'green'))
+
+
+if __name__ == '__main__':
+    # Usage: python history_search.py rebuild
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebuild':
+        print('Usage: python history_search.py rebuild')
+        sys.exit(1)
+    rebuild_search_index()
@@ -0,0 +1,69 @@
+import concurrent.futures
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from termcolor import colored
+
+JOB_WORKERS = 4  # Size of the background worker pool
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='seneca-job')
+# student_name_safe -> deque of (future, func, args, kwargs). The first entry is the job that is running
+_queues = {}
+_lock = threading.Lock()
+
+
+def submit(student_name_safe, func, *args, **kwargs):
+    """Run func(*args, **kwargs) in the worker pool, after all jobs already submitted for the same student.
+    Jobs for different students run in parallel. Returns a Future"""
+    future = Future()
+    with _lock:
+        queue = _queues.setdefault(student_name_safe, deque())
+        queue.append((future, func, args, kwargs))
+        is_first = len(queue) == 1
+    if is_first:
+        _executor.submit(_run_next, student_name_safe)
+    return future
+
+
+def _run_next(student_name_safe):
+    with _lock:
+        future, func, args, kwargs = _queues[student_name_safe][0]
+
+    if future.set_running_or_notify_cancel():
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            print(colored(f'Error in background job for {student_name_safe}: {e}', 'red'))
+            future.set_exception(e)
+
+    with _lock:
+        queue = _queues[student_name_safe]
+        queue.popleft()
+        has_more = bool(queue)
+        if not has_more:
+            del _queues[student_name_safe]
+    if has_more:
+        _executor.submit(_run_next, student_name_safe)
+
+
+def cancel_pending(student_name_safe):
+    """Cancel the jobs for a student that haven't started yet. The running job, if any, carries on"""
+    with _lock:
+        futures = [entry[0] for entry in _queues.get(student_name_safe, ())]
+    for future in futures:
+        future.cancel()
+
+
+def pending_jobs(student_name_safe):
+    with _lock:
+        return len(_queues.get(student_name_safe, ()))
+
+
+def wait_for_student(student_name_safe, timeout=None):
+    """Wait for the jobs submitted so far for a student to finish. Returns False if the timeout ran out first"""
+    with _lock:
+        futures = [entry[0] for entry in _queues.get(student_name_safe, ())]
+    if not futures:
+        return True
+    _, not_done = concurrent.futures.wait(futures, timeout=timeout)
+    return not not_done
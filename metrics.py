@@ -0,0 +1,114 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# Trace of the request being handled (see profiling.Trace). Spans are added to its timeline
+current_trace = ContextVar('current_trace', default=None)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._values = {}  # label key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            data = self._values[key]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, data in sorted(self._values.items()):
+                cumulative = 0
+                for bucket, count in zip(self.buckets, data):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_format_labels(key, [("le", str(bucket))])} {cumulative}')
+                lines.append(f'{self.name}_bucket{_format_labels(key, [("le", "+Inf")])} {data[-1]}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {data[-2]}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {data[-1]}')
+        return lines
+
+
+def render_prometheus():
+    with _registry_lock:
+        metrics = list(_registry)
+    return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+LLM_REQUEST_SECONDS = Histogram('seneca_llm_request_duration_seconds', 'Latency of messages.create calls')
+LLM_REQUESTS = Counter('seneca_llm_requests_total', 'messages.create calls, by model, route and stop_reason')
+LLM_TOKENS = Counter('seneca_llm_tokens_total', 'Tokens used by messages.create calls, by type')
+LLM_COST = Counter('seneca_llm_cost_dollars_total', 'Estimated cost of messages.create calls, by model and route')
+LLM_RETRIES = Counter('seneca_llm_retries_total', 'Failed messages.create attempts')
+LLM_ADMISSION_SECONDS = Histogram('seneca_llm_admission_wait_seconds', 'Time LLM calls waited for a free slot (see admission.py)')
+TOOL_SECONDS = Histogram('seneca_tool_duration_seconds', 'Time spent running each tool call')
+TOOL_ERRORS = Counter('seneca_tool_errors_total', 'Tool calls that returned an error')
+SPAN_SECONDS = Histogram('seneca_span_duration_seconds', 'Time spent in instrumented parts of the request path')
+
+
+@contextmanager
+def span(name, **labels):
+    """Time a block of code into seneca_span_duration_seconds{span=name}, and into the current request's trace if any"""
+    trace = current_trace.get()
+    entry = trace.start_span(name, labels) if trace is not None else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPAN_SECONDS.observe(time.perf_counter() - start, span=name, **labels)
+        if entry is not None:
+            trace.end_span(entry)
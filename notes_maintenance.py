@@ -0,0 +1,213 @@
+"""Offline maintenance of the notes: trim each student's notes and update their lesson plan between sessions, so
+live sessions start with compact notes and spend less time on housekeeping.
+
+Usage: python notes_maintenance.py submit|status|apply|run [--all] [--poll-seconds 60]
+
+submit sends one request per student to the Message Batches API (half the price of live calls, results usually
+within an hour). Each request has the student's notes and must answer with one edit_notes_batch call. Students whose
+notes haven't changed since their last maintenance pass are skipped, unless --all is given.
+apply downloads the results of ended batches and applies the edits with edit_notes_batch. If a student's notes changed
+after the batch was submitted (e.g. in a live session), their edits are dropped rather than overwriting the new notes.
+run submits, waits for the batches to end and applies them.
+
+The pending batches are kept in data/notes_maintenance.json. Set ANTHROPIC_BASE_URL to use bench/fake_anthropic.py.
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+from termcolor import colored
+import student_index
+from notes_store import DATA_DIR, read_notes, notes_hash, get_notes_key
+from utils import TOOLS, MODEL_ROUTES, make_system_prompt, build_request, call_api_with_retries, edit_notes_batch, get_client, get_timestamp, record_usage
+
+STATE_FILE = os.path.join(DATA_DIR, 'notes_maintenance.json')
+MAX_BATCH_REQUESTS = 10000  # Most requests per batch (the API allows up to 100,000, or 256 MB)
+POLL_SECONDS = 60  # How often run checks whether the batches have ended
+
+MAINTENANCE_TOOLS = [tool for tool in TOOLS if tool['name'] == 'edit_notes_batch']
+
+MAINTENANCE_PROMPT = """This is an offline maintenance pass over your notes, between sessions. The student is not here, and nothing you write is shown to them. Here are your current notes about the student:
+<notes_content>
+{notes_content}
+</notes_content>
+
+Here is the current timestamp: {timestamp}
+
+Please tidy up the notes so the next session can start quickly:
+1. Trim any note longer than 1-2 pages: merge duplicate points, shorten details of finished topics and drop anything stale. The full text of past sessions stays searchable, so the notes only need summaries.
+2. Update the lesson_plan: check that each topic's status (no proficiency, progressing, mastery) matches the rest of the notes, and put the next topics to work on first.
+3. Keep the markdown sections (such as "## Goals" or "## Topics"), and add sections to notes that don't have them yet.
+
+Make all the changes in one edit_notes_batch call. Rewriting a whole section (an empty old_excerpt with a section) or a whole note (an empty old_excerpt without a section) is fine. If the notes don't need any changes, call edit_notes_batch with an empty list of edits.
+"""
+
+
+def load_state():
+    try:
+        with open(STATE_FILE, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        # batches: pending batches; maintained: student -> notes key (see notes_store.get_notes_key) after their last pass
+        return {'batches': [], 'maintained': {}}
+
+
+def save_state(state):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(STATE_FILE + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(STATE_FILE + '.tmp', STATE_FILE)
+
+
+def make_maintenance_request(student_name_safe):
+    """Messages API parameters for one student's maintenance request, and the notes_hash of each topic it was made
+    from. None if the student has no notes"""
+    notes_content = ''
+    hashes = {}
+    for topic in student_index.NOTE_TOPICS:
+        try:
+            text = read_notes(student_name_safe, topic)
+        except FileNotFoundError:
+            continue
+        hashes[topic] = notes_hash(student_name_safe, topic)
+        notes_content += f'<notes topic="{topic}">\n{text}\n</notes>\n'
+    if not hashes:
+        return None, None
+    messages = [{"role": "user", "content": MAINTENANCE_PROMPT.format(notes_content=notes_content, timestamp=get_timestamp())}]
+    params = build_request(make_system_prompt(), messages, MAINTENANCE_TOOLS, route='maintenance')
+    # Only the system prompt and tools are the same for every student, so the notes don't get a cache breakpoint
+    params['messages'] = messages
+    params['tool_choice'] = {"type": "tool", "name": "edit_notes_batch"}
+    return params, hashes
+
+
+def submit(all_students=False):
+    """Submit maintenance requests for the students whose notes changed since their last pass (or all of them).
+    Returns the IDs of the new batches"""
+    state = load_state()
+    pending_students = {entry['student'] for batch in state['batches'] for entry in batch['requests'].values()}
+    requests = []
+    for student_name_safe in student_index.list_students():
+        if student_name_safe in pending_students:
+            continue
+        if not all_students and state['maintained'].get(student_name_safe) == get_notes_key(student_name_safe):
+            continue
+        params, hashes = make_maintenance_request(student_name_safe)
+        if params is not None:
+            requests.append((student_name_safe, params, hashes))
+    if not requests:
+        print(colored('No notes need maintenance', 'green'))
+        return []
+
+    batch_ids = []
+    for start in range(0, len(requests), MAX_BATCH_REQUESTS):
+        chunk = requests[start:start + MAX_BATCH_REQUESTS]
+        # custom_id only allows ASCII letters, digits, - and _, and student names may have other letters
+        batch_requests = [{'custom_id': f'notes-{i}', 'params': params} for i, (_, params, _) in enumerate(chunk)]
+        batch = call_api_with_retries(get_client().messages.batches.create, requests=batch_requests, admit=False)
+        state['batches'].append({
+            'id': batch.id,
+            'submitted_at': time.time(),
+            'requests': {f'notes-{i}': {'student': student_name_safe, 'hashes': hashes}
+                         for i, (student_name_safe, _, hashes) in enumerate(chunk)},
+        })
+        save_state(state)
+        batch_ids.append(batch.id)
+        print(colored(f'Submitted batch {batch.id} with maintenance requests for {len(chunk)} students', 'green'))
+    return batch_ids
+
+
+def get_edits(message):
+    """The edits from the edit_notes_batch call in a maintenance response, or None if there isn't one"""
+    for block in message.content:
+        if block.type == 'tool_use' and block.name == 'edit_notes_batch':
+            return block.input.get('edits') or []
+    return None
+
+
+def apply_result(entry, result, latency):
+    """Apply one batch result. Returns 'applied', 'unchanged', 'conflict' or 'failed'"""
+    student_name_safe = entry['student']
+    if result.type != 'succeeded':
+        error = getattr(getattr(result, 'error', None), 'error', None)
+        print(colored(f'Maintenance request for {student_name_safe} {result.type}' + (f': {error.message}' if error else ''), 'red'))
+        return 'failed'
+    record_usage(student_name_safe, result.message, latency, route='maintenance', batch=True)
+    edits = get_edits(result.message)
+    if edits is None:
+        print(colored(f'Maintenance response for {student_name_safe} has no edit_notes_batch call', 'red'))
+        return 'failed'
+    if not student_index.student_exists(student_name_safe):
+        return 'failed'
+    if edits:
+        outcome = edit_notes_batch(student_name_safe, edits, expected_hashes=entry['hashes'])
+        if outcome.startswith('Error:'):
+            changed = [topic for topic, expected in entry['hashes'].items() if notes_hash(student_name_safe, topic) != expected]
+            print(colored(f'Maintenance edits for {student_name_safe} not applied: {outcome}', 'red'))
+            return 'conflict' if changed else 'failed'
+    return 'applied' if edits else 'unchanged'
+
+
+def apply(wait=False, poll_seconds=POLL_SECONDS):
+    """Apply the results of the pending batches that have ended (waiting for all of them if wait is True).
+    Returns the number of students for each outcome"""
+    state = load_state()
+    counts = {}
+    while state['batches']:
+        for batch_state in list(state['batches']):
+            batch = call_api_with_retries(get_client().messages.batches.retrieve, batch_state['id'], admit=False)
+            if batch.processing_status != 'ended':
+                print(colored(f'Batch {batch.id} is {batch.processing_status} ({batch.request_counts.processing} requests processing)', 'yellow'))
+                continue
+            ended_at = batch.ended_at.timestamp() if batch.ended_at else time.time()
+            latency = max(0.0, ended_at - batch_state['submitted_at'])
+            # Downloaded in full, so a dropped connection can be retried without applying any result twice
+            results = call_api_with_retries(lambda: list(get_client().messages.batches.results(batch.id)), admit=False)
+            for result in results:
+                entry = batch_state['requests'].get(result.custom_id)
+                if entry is None:
+                    continue
+                outcome = apply_result(entry, result.result, latency)
+                counts[outcome] = counts.get(outcome, 0) + 1
+                if outcome in ('applied', 'unchanged'):
+                    state['maintained'][entry['student']] = get_notes_key(entry['student'])
+            state['batches'].remove(batch_state)
+            save_state(state)
+            print(colored(f'Applied batch {batch.id}', 'green'))
+        if not wait or not state['batches']:
+            break
+        time.sleep(poll_seconds)
+    if counts:
+        print(colored('Maintenance results: ' + ', '.join(f'{count} {outcome}' for outcome, count in sorted(counts.items())), 'green'))
+    return counts
+
+
+def status():
+    state = load_state()
+    if not state['batches']:
+        print('No pending maintenance batches')
+    for batch_state in state['batches']:
+        batch = call_api_with_retries(get_client().messages.batches.retrieve, batch_state['id'], admit=False)
+        submitted = datetime.fromtimestamp(batch_state['submitted_at']).strftime('%Y-%m-%d %H:%M:%S')
+        counts = batch.request_counts
+        print(f'{batch.id}: {batch.processing_status}, submitted {submitted}, {len(batch_state["requests"])} students '
+              f'({counts.processing} processing, {counts.succeeded} succeeded, {counts.errored} errored, {counts.expired} expired)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['submit', 'status', 'apply', 'run'])
+    parser.add_argument('--all', action='store_true', help='Submit all students, not only those whose notes changed since their last pass')
+    parser.add_argument('--poll-seconds', type=float, default=POLL_SECONDS, help='How often run checks the batches')
+    args = parser.parse_args()
+    print(colored(f"Notes maintenance with {MODEL_ROUTES['maintenance']['model']}", 'green'))
+    if args.command == 'submit':
+        submit(args.all)
+    elif args.command == 'status':
+        status()
+    elif args.command == 'apply':
+        apply()
+    else:
+        submit(args.all)
+        apply(wait=True, poll_seconds=args.poll_seconds)
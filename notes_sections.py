@@ -0,0 +1,86 @@
+import difflib
+import re
+
+DIFF_MAX_CHARS = 1500  # Longest diff returned to the LLM after a notes edit
+
+_heading_pattern = re.compile(r'^(#{1,6})[ \t]+(.+?)[ \t]*#*[ \t]*$', re.MULTILINE)
+
+
+def find_section(notes, section):
+    """(start, body_start, end) character offsets of a markdown section ("## Title") in notes, matching the title
+    case-insensitively. The section runs until the next heading of the same or a higher level. None if not found"""
+    headings = list(_heading_pattern.finditer(notes))
+    for i, match in enumerate(headings):
+        if match.group(2).strip().lower() != section.strip().lower():
+            continue
+        level = len(match.group(1))
+        end = len(notes)
+        for following in headings[i + 1:]:
+            if len(following.group(1)) <= level:
+                end = following.start()
+                break
+        return match.start(), min(match.end() + 1, len(notes)), end
+    return None
+
+
+def list_sections(notes):
+    return [match.group(2).strip() for match in _heading_pattern.finditer(notes)]
+
+
+def get_section(notes, section):
+    """Text of a section, including its heading. None if not found"""
+    bounds = find_section(notes, section)
+    if bounds is None:
+        return None
+    start, _, end = bounds
+    return notes[start:end]
+
+
+def apply_edit(notes, old_excerpt=None, new_excerpt=None, section=None):
+    """Apply one edit_notes edit to notes and return the new text. Raises ValueError if the edit can't be applied.
+
+    Without a section, old_excerpt is replaced with new_excerpt, or the whole notes if old_excerpt is empty.
+    With a section, old_excerpt is only looked for in that section; an empty old_excerpt replaces the section's body
+    (the section is added at the end if it doesn't exist yet), and empty excerpts delete the section."""
+    old_excerpt = old_excerpt or ''
+    new_excerpt = new_excerpt or ''
+    if section is None:
+        if not old_excerpt and not new_excerpt:
+            raise ValueError('Both old_excerpt and new_excerpt cannot be empty')
+        if not old_excerpt:
+            return new_excerpt
+        if old_excerpt not in notes:
+            raise ValueError('Could not find the exact text to replace')
+        return notes.replace(old_excerpt, new_excerpt)
+
+    if not notes.endswith('\n'):
+        notes += '\n'
+    bounds = find_section(notes, section)
+    if bounds is None:
+        if old_excerpt:
+            raise ValueError(f'No section named "{section}". Sections: {", ".join(list_sections(notes)) or "none"}')
+        if not new_excerpt:
+            raise ValueError(f'No section named "{section}"')
+        return f'{notes.rstrip()}\n\n## {section}\n{new_excerpt.strip()}\n'
+
+    start, body_start, end = bounds
+    if not old_excerpt and not new_excerpt:
+        return notes[:start] + notes[end:]
+    if not old_excerpt:
+        return notes[:body_start] + new_excerpt.strip() + '\n' + notes[end:]
+    body = notes[body_start:end]
+    if old_excerpt not in body:
+        raise ValueError(f'Could not find the exact text to replace in section "{section}"')
+    return notes[:body_start] + body.replace(old_excerpt, new_excerpt) + notes[end:]
+
+
+def describe_change(note_topic, old_notes, new_notes):
+    """Short confirmation of a notes edit with a unified diff, instead of the whole new notes"""
+    diff_lines = list(difflib.unified_diff(old_notes.splitlines(), new_notes.splitlines(), n=0, lineterm=''))
+    diff = '\n'.join(diff_lines[2:])  # Without the ---/+++ file header lines
+    summary = f'Changes saved to {note_topic} notes ({len(new_notes)} characters, was {len(old_notes)}).'
+    if not diff:
+        return f'{summary} No text changed.'
+    if len(diff) > DIFF_MAX_CHARS:
+        return f'{summary} The diff is too long to show; use get_notes to see the new version if needed.'
+    return f'{summary} Diff:\n{diff}'
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from termcolor import colored
+import history_search
+import student_index
+from file_lock import student_lock
+
+DATA_DIR = 'data'
+NOTES_CACHE_SIZE = 256  # Number of notes files kept in memory
+
+# (student_name_safe, note_topic) -> (file signature, text, md5 hash of text)
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def notes_path(student_name_safe, note_topic):
+    return os.path.join(DATA_DIR, f'{student_name_safe}_{note_topic}.txt')
+
+
+def notes_lock(student_name_safe):
+    """Lock to hold while doing a read-modify-write of a student's notes. Works across worker processes"""
+    return student_lock(student_name_safe, 'notes')
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _cache_put(key, signature, text):
+    entry = (signature, text, hashlib.md5(text.encode()).hexdigest())
+    with _cache_lock:
+        _cache[key] = entry
+        _cache.move_to_end(key)
+        if len(_cache) > NOTES_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return entry
+
+
+def _get_entry(student_name_safe, note_topic):
+    """Get the cache entry for a notes file, re-reading it if another process changed it. Raises FileNotFoundError"""
+    key = (student_name_safe, note_topic)
+    path = notes_path(student_name_safe, note_topic)
+    signature = _file_signature(path)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] == signature:
+            _cache.move_to_end(key)
+            return entry
+
+    with open(path, 'r') as f:
+        text = f.read()
+    return _cache_put(key, signature, text)
+
+
+def read_notes(student_name_safe, note_topic):
+    """Read a notes file. Raises FileNotFoundError if it doesn't exist"""
+    return _get_entry(student_name_safe, note_topic)[1]
+
+
+def notes_hash(student_name_safe, note_topic):
+    """md5 hash of a notes file's text, or None if it doesn't exist"""
+    try:
+        return _get_entry(student_name_safe, note_topic)[2]
+    except FileNotFoundError:
+        return None
+
+
+def get_notes_key(student_name_safe, notes=None):
+    """Changes whenever any of the student's notes change. notes: texts to use instead of the files (topic -> text),
+    e.g. a draft that hasn't been saved yet"""
+    notes = notes or {}
+    return ','.join(hashlib.md5(notes[topic].encode()).hexdigest() if topic in notes else str(notes_hash(student_name_safe, topic))
+                    for topic in student_index.NOTE_TOPICS)
+
+
+def write_notes(student_name_safe, note_topic, text):
+    """Atomically replace a notes file (write to a temp file, then rename) and update the cache"""
+    path = notes_path(student_name_safe, note_topic)
+    if not os.path.exists(path):
+        student_index.add_note_file(student_name_safe, note_topic)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _cache_put((student_name_safe, note_topic), _file_signature(path), text)
+    try:
+        history_search.index_notes(student_name_safe, note_topic, text)
+    except Exception as e:
+        # The notes are already saved; python history_search.py rebuild fills in what is missing from the index
+        print(colored(f'Error indexing {note_topic} of {student_name_safe} for search: {e}', 'red'))
+
+
+def forget_student(student_name_safe):
+    """Drop a student's notes from the cache (e.g. after deleting the student)"""
+    with _cache_lock:
+        for key in [key for key in _cache if key[0] == student_name_safe]:
+            del _cache[key]
@@ -0,0 +1,305 @@
+"""Request traces, an opt-in sampling profiler, and capture of slow requests.
+
+Every request gets a Trace: a timeline of the spans (see metrics.span) it runs, including spans in the threads it
+hands work to. A request is also profiled, by sampling the stacks of its threads every SAMPLE_INTERVAL_SECONDS, if
+it has the X-Seneca-Profile: 1 header or the ?profile=1 query flag, or for a random PROFILE_SAMPLE_RATE fraction of
+chat turns. Requests slower than SLOW_REQUEST_SECONDS (and every request that asked to be profiled) are saved to
+PROFILE_DIR: <id>.json has the span timeline, and <id>.folded the profile in the collapsed stack format read by
+flame graph tools such as speedscope or flamegraph.pl. They are listed at /admin/slow_turns.
+"""
+import contextvars
+import functools
+import json
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from termcolor import colored
+import student_index
+from metrics import current_trace
+
+PROFILE_SAMPLE_RATE = float(os.getenv('SENECA_PROFILE_SAMPLE_RATE', '0'))  # Fraction of chat turns profiled without being asked
+SLOW_REQUEST_SECONDS = float(os.getenv('SENECA_SLOW_REQUEST_SECONDS', '10'))  # Requests slower than this are saved
+SAMPLE_INTERVAL_SECONDS = 0.005  # Time between stack samples of a profiled request
+MAX_STACK_DEPTH = 100  # Deeper stacks are cut off at the root end
+PROFILE_DIR = 'logs/profiles'
+PROFILE_HEADER = 'X-Seneca-Profile'
+PROFILE_QUERY_FLAG = 'profile'
+SAMPLED_ENDPOINTS = ('tutor.chat', 'tutor.chat_stream')  # Endpoints profiled at PROFILE_SAMPLE_RATE
+SLOW_REQUEST_MAX_AGE_SECONDS = 7 * 24 * 3600  # Saved requests older than this are deleted
+PURGE_INTERVAL_SECONDS = 3600  # How often each process deletes old saved requests
+
+_local = threading.local()
+_last_purge = 0.0
+
+# Traces being profiled, and the thread that samples them (running while there are any)
+_profiled_traces = set()
+_sampler_lock = threading.Lock()
+_sampler_running = False
+
+
+class Trace:
+    """Span timeline, and stack samples if profiled, of one request. The trace finishes when the request and every
+    thread it started with run_in_thread have released it"""
+
+    def __init__(self, endpoint, method, profiled, forced=False):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(4)}"
+        self.endpoint = endpoint
+        self.method = method
+        self.profiled = profiled
+        self.forced = forced  # Saved even if it isn't slow, because the request asked to be profiled
+        self.student_name_safe = None
+        self.chat_id = None
+        self.started_at = time.time()
+        self.seconds = None
+        self.spans = []
+        self.stacks = Counter()
+        self.sample_count = 0
+        self._start = time.perf_counter()
+        self._threads = Counter()  # Thread ident -> number of attach() calls not yet detached
+        self._holders = 1
+        self._lock = threading.Lock()
+        if profiled:
+            _start_profiling(self)
+
+    def start_span(self, name, labels):
+        entry = {'name': name, 'labels': labels, 'thread': threading.current_thread().name,
+                 'start': round(time.perf_counter() - self._start, 6), 'seconds': None}
+        with self._lock:
+            self.spans.append(entry)
+        self.attach()
+        return entry
+
+    def end_span(self, entry):
+        entry['seconds'] = round(time.perf_counter() - self._start - entry['start'], 6)
+        self.detach()
+
+    def attach(self):
+        """Sample the current thread's stack (if profiled) until detach is called"""
+        with self._lock:
+            self._threads[threading.get_ident()] += 1
+
+    def detach(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] -= 1
+            if self._threads[ident] <= 0:
+                del self._threads[ident]
+
+    def take_sample(self, frames):
+        with self._lock:
+            idents = list(self._threads)
+        for ident in idents:
+            frame = frames.get(ident)
+            names = []
+            while frame is not None and len(names) < MAX_STACK_DEPTH:
+                names.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                frame = frame.f_back
+            if names:
+                with self._lock:
+                    self.stacks[';'.join(reversed(names))] += 1
+        with self._lock:
+            self.sample_count += 1
+
+    def hold(self):
+        with self._lock:
+            self._holders += 1
+
+    def release(self):
+        with self._lock:
+            self._holders -= 1
+            finished = self._holders == 0
+        if finished:
+            self.finish()
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self._start
+        if self.profiled:
+            _stop_profiling(self)
+        if self.forced or self.seconds >= SLOW_REQUEST_SECONDS:
+            try:
+                save_trace(self)
+            except Exception as e:
+                print(colored(f'Error saving trace {self.id}: {e}', 'red'))
+
+
+def _sample_loop():
+    global _sampler_running
+    while True:
+        with _sampler_lock:
+            traces = list(_profiled_traces)
+            if not traces:
+                _sampler_running = False
+                return
+        frames = sys._current_frames()
+        for trace in traces:
+            trace.take_sample(frames)
+        del frames
+        time.sleep(SAMPLE_INTERVAL_SECONDS)
+
+
+def _start_profiling(trace):
+    global _sampler_running
+    with _sampler_lock:
+        _profiled_traces.add(trace)
+        if not _sampler_running:
+            _sampler_running = True
+            threading.Thread(target=_sample_loop, name='seneca-profiler', daemon=True).start()
+
+
+def _stop_profiling(trace):
+    with _sampler_lock:
+        _profiled_traces.discard(trace)
+
+
+def should_profile(request):
+    """(profiled, forced): whether to profile a request, and whether it asked to be"""
+    forced = request.headers.get(PROFILE_HEADER) == '1' or request.args.get(PROFILE_QUERY_FLAG) == '1'
+    sampled = request.endpoint in SAMPLED_ENDPOINTS and random.random() < PROFILE_SAMPLE_RATE
+    return forced or sampled, forced
+
+
+def start_trace(endpoint, method, profiled=False, forced=False):
+    """Start a trace and make it the current one. Call end_trace when the request is done"""
+    trace = Trace(endpoint, method, profiled, forced)
+    current_trace.set(trace)
+    return trace
+
+
+def end_trace():
+    """Release the current trace (it finishes once threads started with run_in_thread are done too)"""
+    trace = current_trace.get()
+    if trace is not None:
+        current_trace.set(None)
+        trace.release()
+
+
+def traced(view):
+    """Decorator for views: sample the thread the view runs in while it runs"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        trace = current_trace.get()
+        if trace is None:
+            return view(*args, **kwargs)
+        trace.attach()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            trace.detach()
+    return wrapper
+
+
+def run_in_thread(target):
+    """Run target in a new daemon thread that is part of the current request's trace, so its spans and stacks are
+    recorded and the trace isn't finished before it is"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.hold()
+
+    def run():
+        if trace is None:
+            return target()
+        trace.attach()
+        try:
+            return target()
+        finally:
+            trace.detach()
+            trace.release()
+
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True)
+    thread.start()
+    return thread
+
+
+def get_connection():
+    """The student index connection, with the slow request table created if needed"""
+    connection = student_index.get_connection()
+    if getattr(_local, 'connection', None) is not connection:
+        connection.execute('''CREATE TABLE IF NOT EXISTS slow_requests (
+            id TEXT PRIMARY KEY, student TEXT, chat_id INTEGER, endpoint TEXT, method TEXT, started_at REAL,
+            seconds REAL, profiled INTEGER)''')
+        connection.execute('CREATE INDEX IF NOT EXISTS slow_requests_by_student ON slow_requests (student, seconds)')
+        _local.connection = connection
+    return connection
+
+
+def trace_path(trace_id, extension):
+    return os.path.join(PROFILE_DIR, f'{trace_id}.{extension}')
+
+
+def save_trace(trace):
+    """Write the trace's timeline (and profile) to PROFILE_DIR and add it to the slow request table"""
+    global _last_purge
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    chat_id = int(trace.chat_id) if trace.chat_id is not None else None
+    with open(trace_path(trace.id, 'json'), 'w') as f:
+        json.dump({
+            'id': trace.id,
+            'endpoint': trace.endpoint,
+            'method': trace.method,
+            'student': trace.student_name_safe,
+            'chat_id': chat_id,
+            'started_at': trace.started_at,
+            'seconds': round(trace.seconds, 6),
+            'spans': sorted(trace.spans, key=lambda entry: entry['start']),
+            'profile': {'interval_seconds': SAMPLE_INTERVAL_SECONDS, 'samples': trace.sample_count} if trace.profiled else None,
+        }, f, indent=1)
+    if trace.profiled:
+        with open(trace_path(trace.id, 'folded'), 'w') as f:
+            f.writelines(f'{stack} {count}\n' for stack, count in trace.stacks.most_common())
+
+    connection = get_connection()
+    connection.execute('INSERT OR REPLACE INTO slow_requests VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (trace.id, trace.student_name_safe, chat_id, trace.endpoint, trace.method, trace.started_at,
+                        trace.seconds, int(trace.profiled)))
+    print(colored(f'Saved trace {trace.id} of {trace.endpoint} ({trace.seconds:.2f}s'
+                  + (', profiled' if trace.profiled else '') + ')', 'yellow'))
+    now = time.time()
+    if now - _last_purge > PURGE_INTERVAL_SECONDS:
+        _last_purge = now
+        purge_traces(connection, 'started_at < ?', (now - SLOW_REQUEST_MAX_AGE_SECONDS,))
+
+
+def purge_traces(connection, where, params):
+    """Delete the saved requests matching a condition on the slow request table, with their files"""
+    trace_ids = [row[0] for row in connection.execute(f'SELECT id FROM slow_requests WHERE {where}', params)]
+    for trace_id in trace_ids:
+        for extension in ('json', 'folded'):
+            try:
+                os.remove(trace_path(trace_id, extension))
+            except FileNotFoundError:
+                pass
+    connection.execute(f'DELETE FROM slow_requests WHERE {where}', params)
+
+
+def slowest_requests(per_student=10, since=None):
+    """The slowest saved requests of each student since a time (default: SLOW_REQUEST_MAX_AGE_SECONDS ago), as
+    {student: [row dicts, slowest first]}. Requests without a student are listed under None"""
+    since = time.time() - SLOW_REQUEST_MAX_AGE_SECONDS if since is None else since
+    rows = get_connection().execute('''
+        SELECT id, student, chat_id, endpoint, method, started_at, seconds, profiled FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY student ORDER BY seconds DESC) AS rank
+            FROM slow_requests WHERE started_at >= ?)
+        WHERE rank <= ? ORDER BY student, seconds DESC''', (since, per_student)).fetchall()
+    columns = ('id', 'student', 'chat_id', 'endpoint', 'method', 'started_at', 'seconds', 'profiled')
+    result = {}
+    for row in rows:
+        entry = dict(zip(columns, row))
+        entry['started'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['started_at']))
+        result.setdefault(entry['student'], []).append(entry)
+    return result
+
+
+def read_trace(trace_id, extension='json'):
+    """Text of a saved trace file. Raises FileNotFoundError"""
+    if not all(c.isalnum() or c == '-' for c in trace_id):
+        raise FileNotFoundError(trace_id)
+    with open(trace_path(trace_id, extension), 'r') as f:
+        return f.read()
+
+
+def remove_student(student_name_safe):
+    purge_traces(get_connection(), 'student = ?', (student_name_safe,))
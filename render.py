@@ -0,0 +1,92 @@
+import html
+import re
+import nh3
+
+SVG_TAGS = {"svg", "line", "text", "rect", "path", "polygon", "polyline", "ellipse", "circle", "g", "defs", "use", "clipPath", "linearGradient", "stop", "image"}
+SVG_ATTRIBUTES = {
+    'svg': ['width', 'height', 'viewBox', 'xmlns', 'fill', 'stroke'],
+    'path': ['d', 'fill', 'stroke', 'stroke-width'],
+    'circle': ['cx', 'cy', 'r', 'fill', 'stroke'],
+    'line': ['x1', 'y1', 'x2', 'y2', 'stroke', 'stroke-width', 'marker-end', 'marker-start'],
+    'text': ['x', 'y', 'font-size', 'fill', 'font-weight'],
+    'rect': ['x', 'y', 'width', 'height', 'fill', 'stroke', 'stroke-width'],
+    'marker': ['id', 'markerWidth', 'markerHeight', 'refX', 'refY', 'orient'],
+    'polygon': ['points', 'fill'],
+}
+
+# Attributes added to tags in tutor HTML, after sanitizing
+TAILWIND_ATTRIBUTES = {
+    'ul': 'class="list-disc ml-4"',
+    'a': 'target="_blank" class="text-indigo-600 hover:underline"',
+    'p': 'class="mt-2"',
+    'h1': 'class="text-2xl font-bold mt-4"',
+    'h2': 'class="text-xl font-bold mt-4"',
+    'h3': 'class="text-lg font-bold mt-4"',
+    'h4': 'class="text-base font-bold mt-4"',
+    'strong': 'class="font-bold"',
+    'em': 'class="italic"',
+    'blockquote': 'class="border-l-4 border-gray-300 pl-4 italic"',
+    'code': 'class="bg-gray-200 p-1 rounded"',
+    'pre': 'class="bg-gray-200 p-2 rounded overflow-x-auto whitespace-pre-wrap"',
+}
+
+
+def _make_cleaner():
+    tags = set(nh3.ALLOWED_TAGS) | SVG_TAGS
+    attributes = {tag: set(attrs) for tag, attrs in nh3.ALLOWED_ATTRIBUTES.items()}
+    for tag, attrs in SVG_ATTRIBUTES.items():
+        attributes.setdefault(tag, set()).update(attrs)
+    return nh3.Cleaner(tags=tags, attributes=attributes)
+
+
+_cleaner = _make_cleaner()
+_tailwind_pattern = re.compile(r'<(' + '|'.join(TAILWIND_ATTRIBUTES) + r')(?=[\s>])')
+_tag_patterns = {}
+
+
+def sanitize_html(html_text):
+    return _cleaner.clean(html_text)
+
+
+def format_html_w_tailwind(html_text):
+    """Format HTML text to be more readable by adding Tailwind CSS classes, in a single pass over the text"""
+    return _tailwind_pattern.sub(lambda match: f'<{match.group(1)} {TAILWIND_ATTRIBUTES[match.group(1)]}', html_text)
+
+
+def render_tutor_html(html_text):
+    """Sanitize tutor HTML, then style it. Styling runs second so the sanitizer doesn't strip the classes"""
+    return format_html_w_tailwind(sanitize_html(html_text))
+
+
+def render_student_text(text):
+    return html.escape(text, quote=False).replace('\n', '<br>')
+
+
+def find_tagged(text, tag):
+    """Contents of each <tag>...</tag> block in text. An unclosed block runs to the end of the text"""
+    if tag not in _tag_patterns:
+        _tag_patterns[tag] = re.compile(rf'<{tag}>(.*?)(?:</{tag}>|$)', re.DOTALL | re.IGNORECASE)
+    return _tag_patterns[tag].findall(text)
+
+
+def extract_chat_messages(messages):
+    """Extract student and tutor text from the messages list"""
+    chat_messages = []
+    for message in messages:
+        if isinstance(message.get('content'), str):
+            content = message['content']
+        else:
+            content = ''.join(item.text + '\n\n' for item in message.get('content', []) if hasattr(item, 'text'))
+
+        filtered_messages = None
+        if message['role'] == 'assistant':  # HTML formatted text
+            filtered_messages = [render_tutor_html(block) for block in find_tagged(content, 'to_student') if block.strip()]
+        elif message['role'] == 'user':  # Plain text
+            filtered_messages = [render_student_text(block) for block in find_tagged(content, 'from_student') if block.strip()]
+
+        if filtered_messages:
+            chat_messages.append({
+                'role': message['role'],
+                'content': '\n'.join(filtered_messages)
+            })
+    return chat_messages
@@ -0,0 +1,172 @@
+import ast
+import decimal
+import math
+import operator
+import time
+from fractions import Fraction
+
+MAX_EXPRESSION_CHARS = 2000  # Longest expression accepted
+MAX_AST_NODES = 500  # Most syntax nodes in one expression
+MAX_EXPONENT = 10000  # Largest absolute exponent for **
+MAX_INTEGER_DIGITS = 1000  # Largest integer (or numerator/denominator) allowed in a result
+EVALUATION_SECONDS = 0.5  # Time limit for evaluating one expression
+DECIMAL_PRECISION = 50  # Significant digits in decimal mode
+
+NUMBER_TYPES = ('float', 'fraction', 'decimal')
+
+_MAX_INTEGER_BITS = int(MAX_INTEGER_DIGITS * math.log2(10)) + 1
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+_COMPARISON_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+
+def _sqrt(value):
+    if isinstance(value, decimal.Decimal):
+        return value.sqrt()
+    return math.sqrt(value)
+
+
+def _round(value, ndigits=None):
+    if ndigits is not None and abs(ndigits) > MAX_EXPONENT:
+        raise CalculatorError(f'round() digits is larger than {MAX_EXPONENT}')
+    return round(value, None if ndigits is None else int(ndigits))
+
+
+_FUNCTIONS = {
+    'abs': abs,
+    'round': _round,
+    'min': min,
+    'max': max,
+    'sqrt': _sqrt,
+}
+
+
+class CalculatorError(Exception):
+    pass
+
+
+def _check_size(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value.bit_length() > _MAX_INTEGER_BITS:
+        raise CalculatorError(f'result has more than {MAX_INTEGER_DIGITS} digits')
+    if isinstance(value, Fraction) and max(value.numerator.bit_length(), value.denominator.bit_length()) > _MAX_INTEGER_BITS:
+        raise CalculatorError(f'result has more than {MAX_INTEGER_DIGITS} digits')
+    return value
+
+
+def _bit_length(value):
+    if isinstance(value, int):
+        return value.bit_length()
+    if isinstance(value, Fraction):
+        return max(value.numerator.bit_length(), value.denominator.bit_length())
+    return 0
+
+
+def _power(base, exponent):
+    """base ** exponent, refusing exponents whose result would be too large to compute quickly"""
+    if abs(exponent) > MAX_EXPONENT:
+        raise CalculatorError(f'exponent is larger than {MAX_EXPONENT}')
+    # bit_length * exponent overestimates the result size (up to 2x for small bases), the result is checked exactly after
+    if _bit_length(base) * abs(exponent) > _MAX_INTEGER_BITS * 2:
+        raise CalculatorError(f'result has more than {MAX_INTEGER_DIGITS} digits')
+    return base ** exponent
+
+
+class _Evaluator:
+    def __init__(self, number_type):
+        self.number_type = number_type
+        self.deadline = time.monotonic() + EVALUATION_SECONDS
+
+    def number(self, value):
+        if self.number_type == 'fraction':
+            return Fraction(repr(value)) if isinstance(value, float) else Fraction(value)
+        if self.number_type == 'decimal':
+            return decimal.Decimal(repr(value)) if isinstance(value, float) else decimal.Decimal(value)
+        return value
+
+    def visit(self, node):
+        if time.monotonic() > self.deadline:
+            raise CalculatorError(f'evaluation took longer than {EVALUATION_SECONDS}s')
+
+        if isinstance(node, ast.Expression):
+            return self.visit(node.body)
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return self.number(node.value)
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+            left, right = self.visit(node.left), self.visit(node.right)
+            if isinstance(node.op, ast.Pow):
+                return _check_size(_power(left, right))
+            return _check_size(_BINARY_OPERATORS[type(node.op)](left, right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+            return _UNARY_OPERATORS[type(node.op)](self.visit(node.operand))
+        if isinstance(node, ast.Compare) and all(type(op) in _COMPARISON_OPERATORS for op in node.ops):
+            left = self.visit(node.left)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self.visit(comparator)
+                if not _COMPARISON_OPERATORS[type(op)](left, right):
+                    return False
+                left = right
+            return True
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS and not node.keywords:
+            return _check_size(_FUNCTIONS[node.func.id](*[self.visit(arg) for arg in node.args]))
+        if isinstance(node, ast.Name) and node.id in ('pi', 'e'):
+            return self.number(getattr(math, node.id))
+        raise CalculatorError(f'unsupported syntax: {ast.unparse(node) if isinstance(node, ast.expr) else type(node).__name__}')
+
+
+def evaluate(expression, number_type='float'):
+    """Evaluate an arithmetic expression by walking its AST, with limits on size and time. Raises CalculatorError,
+    or ArithmeticError/ValueError/TypeError from the arithmetic itself"""
+    if number_type not in NUMBER_TYPES:
+        raise CalculatorError(f'number_type must be one of {", ".join(NUMBER_TYPES)}')
+    if len(expression) > MAX_EXPRESSION_CHARS:
+        raise CalculatorError(f'expression is longer than {MAX_EXPRESSION_CHARS} characters')
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except (SyntaxError, RecursionError, MemoryError) as e:
+        raise CalculatorError(f'invalid expression: {e.msg if isinstance(e, SyntaxError) else "too deeply nested"}')
+    if sum(1 for _ in ast.walk(tree)) > MAX_AST_NODES:
+        raise CalculatorError(f'expression has more than {MAX_AST_NODES} parts')
+
+    with decimal.localcontext() as context:
+        context.prec = DECIMAL_PRECISION
+        context.traps[decimal.Inexact] = False
+        try:
+            return _Evaluator(number_type).visit(tree)
+        except RecursionError:
+            raise CalculatorError('expression is too deeply nested')
+        except ZeroDivisionError:
+            raise CalculatorError('division by zero')
+        except decimal.DecimalException as e:
+            raise CalculatorError(f'invalid decimal operation ({type(e).__name__})')
+
+
+def format_result(value):
+    if isinstance(value, Fraction):
+        if value.denominator == 1:
+            return str(value.numerator)
+        return f'{value} (≈ {float(value):.12g})'
+    if isinstance(value, decimal.Decimal):
+        value = value.normalize(decimal.Context(prec=DECIMAL_PRECISION))
+        return format(value, 'f') if abs(value.adjusted()) < DECIMAL_PRECISION else str(value)
+    return str(value)
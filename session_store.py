@@ -0,0 +1,77 @@
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+DATA_DIR = 'data'
+SESSIONS_FILENAME = 'sessions.sqlite3'
+SESSION_PURGE_INTERVAL_SECONDS = 3600  # How often each process deletes expired sessions
+
+_local = threading.local()
+
+
+def get_connection():
+    """Get this thread's connection to the session database"""
+    path = os.path.join(DATA_DIR, SESSIONS_FILENAME)
+    connection = getattr(_local, 'connection', None)
+    if connection is not None and _local.path == path and os.path.exists(path):
+        return connection
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT, updated_at REAL)')
+    _local.connection = connection
+    _local.path = path
+    return connection
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class SqliteSessionInterface(SessionInterface):
+    """Keeps session data in SQLite, shared by all worker processes. The cookie only holds a random session ID"""
+
+    def __init__(self):
+        self._last_purge = 0.0
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            row = get_connection().execute('SELECT data, updated_at FROM sessions WHERE sid = ?', (sid,)).fetchone()
+            if row is not None and row[1] > time.time() - app.permanent_session_lifetime.total_seconds():
+                return ServerSession(json.loads(row[0]), sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                get_connection().execute('DELETE FROM sessions WHERE sid = ?', (session.sid,))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified and not session.new:
+            return
+
+        now = time.time()
+        get_connection().execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)', (session.sid, json.dumps(dict(session)), now))
+        if now - self._last_purge > SESSION_PURGE_INTERVAL_SECONDS:
+            self._last_purge = now
+            get_connection().execute('DELETE FROM sessions WHERE updated_at < ?', (now - app.permanent_session_lifetime.total_seconds(),))
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
@@ -0,0 +1,64 @@
+import secrets
+import threading
+import time
+import student_index
+from file_lock import student_lock
+
+TURN_WAIT_SECONDS = 600  # Longest a request waits for another request's turn on the same chat to finish
+IDEMPOTENCY_KEY_MAX_AGE_SECONDS = 24 * 3600  # How long request keys are remembered
+KEY_PURGE_INTERVAL_SECONDS = 3600  # How often each process deletes old request keys
+
+_local = threading.local()
+_last_purge = 0.0
+
+
+def get_connection():
+    """The student index connection, with the request key table created if needed"""
+    connection = student_index.get_connection()
+    if getattr(_local, 'connection', None) is not connection:
+        # scope is a chat ID for chat turns, or 'new_chat'; result is what the request did (see record_request)
+        connection.execute('''CREATE TABLE IF NOT EXISTS request_keys (
+            student TEXT, scope TEXT, key TEXT, result INTEGER, created_at REAL, PRIMARY KEY (student, scope, key))''')
+        _local.connection = connection
+    return connection
+
+
+def new_request_key():
+    """Idempotency key for a form. Submitting the form twice sends the same key, so the second request is not run again"""
+    return secrets.token_urlsafe(16)
+
+
+def turn_lock(student_name_safe, chat_id):
+    """Lock held while a chat turn runs, so only one LLM loop runs per chat at a time (across worker processes)"""
+    return student_lock(student_name_safe, f'{chat_id}.turn')
+
+
+def new_chat_lock(student_name_safe):
+    return student_lock(student_name_safe, 'new_chat')
+
+
+def find_request(student_name_safe, scope, key):
+    """The result recorded for a request key, or None if no request with this key has run"""
+    if not key:
+        return None
+    row = get_connection().execute('SELECT result FROM request_keys WHERE student = ? AND scope = ? AND key = ?',
+                                   (student_name_safe, scope, key)).fetchone()
+    return None if row is None else row[0]
+
+
+def record_request(student_name_safe, scope, key, result):
+    """Remember that the request with key ran. For a chat turn, result is the number of messages before the
+    student's message; for a new chat, the new chat ID. Call while holding the lock for the scope"""
+    global _last_purge
+    if not key:
+        return
+    now = time.time()
+    connection = get_connection()
+    connection.execute('INSERT OR REPLACE INTO request_keys VALUES (?, ?, ?, ?, ?)', (student_name_safe, scope, key, result, now))
+    if now - _last_purge > KEY_PURGE_INTERVAL_SECONDS:
+        _last_purge = now
+        connection.execute('DELETE FROM request_keys WHERE created_at < ?', (now - IDEMPOTENCY_KEY_MAX_AGE_SECONDS,))
+
+
+def remove_student(student_name_safe):
+    get_connection().execute('DELETE FROM request_keys WHERE student = ?', (student_name_safe,))
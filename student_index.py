@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import sys
+import threading
+from termcolor import colored
+
+DATA_DIR = 'data'
+INDEX_FILENAME = 'index.sqlite3'
+NOTE_TOPICS = ['student_info', 'lesson_plan', 'past_problems']
+
+_local = threading.local()
+
+
+def index_path():
+    return os.path.join(DATA_DIR, INDEX_FILENAME)
+
+
+def get_connection():
+    """Get this thread's connection to the index, creating (and filling from the data directory) the index if needed"""
+    path = index_path()
+    connection = getattr(_local, 'connection', None)
+    if connection is not None and _local.path == path and os.path.exists(path):
+        return connection
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    is_new = not os.path.exists(path)
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS students (student TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS chats (student TEXT, chat_id INTEGER, PRIMARY KEY (student, chat_id));
+        CREATE TABLE IF NOT EXISTS note_files (student TEXT, topic TEXT, PRIMARY KEY (student, topic));
+    ''')
+    _local.connection = connection
+    _local.path = path
+    if is_new:
+        rebuild_index()
+    return connection
+
+
+def rebuild_index():
+    """Fill the index from the file names in the data directory (for data written before the index existed)"""
+    connection = get_connection()
+    students, chats, note_files = set(), set(), set()
+    for file in os.listdir(DATA_DIR):
+        if '_chathistory_' in file:
+            student_name_safe, rest = file.rsplit('_chathistory_', 1)
+            chat_id, ext = os.path.splitext(rest)
+            if ext in ('.jsonl', '.pkl') and chat_id.isdigit():
+                chats.add((student_name_safe, int(chat_id)))
+            continue
+        for topic in NOTE_TOPICS:
+            if file.endswith(f'_{topic}.txt'):
+                student_name_safe = file[:-len(f'_{topic}.txt')]
+                note_files.add((student_name_safe, topic))
+                if topic == 'lesson_plan':
+                    students.add(student_name_safe)
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute('DELETE FROM students')
+        connection.execute('DELETE FROM chats')
+        connection.execute('DELETE FROM note_files')
+        connection.executemany('INSERT INTO students VALUES (?)', [(s,) for s in students])
+        connection.executemany('INSERT INTO chats VALUES (?, ?)', list(chats))
+        connection.executemany('INSERT INTO note_files VALUES (?, ?)', list(note_files))
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    print(colored(f'Rebuilt student index: {len(students)} students, {len(chats)} chats', 'green'))
+
+
+def add_student(student_name_safe):
+    get_connection().execute('INSERT OR IGNORE INTO students VALUES (?)', (student_name_safe,))
+
+
+def student_exists(student_name_safe):
+    return get_connection().execute('SELECT 1 FROM students WHERE student = ?', (student_name_safe,)).fetchone() is not None
+
+
+def list_students():
+    return [row[0] for row in get_connection().execute('SELECT student FROM students ORDER BY student')]
+
+
+def add_chat(student_name_safe, chat_id):
+    get_connection().execute('INSERT OR IGNORE INTO chats VALUES (?, ?)', (student_name_safe, int(chat_id)))
+
+
+def list_chat_ids(student_name_safe):
+    """Sorted chat IDs (as ints) for a student"""
+    return [row[0] for row in get_connection().execute(
+        'SELECT chat_id FROM chats WHERE student = ? ORDER BY chat_id', (student_name_safe,))]
+
+
+def add_note_file(student_name_safe, topic):
+    get_connection().execute('INSERT OR IGNORE INTO note_files VALUES (?, ?)', (student_name_safe, topic))
+
+
+def list_note_topics(student_name_safe):
+    return [row[0] for row in get_connection().execute(
+        'SELECT topic FROM note_files WHERE student = ? ORDER BY topic', (student_name_safe,))]
+
+
+def remove_student(student_name_safe):
+    """Remove a student and everything indexed for them in one transaction. Returns (chat_ids, note_topics) that were indexed"""
+    connection = get_connection()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        chat_ids = list_chat_ids(student_name_safe)
+        topics = list_note_topics(student_name_safe)
+        connection.execute('DELETE FROM students WHERE student = ?', (student_name_safe,))
+        connection.execute('DELETE FROM chats WHERE student = ?', (student_name_safe,))
+        connection.execute('DELETE FROM note_files WHERE student = ?', (student_name_safe,))
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    return chat_ids, topics
+
+
+if __name__ == '__main__':
+    # Usage: python student_index.py rebuild
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebuild':
+        print('Usage: python student_index.py rebuild')
+        sys.exit(1)
+    rebuild_index()
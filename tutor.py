@@ -1,131 +1,147 @@
-from flask import Flask, render_template, request, redirect, url_for, session
+from flask import Flask, Blueprint, render_template, request, redirect, url_for, session, Response, g, jsonify, make_response
 import os
-from utils import get_notes, edit_notes, call_llm_with_tools, get_timestamp, count_tokens, format_html_w_tailwind
+import gzip
+import hashlib
+import secrets
+import shutil
+from contextlib import nullcontext
+from utils import TOOLS, make_system_prompt, notes_draft, apply_notes_draft, get_notes, edit_notes, call_llm_with_tools, get_timestamp, count_tokens, get_token_estimator, compact_messages, ToStudentFilter, get_client
 from termcolor import colored
-import anthropic
-from bs4 import BeautifulSoup
-from dotenv import load_dotenv
 import pickle
-import nh3
-from copy import deepcopy
-import hashlib
-
-load_dotenv()
+from render import extract_chat_messages, render_tutor_html
+import json
+import queue
+import threading
+import time
+from notes_store import DATA_DIR, write_notes, notes_hash, notes_path, forget_student, get_notes_key
+from chat_store import save_chat_history, load_chat_history, load_chat_history_since, list_chat_ids, allocate_chat_id, save_prefetched_opening, take_prefetched_opening, prefetched_opening_path, save_pending_finalization, pending_finalization_notes, take_pending_finalization, discard_pending_finalization, pending_finalization_path, chat_history_path, chat_log_path, legacy_pickle_path, get_content_block_adapter
+import student_index
+import history_search
+import single_flight
+from single_flight import TURN_WAIT_SECONDS, turn_lock, new_chat_lock, find_request, record_request, new_request_key
+from student_index import NOTE_TOPICS
+import jobs
+import profiling
+from file_lock import student_lock, remove_student_locks
+from session_store import SqliteSessionInterface
+from metrics import span, render_prometheus, Histogram
 
 VERBOSE_OUTPUT = True
 MAX_INPUT_TOKENS = 80000
-
-app = Flask(__name__)
-app.secret_key = os.getenv('FLASK_SECRET_KEY', 'insecure-key')
+COMPACTION_TRIGGER_TOKENS = 50000  # Older messages are summarized once a request would be bigger than this
+COMPACTION_KEEP_TOKENS = 15000  # About this many tokens of the most recent messages are kept verbatim when compacting
+FINALIZE_WAIT_SECONDS = 120  # How long a new session waits for the previous session's note finalization
+FINALIZE_MARKER_MAX_AGE_SECONDS = 600  # Finalization markers older than this were left by a worker that died
+FINALIZE_POLL_SECONDS = 0.1  # How often a new session checks whether finalization markers are gone
+REMOTE_TOKEN_COUNT_THRESHOLD = 0.9  # Only ask the API for an exact token count once the local estimate passes this fraction of MAX_INPUT_TOKENS
+PRIOR_CHATS_PAGE_SIZE = 10  # Number of prior chat sessions loaded at a time in the Prior Chats tab
+PREFETCH_MAX_AGE_SECONDS = 6 * 3600  # Prefetched openings older than this aren't used (their timestamp would be stale)
+RENDER_CACHE_VERSION = 2  # Bump when extract_chat_messages output changes, to invalidate rendered transcripts
+COMPRESS_MIN_BYTES = 1024  # Smaller responses are sent uncompressed
+COMPRESS_MIMETYPES = ('text/html', 'application/json', 'text/plain')
+PRELOAD_LLM_CLIENT = True  # Import the Anthropic SDK in a background thread when the app is created (see warm_up)
+# Requests without a trace (see profiling.py). A deleted student's trace would outlive them
+UNTRACED_ENDPOINTS = ('static', 'tutor.metrics', 'tutor.slow_turns', 'tutor.saved_trace', 'tutor.delete_student')
+SLOWEST_TURNS_PER_STUDENT = 10  # Number of saved requests listed for each student at /admin/slow_turns
+
+routes = Blueprint('tutor', __name__)
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY',"no_key_supplied")
 
-note_topics = ['student_info', 'lesson_plan', 'past_problems']
+note_topics = NOTE_TOPICS
+
+FINALIZE_PROMPT = 'The session has ended because the student or tutor wants to do a new question. Please make any last updates to your notes. This would be a good time to update the lesson plan with your plans for the next question so you are ready for the next session. You do not need to call finish_question.'
+# The speculative opening made by prefetch_opening must not change the notes, since it may never be shown
+PREFETCH_TOOLS = [tool for tool in TOOLS if tool['name'] in ('get_notes', 'search_history', 'calculator')]
+
+HTTP_REQUEST_SECONDS = Histogram('seneca_http_request_duration_seconds', 'Time to respond to each route (for streamed responses, until the stream starts)')
+
+
+@routes.before_app_request
+def start_request_timer():
+    g.request_start_time = time.perf_counter()
+
+
+@routes.after_app_request
+def record_request_time(response):
+    if 'request_start_time' in g:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_start_time,
+                                     endpoint=request.endpoint or 'unknown', method=request.method, status=response.status_code)
+    return response
+
+
+@routes.before_app_request
+def start_request_trace():
+    """Record the request's span timeline, and profile it if asked to (see profiling.py)"""
+    if request.endpoint is None or request.endpoint in UNTRACED_ENDPOINTS:
+        return
+    profiled, forced = profiling.should_profile(request)
+    g.trace = profiling.start_trace(request.endpoint, request.method, profiled, forced)
+
+
+@routes.after_app_request
+def add_trace_header(response):
+    """Tell a client that asked for a profile where to find it"""
+    if 'trace' in g and g.trace.forced:
+        response.headers['X-Seneca-Profile-Id'] = g.trace.id
+    return response
+
+
+@routes.teardown_app_request
+def end_request_trace(error=None):
+    if 'trace' in g:
+        g.trace.student_name_safe = session.get('student_name_safe')
+        g.trace.chat_id = session.get('chat_id')
+        profiling.end_trace()
+
+
+@routes.after_app_request
+def compress_response(response):
+    """gzip HTML and JSON responses for clients that accept it. Streamed responses (chat_stream) are left alone"""
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or response.mimetype not in COMPRESS_MIMETYPES or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.accept_encodings):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
 
 def get_student_list():
-    """Get list of students from data directory"""
-    if not os.path.exists('data'):
-        return []
-    
-    # Get unique student names from files in data directory
-    files = os.listdir('data')
-    students = set()
-    for file in files:
-        if file.endswith('_lesson_plan.txt'):
-            # Remove '_lesson_plan.txt' from the end to get the student name
-            student_name_safe = file[:-16]  # len('_lesson_plan.txt') == 16
-            students.add(student_name_safe)
-    return sorted(list(students))
-
-
-def sanitize_html(html_text):
-    tags = set(nh3.ALLOWED_TAGS) | {"svg", "line", "text", "rect", "path", "polygon", "polyline", "ellipse", "circle", "g", "defs", "use", "clipPath", "linearGradient", "stop", "image"}
-    attributes = deepcopy(nh3.ALLOWED_ATTRIBUTES)
-    attributes_to_add = {
-        'svg': ['width', 'height', 'viewBox', 'xmlns', 'fill', 'stroke'],
-        'path': ['d', 'fill', 'stroke', 'stroke-width'],
-        'circle': ['cx', 'cy', 'r', 'fill', 'stroke'],
-        'line': ['x1', 'y1', 'x2', 'y2', 'stroke', 'stroke-width', 'marker-end', 'marker-start'],
-        'text': ['x', 'y', 'font-size', 'fill', 'font-weight'],
-        'rect': ['x', 'y', 'width', 'height', 'fill', 'stroke', 'stroke-width'],
-        'marker': ['id', 'markerWidth', 'markerHeight', 'refX', 'refY', 'orient'],
-        'polygon': ['points', 'fill'],
-    }
-    for tag, attrs in attributes_to_add.items():
-        if tag not in attributes:
-            attributes[tag] = set()
-        for attr in attrs:
-            attributes[tag].add(attr)
+    """Get sorted list of students from the student index"""
+    return student_index.list_students()
 
-    return nh3.clean(html_text, tags=tags, attributes=attributes)
 
+def rendered_cache_path(student_name_safe, chat_id):
+    return f'data/{student_name_safe}_rendered_{chat_id}.json'
 
-def extract_chat_messages(messages):
-    """Extract student and tutor text from the messages list"""
-    chat_messages = []
-    for message in messages:
-        if isinstance(message.get('content'), str):
-            content = message['content']
-        else:
-            content = ""
-            for item in message.get('content', []):
-                if hasattr(item, 'text'):
-                    content += item.text + '\n\n'
-            
-        soup = BeautifulSoup(content, 'html.parser')
-        filtered_messages = None
-        if message['role'] == 'assistant': #HTML formatted text
-            student_messages = soup.find_all('to_student')
-            filtered_messages = [sanitize_html(format_html_w_tailwind(str(msg))) for msg in student_messages if str(msg) not in ['', '\n']]
-        elif message['role'] == 'user': #plain text
-            student_messages = soup.find_all('from_student')
-            filtered_messages = [str(msg).replace('\n', '<br>') for msg in student_messages if str(msg) not in ['', '\n']]
-            
-        if filtered_messages:
-            chat_messages.append({
-                'role': message['role'],
-                'content': '\n'.join(filtered_messages)
-            })
-    return chat_messages
-
-
-def save_chat_history(student_name_safe, chat_id, messages):
-    """Save chat history to a pickle file"""
-    filename = f'data/{student_name_safe}_chathistory_{chat_id}.pkl'
-    with open(filename, 'wb') as f:
-        pickle.dump(messages, f)
-
-
-def load_chat_history(student_name_safe, chat_id):
-    """Load chat history from a pickle file"""
-    filename = f'data/{student_name_safe}_chathistory_{chat_id}.pkl'
-    with open(filename, 'rb') as f:
-        return pickle.load(f)
-
-
-def make_system_prompt():
-    return """You are a private tutor for a student. You will give the student problems or challenges that can be answered fairly quickly, check their answers, and help them if they get stuck. Your goal is to help the student improve their skills and get excited about the topic, while maintaining detailed notes on their progress.
-When creating a new problem or challenge, the steps will be:
-1. Write out the problem. Use <problem></problem> tags.
-2. Write down the steps needed to solve the problem, and an acceptable answer. Use <solution></solution> tags. For arithmetic problems, when feasible, use the calculator tool to check the answer.
-3. Write a correctness check inside <correctness_check></correctness_check> tags. For this, you will verify that the problem is correctly posed, using the proposed solution and also your background knowledge (e.g., for the problem: "Give the perimeter of a rectangle with sides of 3,4,5,6 units", you will recognize that the problem is flawed because opposite sides of a rectangle cannot be different lengths). If there is an error in the problem, correct it.
-4. Give the problem to the student. Wrap any text that will be sent to the student in <to_student></to_student> tags. Format this text with HTML, and you can also include small SVG diagrams as needed.
-
-The student's responses will be wrapped in <from_student></from_student> tags. After the student responds, if they are correct, then congratulate them, make any relevant comments on the strategy they used to, and move on to the next problem. If they are wrong, then engage with them as a tutor would, to try to understand why they are getting it wrong. This could include asking them to tell you the steps they used to solve the problem, giving them small hints to try to nudge them in the right direction, or teaching them about needed concepts.
-If the student still cannot get to the right answer after several turns back and forth and you think it's time to move to the next problem, make a note in the skills note using tool calling, then move to the next problem and notify the student.
-
-During the conversation, you should be keeping all your notes up to date using tool calls. Here is a guide to the different notes:
-- student_info: The student's grade level or professional situation, what areas they want to focus on, learning style, strategies that have worked well or poorly with them. Also use this to store memories of your social connection with the student. For instance, if you or the student shared a personal detail that you think could be helpful when bonding in the future.
-- lesson_plan: Start with a summary of short and long-term goals. Then have a list of topics that you want to cover, with details. Details include the material to cover, where the student is at (no proficiency, progressing, mastery). Use timestamps to keep track of when the topic was started and most recently worked on.
-- past_problems: Use this to store problems that the student could not get right even after several tries, so that you can come back to them later once the student has progressed in their skills and is ready to try again.
-
-Some notes/reminders:
-- Very important: Only text within <to_student> blocks will be shown to the student; use HTML formatting for this text.
-- Make sure none of the notes get too long; you should keep each one to 1-2 pages of text or less. If they get longer than that, use the edit_notes tool to trim them.
-- If the user requests a new problem, or the chat history gets long and the early messages are no longer relevant, or you want to start a new topic, call the finish_question tool to start a new session.
-- Adapt your style to the age of the student. For instance, for an 8 year old student, if they got the answer right, don't ask them to explain their steps.
-- Only ask the student to do things they can type (no drawing, etc.).
-- Make sure not to include the solution when you give the problem to the student.
-"""
+
+def get_rendered_chat(student_name_safe, chat_id):
+    """Get the student-visible messages of a closed chat session, using a cache of the rendered HTML"""
+    history_path = chat_history_path(student_name_safe, chat_id)
+    if history_path is None:
+        raise FileNotFoundError(f'No chat history for {student_name_safe} with chat ID {chat_id}')
+    stat = os.stat(history_path)
+    cache_key = [RENDER_CACHE_VERSION, os.path.basename(history_path), stat.st_mtime_ns, stat.st_size]
+
+    cache_filename = rendered_cache_path(student_name_safe, chat_id)
+    try:
+        with open(cache_filename, 'r') as f:
+            cached = json.load(f)
+        if cached['key'] == cache_key:
+            return cached['messages']
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    with span('extract_chat_messages', source='prior_chat'):
+        rendered_messages = extract_chat_messages(load_chat_history(student_name_safe, chat_id))
+    tmp_filename = f'{cache_filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump({'key': cache_key, 'messages': rendered_messages}, f)
+    os.replace(tmp_filename, cache_filename)
+    return rendered_messages
 
 
 def make_first_user_message(student_name_safe):
@@ -147,43 +163,182 @@ If your notes indicate the student has done prior work with you, the chat sessio
     return first_user_message
 
 
+def finalize_lock(student_name_safe):
+    """Held while a finished session's notes are finalized, so a new session started in any worker process can wait for it"""
+    return student_lock(student_name_safe, 'finalize')
+
+
+def finalize_marker_dir(student_name_safe):
+    return os.path.join(DATA_DIR, 'finalizing', student_name_safe)
+
+
+def submit_finalize(student_name_safe, chat_id, commit=True):
+    """Submit a finalize_chat job. A marker file is written first and removed when the job is done, so a new session
+    started in any worker process waits for the finalization even while the job is still queued"""
+    directory = finalize_marker_dir(student_name_safe)
+    os.makedirs(directory, exist_ok=True)
+    marker = os.path.join(directory, f'{os.getpid()}.{secrets.token_hex(4)}')
+    open(marker, 'w').close()
+
+    def remove_marker(future):
+        try:
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+
+    # Also called when the job is cancelled before it starts (see delete_student)
+    jobs.submit(student_name_safe, finalize_chat, student_name_safe, chat_id, commit).add_done_callback(remove_marker)
+
+
+def finalize_pending(student_name_safe):
+    """True if a finalize job submitted by any worker process is queued or running"""
+    directory = finalize_marker_dir(student_name_safe)
+    try:
+        markers = os.listdir(directory)
+    except FileNotFoundError:
+        return False
+    now = time.time()
+    for marker in markers:
+        try:
+            if now - os.path.getmtime(os.path.join(directory, marker)) < FINALIZE_MARKER_MAX_AGE_SECONDS:
+                return True
+        except FileNotFoundError:
+            pass
+    return False
+
+
+def make_opening_messages(student_name_safe):
+    """Messages for the start of a new session. Waits for the student's note finalization, queued or running in any
+    worker process, first, so the notes snapshot in the first user message is up to date"""
+    lock = finalize_lock(student_name_safe)
+    deadline = time.monotonic() + FINALIZE_WAIT_SECONDS
+    while finalize_pending(student_name_safe) and time.monotonic() < deadline:
+        time.sleep(FINALIZE_POLL_SECONDS)
+    if (not finalize_pending(student_name_safe) and jobs.wait_for_student(student_name_safe, timeout=max(0, deadline - time.monotonic()))
+            and lock.acquire(timeout=max(0, deadline - time.monotonic()))):
+        lock.release()
+    else:
+        print(colored(f'Note finalization for {student_name_safe} is still running; starting the new session with the current notes', 'red'))
+    prefetched = take_prefetched_opening(student_name_safe, get_notes_key(student_name_safe), PREFETCH_MAX_AGE_SECONDS)
+    if prefetched:
+        return prefetched
+    return [{"role": "user", "content": make_first_user_message(student_name_safe)}]
+
+
+def is_student_message(message):
+    return message['role'] == 'user' and isinstance(message['content'], str) and '<from_student>' in message['content']
+
+
+def is_finalized(messages):
+    """True if the session's notes were finalized and the student hasn't sent a message since"""
+    for message in reversed(messages):
+        if message['role'] == 'user' and message['content'] == FINALIZE_PROMPT:
+            return True
+        if is_student_message(message):
+            return False
+    return False
+
+
+def prefetch_opening(student_name_safe):
+    """Generate the next session's opening turn ahead of time, from the finalized notes. Runs as a background job
+    after finalize_chat; make_opening_messages uses the result if the notes haven't changed since"""
+    lock = finalize_lock(student_name_safe)
+    if not lock.acquire(timeout=FINALIZE_WAIT_SECONDS):
+        return
+    lock.release()
+
+    # Start from the notes as they will be once the finalization made ahead of time is committed (see finalize_chat)
+    draft_notes = pending_finalization_notes(student_name_safe) or {}
+    notes_key = get_notes_key(student_name_safe, draft_notes)
+    with notes_draft(student_name_safe, draft_notes), span('prefetch_opening'):
+        messages = [{"role": "user", "content": make_first_user_message(student_name_safe)}]
+        messages = call_llm_with_tools(student_name_safe, make_system_prompt(), messages, PREFETCH_TOOLS,
+                                       verbose_output=VERBOSE_OUTPUT, route='opening')
+    # An error response (plain string content) isn't worth keeping
+    if isinstance(messages[-1]['content'], list) and get_notes_key(student_name_safe, draft_notes) == notes_key:
+        save_prefetched_opening(student_name_safe, notes_key, messages)
+
+
+def finalize_chat(student_name_safe, chat_id, commit=True):
+    """Let the LLM make its last updates to the notes for a finished session. Runs as a background job, and does
+    nothing if the session is already finalized.
+    The job started when the LLM asks for a new question (commit=False) runs ahead of time on a copy of the chat and
+    a draft of the notes, and keeps both aside (see save_pending_finalization), since the student may carry on with
+    the session instead. When the student starts the new question (commit=True), the draft notes are saved and the
+    turns added to the chat log if the student hasn't sent a message since; otherwise the session is finalized now"""
+    with finalize_lock(student_name_safe), turn_lock(student_name_safe, chat_id):
+        try:
+            messages = load_chat_history(student_name_safe, chat_id)
+        except FileNotFoundError:
+            return
+        if not messages or is_finalized(messages):
+            return
+        if commit:
+            pending = take_pending_finalization(student_name_safe, chat_id, len(messages))
+            if pending is not None:
+                if apply_notes_draft(student_name_safe, pending['notes'], pending['notes_hashes']):
+                    save_chat_history(student_name_safe, chat_id, messages + pending['messages'])
+                    return
+                print(colored(f'Notes of {student_name_safe} changed since they were finalized ahead of time; finalizing again', 'yellow'))
+
+        finalize_messages = messages + [{"role": "user", "content": FINALIZE_PROMPT}]
+        notes_hashes = {topic: notes_hash(student_name_safe, topic) for topic in NOTE_TOPICS}
+        retries = 3
+        for attempt in range(retries):
+            try:
+                # Ahead of time, the note edits go to a draft that is only saved when the finalization is committed
+                with nullcontext() if commit else notes_draft(student_name_safe) as draft_notes:
+                    finalize_messages = call_llm_with_tools(
+                        student_name_safe, 
+                        make_system_prompt(),
+                        finalize_messages, 
+                        TOOLS, 
+                        verbose_output=VERBOSE_OUTPUT,
+                        route='finalize'
+                    )
+                break
+            except Exception as e:
+                print(colored(f'Error calling LLM (attempt {attempt + 1}): {e}', 'red'))
+                if attempt == retries - 1:  # If it's the last attempt
+                    if not commit:
+                        return  # Finalized again when the student starts the new question
+                    finalize_messages.append({"role": "assistant", "content": f"Error calling LLM: {e}. <to_student>I had a problem and couldn't respond. Please type a new message.</to_student>"})
+
+        # Save chat history to file
+        if commit:
+            save_chat_history(student_name_safe, chat_id, finalize_messages)
+        else:
+            save_pending_finalization(student_name_safe, chat_id, len(messages), finalize_messages[len(messages):], draft_notes, notes_hashes)
+
+
+def prepare_next_session(student_name_safe, chat_id):
+    """Finalize the notes now and prefetch the next session's opening, so starting the new question is quick"""
+    submit_finalize(student_name_safe, chat_id, commit=False)
+    jobs.submit(student_name_safe, prefetch_opening, student_name_safe)
+
+
 def get_lesson_plan_hash(student_name_safe):
-    """Calculate hash of lesson plan content"""
-    lesson_plan = get_notes(student_name_safe, 'lesson_plan')
-    return hashlib.md5(lesson_plan.encode()).hexdigest()
+    """Get hash of lesson plan content (kept alongside the cached notes, so it isn't recomputed on every request)"""
+    return notes_hash(student_name_safe, 'lesson_plan')
 
 
 def get_latest_chat_id(student_name_safe):
     """Get the most recent chat ID for a student (the one with the highest number)"""
-    if not os.path.exists('data'):
-        return '000001'
-    
-    files = [f for f in os.listdir('data') if f.startswith(f'{student_name_safe}_chathistory_')]
-    if not files:
-        return '000001'
-        
-    chat_ids = []
-    for file in files:
-        try:
-            chat_id = file.split('_chathistory_')[1].split('.pkl')[0]
-            chat_ids.append(int(chat_id))
-        except (IndexError, ValueError):
-            continue
-    
+    chat_ids = list_chat_ids(student_name_safe)
     if not chat_ids:
         return '000001'
         
     return f'{max(chat_ids):06d}'  # Format as 6-digit string with leading zeros
 
 
-@app.route('/')
+@routes.route('/')
 def index():
     students = get_student_list()
     return render_template('index.html', 
                          students=students)
 
 
-@app.route('/new_student', methods=['GET', 'POST'])
+@routes.route('/new_student', methods=['GET', 'POST'])
 def new_student():
     if request.method == 'POST':
         student_name = request.form['student_name']
@@ -196,8 +351,7 @@ def new_student():
             return render_template('new_student.html', error="Student identifier cannot be empty and must contain at least one valid character (letters, numbers, hyphens, or underscores).")
         
         # Check if student already exists
-        existing_students = get_student_list()
-        if student_name_safe in existing_students:
+        if student_index.student_exists(student_name_safe):
             return render_template('new_student.html', error=f'A student with identifier {student_name_safe} already exists. Please choose a different identifier.')
         
         if not os.path.exists('data'):
@@ -211,17 +365,17 @@ def new_student():
         }
         
         for topic, content in note_defaults.items():
-            with open(f'data/{student_name_safe}_{topic}.txt', 'w') as f:
-                f.write(content)
+            write_notes(student_name_safe, topic, content)
+        student_index.add_student(student_name_safe)
         
         session['student_name_safe'] = student_name_safe
-        session['chat_id'] = '000001'  # First chat session for new student
-        return redirect(url_for('chat'))
+        session['chat_id'] = allocate_chat_id(student_name_safe)  # First chat session for new student
+        return redirect(url_for('.chat'))
         
     return render_template('new_student.html')
 
 
-@app.route('/select_student/<student_name_safe>')
+@routes.route('/select_student/<student_name_safe>')
 def select_student(student_name_safe):
     session['student_name_safe'] = student_name_safe
     session['chat_id'] = get_latest_chat_id(student_name_safe)
@@ -230,79 +384,113 @@ def select_student(student_name_safe):
     current_hash = get_lesson_plan_hash(student_name_safe)
     session['lesson_plan_hash'] = current_hash
 
-    return redirect(url_for('chat'))
+    return redirect(url_for('.chat'))
+
+
+def get_input_token_count(student_name_safe, chat_id, messages, tools):
+    """Estimate the input tokens locally, and only call the token counting API when close to MAX_INPUT_TOKENS"""
+    token_estimator = get_token_estimator(student_name_safe, chat_id)
+    input_token_count = token_estimator.estimate(messages, make_system_prompt(), tools)
+    if input_token_count >= MAX_INPUT_TOKENS * REMOTE_TOKEN_COUNT_THRESHOLD:
+        try:
+            input_token_count = count_tokens(messages, tools, make_system_prompt())
+            token_estimator.set_exact_count(input_token_count, len(messages))
+        except Exception as e:
+            print(colored(f'Error counting tokens: {e}', 'red'))
+    if VERBOSE_OUTPUT:
+        print(colored(f'Input token count: {input_token_count}', 'green'))
+    return input_token_count
+
+
+def get_compacted_token_count(student_name_safe, chat_id, messages, tools):
+    """Count input tokens, first compacting the history if it has grown past COMPACTION_TRIGGER_TOKENS"""
+    with span('count_tokens'):
+        input_token_count = get_input_token_count(student_name_safe, chat_id, messages, tools)
+    if input_token_count > COMPACTION_TRIGGER_TOKENS:
+        with span('compact_messages'):
+            if compact_messages(messages, COMPACTION_KEEP_TOKENS, get_token_estimator(student_name_safe, chat_id), make_system_prompt(), tools):
+                input_token_count = get_input_token_count(student_name_safe, chat_id, messages, tools)
+    return input_token_count
+
+
+def finish_llm_turn(student_name_safe, chat_id, messages, input_token_count):
+    """Save the chat history after an LLM call and report whether the LLM wants a new question"""
+    # Check if LLM called finish_question
+    llm_wants_new_question = False
+    for message in messages:
+        if isinstance(message.get('content'), list):
+            for content_item in message['content']:
+                if getattr(content_item, 'type', None) == 'tool_use':
+                    if content_item.name == 'finish_question':
+                        llm_wants_new_question = True
+                        break
+
+    # Check if max input tokens reached even after compaction
+    if input_token_count > MAX_INPUT_TOKENS:
+        print(colored('Conversation reached maximum length. Starting a new question.', 'red'))
+        llm_wants_new_question = True
+
+    if llm_wants_new_question:
+        print(colored(f'LLM wants to start a new question', 'yellow'))
+
+    # The chat has moved on, so finalization turns made ahead of time are out of date (see finalize_chat)
+    discard_pending_finalization(student_name_safe)
+
+    # Save chat history to file
+    save_chat_history(
+        student_name_safe,
+        chat_id,
+        messages
+    )
+
+    # finish_question stays in the history, so only prepare the next session when it was called in this turn
+    if input_token_count > MAX_INPUT_TOKENS or new_question_requested_this_turn(messages):
+        prepare_next_session(student_name_safe, chat_id)
+    return llm_wants_new_question
+
+
+def new_question_requested_this_turn(messages):
+    """True if the LLM called finish_question since the student's last message"""
+    for message in reversed(messages):
+        if is_student_message(message):
+            return False
+        if message['role'] == 'assistant' and isinstance(message['content'], list):
+            if any(getattr(block, 'type', None) == 'tool_use' and block.name == 'finish_question' for block in message['content']):
+                return True
+    return False
+
+
+def get_route(messages):
+    """Model route for a chat turn (see utils.MODEL_ROUTES): 'opening' if the session has only the notes preamble so far"""
+    return 'opening' if len(messages) == 1 else 'reply'
+
+
+def run_llm_turn(student_name_safe, chat_id, messages, tools, on_text=None):
+    """Call the LLM on the current messages, save the chat history, and report whether the LLM wants a new question"""
+    input_token_count = get_compacted_token_count(student_name_safe, chat_id, messages, tools)
+    try:
+        with span('call_llm_with_tools'):
+            messages = call_llm_with_tools(
+                student_name_safe, 
+                make_system_prompt(),
+                messages, 
+                tools, 
+                verbose_output=VERBOSE_OUTPUT,
+                on_text=on_text,
+                token_estimator=get_token_estimator(student_name_safe, chat_id),
+                route=get_route(messages)
+            )
+    except Exception as e:
+        print(colored(f'Error calling LLM: {e}', 'red'))
+        messages.append({"role": "assistant", "content": f"Error calling LLM: {e}. <to_student>I had a problem and couldn't respond. Please type a new message.</to_student>"})
+
+    return messages, finish_llm_turn(student_name_safe, chat_id, messages, input_token_count)
 
 
-@app.route('/chat', methods=['GET', 'POST'])
+@routes.route('/chat', methods=['GET', 'POST'])
+@profiling.traced
 def chat():
-    tools = [
-        {
-            "name": "get_notes",
-            "description": "Get the full text of notes for the specified topic",
-            "input_schema": {
-                "type": "object",
-                "properties": {
-                    "note_topic": {
-                        "type": "string",
-                        "enum": ["student_info", "lesson_plan", "past_problems"],
-                        "description": "The topic of notes to retrieve"
-                    }
-                },
-                "required": ["note_topic"]
-            }
-        },
-        {
-            "name": "edit_notes",
-            "description": "Edit the notes for the specified topic by replacing old text with new text, or deleting old text if new_excerpt is empty",
-            "input_schema": {
-                "type": "object",
-                "properties": {
-                    "note_topic": {
-                        "type": "string",
-                        "enum": ["student_info", "lesson_plan", "past_problems"],
-                        "description": "The topic of notes to edit"
-                    },
-                    "old_excerpt": {
-                        "type": "string",
-                        "description": "The text to replace (leave empty to overwrite the entire note instead)"
-                    },
-                    "new_excerpt": {
-                        "type": "string",
-                        "description": "The new text to insert (leave empty to delete the old_excerpt)"
-                    }
-                },
-                "required": ["note_topic"]
-            }
-        },
-        {
-            "name": "finish_question",
-            "description": "Use this when you want to finish the current question/topic and start a new one. This will start a new conversation with fresh messages, but you will be reminded of your notes at the beginning. You will have a chance to update your notes beforehand.",
-            "input_schema": {
-                "type": "object",
-                "properties": {
-                    "reason": {
-                        "type": "string",
-                        "description": "The reason for finishing this question/topic (e.g., 'Student requested new topic', 'Student has mastered this concept', 'Student is struggling too much')"
-                    }
-                },
-                "required": ["reason"]
-            }
-        },
-        {
-            "name": "calculator",
-            "description": "Computes the result of a given mathematical expression",
-            "input_schema": {
-                "type": "object",
-                "properties": {
-                    "expression": {
-                        "type": "string",
-                        "description": 'The expression, using Python syntax, such as "(3.5 + 4) * 5". For security reasons, the only allowed input characters are 0-9, ., +, -, *, /, space, and parentheses.'
-                    }
-                },
-                "required": ["expression"]
-            }
-        },
-    ]
+    tools = TOOLS
 
     session['llm_wants_new_question'] = False
 
@@ -312,106 +500,70 @@ def chat():
     else:
         print(colored(f'Chat session ID: {session["chat_id"]}', 'green'))
     
-    need_to_call_llm = False
     try:
         messages = load_chat_history(session['student_name_safe'], session['chat_id'])
     except FileNotFoundError:
         messages = []
 
-    if not messages:
-        print(colored(f'No chat history found for this student and chat ID. Creating first user message.', 'yellow'))
-        messages = [{"role": "user", "content": make_first_user_message(session['student_name_safe'])}]
-        need_to_call_llm = True
-
     if request.method == 'POST':
+        # Submitting a form twice (double click, or reloading the page after a POST) sends the same key
+        request_key = request.form.get('idempotency_key')
         if request.form.get('action') == 'new_chat':
-            # First let LLM finalize notes for current question
-            if messages:
-                messages.append({
-                    "role": "user", 
-                    "content": 'The session has ended because the student or tutor wants to do a new question. Please make any last updates to your notes. This would be a good time to update the lesson plan with your plans for the next question so you are ready for the next session. You do not need to call finish_question.'
-                })
-                retries = 3
-                for attempt in range(retries):
-                    try:
-                        messages = call_llm_with_tools(
-                            session['student_name_safe'], 
-                            make_system_prompt(),
-                            messages, 
-                            tools, 
-                            verbose_output=VERBOSE_OUTPUT
-                        )
-                        break
-                    except Exception as e:
-                        print(colored(f'Error calling LLM (attempt {attempt + 1}): {e}', 'red'))
-                        if attempt == retries - 1:  # If it's the last attempt
-                            messages.append({"role": "assistant", "content": f"Error calling LLM: {e}. <to_student>I had a problem and couldn't respond. Please type a new message.</to_student>"})
-
-                # Save chat history to file
-                save_chat_history(
-                    session['student_name_safe'],
-                    session['chat_id'],
-                    messages
-                )
-
-            # Start new chat session
-            session['chat_id'] = f'{int(get_latest_chat_id(session["student_name_safe"])) + 1:06d}'
+            student_name_safe = session['student_name_safe']
+            with new_chat_lock(student_name_safe):
+                earlier_chat_id = find_request(student_name_safe, 'new_chat', request_key)
+                if earlier_chat_id is not None:
+                    session['chat_id'] = f'{earlier_chat_id:06d}'
+                    return redirect(url_for('.chat'))
+
+                # The LLM finalizes the notes for the current question in the background; the new session's
+                # opening waits for it (see make_opening_messages). If they were finalized ahead of time and the
+                # student hasn't sent a message since, the job only adds those turns to the chat log
+                draft_notes = pending_finalization_notes(student_name_safe, session['chat_id'], len(messages))
+                finalized = (not jobs.pending_jobs(student_name_safe) and not finalize_pending(student_name_safe)
+                             and (is_finalized(messages) or draft_notes is not None))
+                if messages and not is_finalized(messages):
+                    submit_finalize(student_name_safe, session['chat_id'])
+
+                # Start new chat session. If the opening was prefetched from the finalized notes (see prefetch_opening)
+                # it is shown right away; otherwise the page streams in the tutor's opening message
+                session['chat_id'] = allocate_chat_id(student_name_safe)
+                record_request(student_name_safe, 'new_chat', request_key, int(session['chat_id']))
+            if finalized:
+                # The prefetched opening was made from the draft notes that the finalize job is about to save
+                opening = take_prefetched_opening(student_name_safe, get_notes_key(student_name_safe, draft_notes), PREFETCH_MAX_AGE_SECONDS)
+                if opening:
+                    save_chat_history(student_name_safe, session['chat_id'], opening)
             print(colored(f'New chat session started. Assigning ID: {session["chat_id"]}', 'green'))
-            messages = [{"role": "user", "content": make_first_user_message(session['student_name_safe'])}]
-            need_to_call_llm = True
+            return redirect(url_for('.chat'))
             
         user_input = request.form.get('user_input')
         if user_input:
-            wrapped_input = f"Timestamp: {get_timestamp()}\n<from_student>{user_input}</from_student>"
-            messages.append({"role": "user", "content": wrapped_input})
-            need_to_call_llm = True
-
-    if need_to_call_llm:
-        try:
-            input_token_count = count_tokens(messages, tools)
-            if VERBOSE_OUTPUT:
-                print(colored(f'Input token count: {input_token_count}', 'green'))
-        except Exception as e:
-            print(colored(f'Error counting tokens: {e}', 'red'))
-            input_token_count = 0
-
-        try:
-            messages = call_llm_with_tools(
-                session['student_name_safe'], 
-                make_system_prompt(),
-                messages, 
-                tools, 
-                verbose_output=VERBOSE_OUTPUT
-            )
-        except Exception as e:
-            print(colored(f'Error calling LLM: {e}', 'red'))
-            messages.append({"role": "assistant", "content": f"Error calling LLM: {e}. <to_student>I had a problem and couldn't respond. Please type a new message.</to_student>"})
-
-        # Check if LLM called finish_question
-        llm_wants_new_question = False
-        for message in messages:
-            if isinstance(message.get('content'), list):
-                for content_item in message['content']:
-                    if isinstance(content_item, anthropic.types.tool_use_block.ToolUseBlock):
-                        if content_item.name == 'finish_question':
-                            llm_wants_new_question = True
-                            break
-
-        # Check if max input tokens reached
-        if input_token_count > MAX_INPUT_TOKENS:
-            print(colored('Conversation reached maximum length. Starting a new question.', 'red'))
-            llm_wants_new_question = True
-
-        session['llm_wants_new_question'] = llm_wants_new_question
-        if llm_wants_new_question:
-            print(colored(f'LLM wants to start a new question', 'yellow'))
-
-        # Save chat history to file
-        save_chat_history(
-            session['student_name_safe'],
-            session['chat_id'],
-            messages
-        )
+            # One turn at a time per chat; a duplicate request waits for the first and then shows its result
+            lock = turn_lock(session['student_name_safe'], session['chat_id'])
+            if lock.acquire(timeout=TURN_WAIT_SECONDS):
+                try:
+                    try:
+                        messages = load_chat_history(session['student_name_safe'], session['chat_id'])
+                    except FileNotFoundError:
+                        messages = []
+                    if find_request(session['student_name_safe'], session['chat_id'], request_key) is None:
+                        if not messages:
+                            messages = make_opening_messages(session['student_name_safe'])
+                        record_request(session['student_name_safe'], session['chat_id'], request_key, len(messages))
+                        wrapped_input = f"Timestamp: {get_timestamp()}\n<from_student>{user_input}</from_student>"
+                        messages.append({"role": "user", "content": wrapped_input})
+                        messages, llm_wants_new_question = run_llm_turn(
+                            session['student_name_safe'],
+                            session['chat_id'],
+                            messages,
+                            tools
+                        )
+                        session['llm_wants_new_question'] = llm_wants_new_question
+                finally:
+                    lock.release()
+            else:
+                print(colored(f'Timed out waiting for another turn on chat {session["chat_id"]}', 'red'))
     
     # Check if lesson plan has changed so we can show an indicator in chat.html
     current_hash = get_lesson_plan_hash(session['student_name_safe'])
@@ -424,60 +576,290 @@ def chat():
         session['lesson_plan_hash'] = current_hash
 
     #extract only the text that should be visible to the student for displaying in chat.html
-    chat_messages = extract_chat_messages(messages)
+    with span('extract_chat_messages'):
+        chat_messages = extract_chat_messages(messages)
+
+    # Prior chats are loaded separately by the Prior Chats tab (see prior_chats)
+    with span('render_template', template='chat.html'):
+        return render_template('chat.html', 
+                             chat_messages=chat_messages,
+                             start_session=not messages,
+                             student_name_safe=session.get('student_name_safe'),
+                             llm_wants_new_question=session.get('llm_wants_new_question', False),
+                             lesson_plan=get_notes(session['student_name_safe'], 'lesson_plan'),
+                             lesson_plan_is_new=lesson_plan_is_new,
+                             lesson_plan_hash=current_hash,
+                             chat_id=session['chat_id'],
+                             cursor=len(messages),
+                             idempotency_key=new_request_key())
+
+
+@routes.route('/prior_chats')
+def prior_chats():
+    """Render a page of prior chat sessions, most recent last, for the Prior Chats tab"""
+    student_name_safe = session['student_name_safe']
+    before = request.args.get('before', type=int, default=int(session['chat_id']))
+    chat_ids = [chat_id for chat_id in list_chat_ids(student_name_safe) if chat_id < before]
+    page_chat_ids = chat_ids[-PRIOR_CHATS_PAGE_SIZE:]
+    older_before = page_chat_ids[0] if len(chat_ids) > len(page_chat_ids) else None
+
+    # Closed chats rarely change, so the browser can revalidate its copy instead of downloading the page again
+    etag = prior_chats_etag(student_name_safe, page_chat_ids, older_before)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
 
-    # Get prior chat messages for displaying in chat.html
     prior_chat_messages = []
-    if os.path.exists('data'):
-        current_chat_id = int(session['chat_id'])
-        files = [f for f in os.listdir('data') 
-                if f.startswith(f"{session['student_name_safe']}_chathistory_") 
-                and f.endswith('.pkl')]
-        
-        # Extract chat IDs and sort them
-        chat_histories = []
-        for file in files:
-            try:
-                chat_id = int(file.split('_chathistory_')[1].split('.pkl')[0])
-                if chat_id < current_chat_id:
-                    chat_histories.append((chat_id, file))
-            except (IndexError, ValueError):
-                continue
-        
-        chat_histories.sort()
-        
-        # Load and process each chat history
-        for _, filename in chat_histories:
-            try:
-                prior_messages = load_chat_history(session['student_name_safe'], 
-                                                 filename.split('_chathistory_')[1].split('.pkl')[0])
-                prior_chat_messages.extend(extract_chat_messages(prior_messages))
-            except (FileNotFoundError, pickle.UnpicklingError) as e:
-                print(colored(f'Error loading prior chat history {filename}: {e}', 'red'))
-                continue
-
-    return render_template('chat.html', 
-                         chat_messages=chat_messages,
-                         student_name_safe=session.get('student_name_safe'),
-                         llm_wants_new_question=session.get('llm_wants_new_question', False),
-                         lesson_plan=get_notes(session['student_name_safe'], 'lesson_plan'),
-                         lesson_plan_is_new=lesson_plan_is_new,
-                         prior_chat_messages=prior_chat_messages)
-
-
-@app.route('/delete_student/<student_name>')
+    for chat_id in page_chat_ids:
+        try:
+            prior_chat_messages.extend(get_rendered_chat(student_name_safe, f'{chat_id:06d}'))
+        except (FileNotFoundError, pickle.UnpicklingError, ValueError) as e:
+            print(colored(f'Error loading prior chat history {chat_id:06d}: {e}', 'red'))
+            continue
+
+    response = make_response(render_template('prior_chats.html',
+                                             prior_chat_messages=prior_chat_messages,
+                                             older_before=older_before))
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def prior_chats_etag(student_name_safe, page_chat_ids, older_before):
+    """ETag for a page of prior chats, from the size and modification time of each chat's history file"""
+    parts = [RENDER_CACHE_VERSION, older_before]
+    for chat_id in page_chat_ids:
+        history_path = chat_history_path(student_name_safe, f'{chat_id:06d}')
+        if history_path is None:
+            parts.append([chat_id])
+            continue
+        stat = os.stat(history_path)
+        parts.append([chat_id, os.path.basename(history_path), stat.st_mtime_ns, stat.st_size])
+    return hashlib.md5(json.dumps(parts).encode()).hexdigest()
+
+
+@routes.route('/chat_updates')
+def chat_updates():
+    """The chat messages added since a cursor (the number of chat history messages the page was made from), as
+    rendered HTML in JSON, so the chat page can update in place after a turn instead of reloading"""
+    student_name_safe = session['student_name_safe']
+    if request.args.get('chat_id') != session.get('chat_id'):
+        # A new chat was started (e.g. in another tab), so the page is out of date
+        return jsonify(reload=True)
+    # Only the messages after the cursor are parsed (see load_chat_history_since)
+    after = max(request.args.get('after', type=int, default=0), 0)
+    try:
+        messages, total = load_chat_history_since(student_name_safe, session['chat_id'], after)
+    except FileNotFoundError:
+        messages, total = [], 0
+
+    data = {
+        'html': render_template('chat_messages.html', chat_messages=extract_chat_messages(messages)),
+        'cursor': total,
+        'idempotency_key': new_request_key(),
+    }
+    current_hash = get_lesson_plan_hash(student_name_safe)
+    if request.args.get('lesson_plan_hash') != (current_hash or ''):
+        session['lesson_plan_hash'] = current_hash
+        data['lesson_plan'] = get_notes(student_name_safe, 'lesson_plan')
+        data['lesson_plan_hash'] = current_hash
+    response = jsonify(data)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@routes.route('/chat_stream', methods=['POST'])
+@profiling.traced
+def chat_stream():
+    """Run a chat turn and stream the tutor's <to_student> text to the browser as server-sent events"""
+    student_name_safe = session['student_name_safe']
+    if 'chat_id' not in session:
+        session['chat_id'] = get_latest_chat_id(student_name_safe)
+    chat_id = session['chat_id']
+    session['llm_wants_new_question'] = False
+
+    user_input = request.form.get('user_input')
+    request_key = request.form.get('idempotency_key')
+
+    # The LLM call runs in its own thread so the turn finishes and gets saved even if the browser disconnects
+    events = queue.Queue()
+    tools = TOOLS
+
+    def send_saved_messages(messages):
+        """Send tutor messages that were already saved (a prefetched opening, or the reply to an earlier request)"""
+        for chat_message in extract_chat_messages(messages):
+            if chat_message['role'] == 'assistant':
+                events.put(('start', {}))
+                events.put(('fragment', {'html': chat_message['content']}))
+                events.put(('end', {}))
+
+    def run_locked_turn():
+        """Run the turn while holding the chat's turn lock. Returns whether the LLM wants a new question"""
+        try:
+            messages = load_chat_history(student_name_safe, chat_id)
+        except FileNotFoundError:
+            messages = []
+        earlier_start = find_request(student_name_safe, chat_id, request_key)
+        if earlier_start is not None:
+            # Duplicate request (e.g. a double submit): show the reply the first request got
+            send_saved_messages(messages[earlier_start + 1 if user_input else earlier_start:])
+            return False
+        if messages and not user_input:
+            # Another request opened the session while this one waited
+            send_saved_messages(messages)
+            return False
+        record_request(student_name_safe, chat_id, request_key, len(messages))
+
+        if not messages:
+            # A new session's opening is created here, since it may have to wait for note finalization
+            print(colored(f'No chat history found for this student and chat ID. Creating first user message.', 'yellow'))
+            messages = make_opening_messages(student_name_safe)
+            if messages[-1]['role'] == 'assistant' and not user_input:
+                # Prefetched opening (see prefetch_opening); there is nothing to send to the LLM
+                save_chat_history(student_name_safe, chat_id, messages)
+                send_saved_messages(messages)
+                return False
+        if user_input:
+            wrapped_input = f"Timestamp: {get_timestamp()}\n<from_student>{user_input}</from_student>"
+            messages.append({"role": "user", "content": wrapped_input})
+
+        to_student_filter = ToStudentFilter()
+        block_text = ''
+
+        def on_text(text):
+            nonlocal block_text
+            for event, fragment in to_student_filter.feed(text):
+                if event == 'start':
+                    block_text = ''
+                    events.put(('start', {}))
+                elif event == 'text':
+                    block_text += fragment
+                    events.put(('fragment', {'html': render_tutor_html(block_text)}))
+                else:
+                    events.put(('end', {}))
+
+        _, llm_wants_new_question = run_llm_turn(student_name_safe, chat_id, messages, tools, on_text=on_text)
+        return llm_wants_new_question
+
+    def run_turn():
+        # Only one turn runs per chat at a time, across worker processes
+        llm_wants_new_question = False
+        lock = turn_lock(student_name_safe, chat_id)
+        if not lock.acquire(timeout=TURN_WAIT_SECONDS):
+            print(colored(f'Timed out waiting for another turn on chat {chat_id}', 'red'))
+            events.put(('done', {'llm_wants_new_question': False}))
+            return
+        try:
+            llm_wants_new_question = run_locked_turn()
+        except Exception as e:
+            print(colored(f'Error in streamed chat turn: {e}', 'red'))
+        finally:
+            lock.release()
+            events.put(('done', {'llm_wants_new_question': llm_wants_new_question}))
+
+    # The turn is part of this request's trace, so a slow turn is saved with its whole timeline
+    profiling.run_in_thread(run_turn)
+
+    def generate():
+        while True:
+            event, data = events.get()
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            if event == 'done':
+                break
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@routes.route('/metrics')
+def metrics():
+    """Prometheus-style metrics for the LLM/tool loop and the request path"""
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@routes.route('/admin/slow_turns')
+def slow_turns():
+    """The slowest recent requests of each student, with their saved span timelines and profiles (see profiling.py)"""
+    return render_template('slow_turns.html',
+                           slowest=profiling.slowest_requests(SLOWEST_TURNS_PER_STUDENT),
+                           slow_request_seconds=profiling.SLOW_REQUEST_SECONDS,
+                           sample_rate=profiling.PROFILE_SAMPLE_RATE)
+
+
+@routes.route('/admin/traces/<trace_id>')
+def saved_trace(trace_id):
+    """A saved span timeline (JSON), or with ?format=folded its profile in the collapsed stack format"""
+    folded = request.args.get('format') == 'folded'
+    try:
+        text = profiling.read_trace(trace_id, 'folded' if folded else 'json')
+    except FileNotFoundError:
+        return Response('No such trace', status=404, mimetype='text/plain')
+    return Response(text, mimetype='text/plain' if folded else 'application/json')
+
+
+@routes.route('/delete_student/<student_name>')
 def delete_student(student_name):
-    student_name_safe = ''.join(c for c in student_name if c.isalnum() or c in '-_').lower()
+    student_name_safe = ''.join(c for c in student_name if c.isalnum() or c in '-_')
     
-    # Delete all files associated with the student
-    if os.path.exists('data'):
-        files = os.listdir('data')
-        for file in files:
-            if file.startswith(student_name_safe):
-                os.remove(os.path.join('data', file))
+    # Drop the student's queued background jobs and wait for the running one, so that no finalization, prefetch or
+    # search indexing writes files or index rows for the student after the delete
+    jobs.cancel_pending(student_name_safe)
+    if not jobs.wait_for_student(student_name_safe, timeout=FINALIZE_WAIT_SECONDS):
+        print(colored(f'A background job for {student_name_safe} is still running; deleting the student anyway', 'red'))
+
+    shutil.rmtree(finalize_marker_dir(student_name_safe), ignore_errors=True)
+
+    # Remove the student from the index first (one transaction), then delete exactly the files that belong to them
+    chat_ids, topics = student_index.remove_student(student_name_safe)
+    paths = [notes_path(student_name_safe, topic) for topic in topics]
+    paths += [prefetched_opening_path(student_name_safe), pending_finalization_path(student_name_safe)]
+    for chat_id in chat_ids:
+        chat_id = f'{chat_id:06d}'
+        paths += [chat_log_path(student_name_safe, chat_id), legacy_pickle_path(student_name_safe, chat_id),
+                  rendered_cache_path(student_name_safe, chat_id)]
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    forget_student(student_name_safe)
+    history_search.remove_student(student_name_safe)
+    single_flight.remove_student(student_name_safe)
+    profiling.remove_student(student_name_safe)
+    remove_student_locks(student_name_safe)
     
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
+
+
+def create_app():
+    """Create the Flask app. Under gunicorn (see wsgi.py) each worker process creates its own; sessions, notes
+    and chat logs are shared between them through the data directory"""
+    app = Flask(__name__)
+    app.secret_key = os.getenv('FLASK_SECRET_KEY', 'insecure-key')
+    app.session_interface = SqliteSessionInterface()
+    app.register_blueprint(routes)
+    warm_up(app)
+    return app
+
+
+def warm_up(app):
+    """Compile the templates now, and load the Anthropic SDK in the background, so the first requests don't wait
+    for them. Importing the SDK is most of the startup time, and pages that don't call the LLM never need it"""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    if PRELOAD_LLM_CLIENT:
+        threading.Thread(target=preload_llm_client, daemon=True).start()
+
+
+def preload_llm_client():
+    try:
+        with span('preload_llm_client'):
+            get_client()
+            get_content_block_adapter()
+    except Exception as e:
+        print(colored(f'Error preloading the Anthropic client: {e}', 'red'))
 
 
 if __name__ == '__main__':
-    app.run(port=8001, debug=False)
+    create_app().run(port=8001, debug=False)
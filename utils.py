@@ -1,74 +1,761 @@
+import contextvars
 import json
 import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from termcolor import colored
 from datetime import datetime
-import re
 from dotenv import load_dotenv
-from anthropic import AuthenticationError
 
-load_dotenv()
+load_dotenv()  # Before importing modules that read settings from the environment (e.g. admission)
 
-import anthropic
-anthropic_client = anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY',"no_key_supplied"), timeout=30)
+from notes_store import read_notes, write_notes, notes_lock, notes_hash
+from safe_math import evaluate, format_result
+import history_search
+from admission import llm_calls, retry_after_seconds
+from notes_sections import apply_edit, describe_change, get_section, list_sections
+from metrics import LLM_REQUEST_SECONDS, LLM_REQUESTS, LLM_TOKENS, LLM_COST, LLM_RETRIES, TOOL_SECONDS, TOOL_ERRORS, span
+
+# Created on first use by get_client, since importing anthropic takes most of the app's startup time
+anthropic_client = None
+_client_lock = threading.Lock()
+
+# (student_name_safe, {note_topic: text}) while the note tools work on a draft of the notes (see notes_draft)
+_notes_draft = contextvars.ContextVar('notes_draft', default=None)
 
 MODEL_NAME = 'claude-3-5-sonnet-latest'
+FAST_MODEL_NAME = 'claude-3-5-haiku-latest'  # Used for housekeeping calls the student doesn't see
+RETRY_BASE_DELAY_SECONDS = 1
+RETRY_MAX_DELAY_SECONDS = 20
+
+CHARS_PER_TOKEN = 3.5  # Conservative characters-per-token ratio for local token estimates
+COMPACTION_TOOL_RESULT_CHARS = 500  # Tool results are truncated to this length in the summarization prompt
+TOKEN_ESTIMATOR_CACHE_SIZE = 256  # Number of chat sessions to keep token estimators for
+USAGE_LOG_FILE = 'logs/llm_usage.jsonl'  # Token usage (including prompt cache hits/misses) and latency of each LLM call
+MAX_CALCULATOR_EXPRESSIONS = 20  # Most expressions in one calculator tool call
+MAX_SEARCH_RESULTS = 10  # Most results from one search_history tool call
+
+# Model and output token cap for each kind of LLM call. Each can be overridden with environment variables,
+# e.g. SENECA_MODEL_FINALIZE=claude-3-5-sonnet-latest or SENECA_MAX_TOKENS_REPLY=4096
+MODEL_ROUTES = {
+    'opening': {'model': MODEL_NAME, 'max_tokens': 8192},  # First problem of a session
+    'reply': {'model': MODEL_NAME, 'max_tokens': 8192},  # Response to a student message
+    # Calls after tool results in an opening or reply. These usually write the message to the student, and a
+    # different model would miss the prompt cache written by the first call, so this defaults to the main model
+    'tool_continuation': {'model': MODEL_NAME, 'max_tokens': 8192},
+    'finalize': {'model': FAST_MODEL_NAME, 'max_tokens': 4096},  # Last notes updates for a finished session
+    'summary': {'model': FAST_MODEL_NAME, 'max_tokens': 1024},  # Summaries of compacted chat history
+    'maintenance': {'model': MODEL_NAME, 'max_tokens': 8192},  # Offline trimming and re-planning of notes (notes_maintenance.py)
+}
+for _route, _config in MODEL_ROUTES.items():
+    _config['model'] = os.getenv(f'SENECA_MODEL_{_route.upper()}', _config['model'])
+    _config['max_tokens'] = int(os.getenv(f'SENECA_MAX_TOKENS_{_route.upper()}', _config['max_tokens']))
+
+# Dollars per million tokens: (input, cache write, cache read, output), by model name prefix
+MODEL_PRICES = {
+    'claude-3-5-sonnet': (3.0, 3.75, 0.30, 15.0),
+    'claude-3-7-sonnet': (3.0, 3.75, 0.30, 15.0),
+    'claude-sonnet-4': (3.0, 3.75, 0.30, 15.0),
+    'claude-3-5-haiku': (0.80, 1.0, 0.08, 4.0),
+    'claude-haiku-4': (1.0, 1.25, 0.10, 5.0),
+    'claude-3-haiku': (0.25, 0.30, 0.03, 1.25),
+    'claude-3-opus': (15.0, 18.75, 1.50, 75.0),
+    'claude-opus-4': (15.0, 18.75, 1.50, 75.0),
+}
+BATCH_PRICE_FACTOR = 0.5  # Message Batches API calls cost half the prices above
+
+# TokenEstimator for each recent (student_name_safe, chat_id)
+_token_estimators = OrderedDict()
+
+# Built once at import; the last tool gets a prompt-cache breakpoint in build_request
+TOOLS = [
+    {
+        "name": "get_notes",
+        "description": "Get the full text of notes for the specified topic",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "note_topic": {
+                    "type": "string",
+                    "enum": ["student_info", "lesson_plan", "past_problems"],
+                    "description": "The topic of notes to retrieve"
+                },
+                "section": {
+                    "type": "string",
+                    "description": "Only get this section (the text under a markdown heading such as \"## Topics\", up to the next heading of the same or higher level)"
+                }
+            },
+            "required": ["note_topic"]
+        }
+    },
+    {
+        "name": "edit_notes",
+        "description": "Edit the notes for the specified topic by replacing old text with new text, or deleting old text if new_excerpt is empty. Returns a diff of the change",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "note_topic": {
+                    "type": "string",
+                    "enum": ["student_info", "lesson_plan", "past_problems"],
+                    "description": "The topic of notes to edit"
+                },
+                "section": {
+                    "type": "string",
+                    "description": "Optional markdown section heading (without the #s) to edit. old_excerpt is then only looked for in that section, and an empty old_excerpt replaces the section's text (adding the section if it doesn't exist). Leave both excerpts empty to delete the section"
+                },
+                "old_excerpt": {
+                    "type": "string",
+                    "description": "The text to replace (leave empty to overwrite the entire note, or the whole section if a section is given)"
+                },
+                "new_excerpt": {
+                    "type": "string",
+                    "description": "The new text to insert (leave empty to delete the old_excerpt)"
+                }
+            },
+            "required": ["note_topic"]
+        }
+    },
+    {
+        "name": "edit_notes_batch",
+        "description": "Make several edit_notes edits, to any topics, in one call. They are applied in order, and if any of them fails none are saved",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "edits": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "note_topic": {
+                                "type": "string",
+                                "enum": ["student_info", "lesson_plan", "past_problems"],
+                                "description": "The topic of notes to edit"
+                            },
+                            "section": {
+                                "type": "string",
+                                "description": "Optional markdown section heading (without the #s) to edit. old_excerpt is then only looked for in that section, and an empty old_excerpt replaces the section's text (adding the section if it doesn't exist). Leave both excerpts empty to delete the section"
+                            },
+                            "old_excerpt": {
+                                "type": "string",
+                                "description": "The text to replace (leave empty to overwrite the entire note, or the whole section if a section is given)"
+                            },
+                            "new_excerpt": {
+                                "type": "string",
+                                "description": "The new text to insert (leave empty to delete the old_excerpt)"
+                            }
+                        },
+                        "required": ["note_topic"]
+                    }
+                }
+            },
+            "required": ["edits"]
+        }
+    },
+    {
+        "name": "search_history",
+        "description": "Search the student's past sessions (what they wrote and what you wrote, including earlier problems and explanations) and past_problems notes by keywords. Returns the best-matching snippets with the chat they come from",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "Keywords to search for, such as \"fractions common denominator\". Results match any of the words, best matches first"
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": f"Number of results (default 5, at most {MAX_SEARCH_RESULTS})"
+                }
+            },
+            "required": ["query"]
+        }
+    },
+    {
+        "name": "finish_question",
+        "description": "Use this when you want to finish the current question/topic and start a new one. This will start a new conversation with fresh messages, but you will be reminded of your notes at the beginning. You will have a chance to update your notes beforehand.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "reason": {
+                    "type": "string",
+                    "description": "The reason for finishing this question/topic (e.g., 'Student requested new topic', 'Student has mastered this concept', 'Student is struggling too much')"
+                }
+            },
+            "required": ["reason"]
+        }
+    },
+    {
+        "name": "calculator",
+        "description": "Computes the result of one or more mathematical expressions. Use expressions to check several steps in one call",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "expression": {
+                    "type": "string",
+                    "description": 'The expression, using Python syntax, such as "(3.5 + 4) * 5" or "2**10 == 1024". Supports + - * / // % **, comparisons, parentheses, pi, e and the functions abs, round, min, max and sqrt.'
+                },
+                "expressions": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Several expressions to compute in one call, instead of expression"
+                },
+                "number_type": {
+                    "type": "string",
+                    "enum": ["float", "fraction", "decimal"],
+                    "description": "float (default) for ordinary floating point, fraction for exact rational results such as 1/3 + 1/6 = 1/2, decimal for exact decimal arithmetic such as 0.1 + 0.2 = 0.3"
+                }
+            }
+        }
+    },
+]
+
+
+def make_system_prompt():
+    return """You are a private tutor for a student. You will give the student problems or challenges that can be answered fairly quickly, check their answers, and help them if they get stuck. Your goal is to help the student improve their skills and get excited about the topic, while maintaining detailed notes on their progress.
+When creating a new problem or challenge, the steps will be:
+1. Write out the problem. Use <problem></problem> tags.
+2. Write down the steps needed to solve the problem, and an acceptable answer. Use <solution></solution> tags. For arithmetic problems, when feasible, use the calculator tool to check the answer.
+3. Write a correctness check inside <correctness_check></correctness_check> tags. For this, you will verify that the problem is correctly posed, using the proposed solution and also your background knowledge (e.g., for the problem: "Give the perimeter of a rectangle with sides of 3,4,5,6 units", you will recognize that the problem is flawed because opposite sides of a rectangle cannot be different lengths). If there is an error in the problem, correct it.
+4. Give the problem to the student. Wrap any text that will be sent to the student in <to_student></to_student> tags. Format this text with HTML, and you can also include small SVG diagrams as needed.
+
+The student's responses will be wrapped in <from_student></from_student> tags. After the student responds, if they are correct, then congratulate them, make any relevant comments on the strategy they used to, and move on to the next problem. If they are wrong, then engage with them as a tutor would, to try to understand why they are getting it wrong. This could include asking them to tell you the steps they used to solve the problem, giving them small hints to try to nudge them in the right direction, or teaching them about needed concepts.
+If the student still cannot get to the right answer after several turns back and forth and you think it's time to move to the next problem, make a note in the skills note using tool calling, then move to the next problem and notify the student.
+
+During the conversation, you should be keeping all your notes up to date using tool calls. Here is a guide to the different notes:
+- student_info: The student's grade level or professional situation, what areas they want to focus on, learning style, strategies that have worked well or poorly with them. Also use this to store memories of your social connection with the student. For instance, if you or the student shared a personal detail that you think could be helpful when bonding in the future.
+- lesson_plan: Start with a summary of short and long-term goals. Then have a list of topics that you want to cover, with details. Details include the material to cover, where the student is at (no proficiency, progressing, mastery). Use timestamps to keep track of when the topic was started and most recently worked on.
+- past_problems: Use this to store problems that the student could not get right even after several tries, so that you can come back to them later once the student has progressed in their skills and is ready to try again.
+The full text of past sessions is kept too, and you can search it (and past_problems) with the search_history tool. Keep the notes to summaries, and search the history when you need the details of an earlier problem or explanation.
+
+Some notes/reminders:
+- Very important: Only text within <to_student> blocks will be shown to the student; use HTML formatting for this text.
+- Make sure none of the notes get too long; you should keep each one to 1-2 pages of text or less. If they get longer than that, use the edit_notes tool to trim them.
+- Organize the notes into markdown sections (such as "## Goals" or "## Topics"), so you can read or edit one section at a time using the section parameter of get_notes and edit_notes. To make several changes at once, use edit_notes_batch. Edits return a diff of the change rather than the whole notes.
+- If the user requests a new problem, or the chat history gets long and the early messages are no longer relevant, or you want to start a new topic, call the finish_question tool to start a new session.
+- Adapt your style to the age of the student. For instance, for an 8 year old student, if they got the answer right, don't ask them to explain their steps.
+- Only ask the student to do things they can type (no drawing, etc.).
+- Make sure not to include the solution when you give the problem to the student.
+"""
+
 
 def get_timestamp():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
-def count_tokens(messages, tools=None):
-    response = anthropic_client.beta.messages.count_tokens(
-        model=MODEL_NAME,
-        tools=tools,
-        messages=messages,
-    )
+def estimate_cost(model, usage):
+    """Cost in dollars of an LLM call, from the usage record written by record_usage. None if the model's price is unknown"""
+    prices = next((prices for prefix, prices in MODEL_PRICES.items() if model.startswith(prefix)), None)
+    if prices is None:
+        return None
+    tokens = (usage['input_tokens'], usage['cache_creation_input_tokens'], usage['cache_read_input_tokens'], usage['output_tokens'])
+    return sum(count * price for count, price in zip(tokens, prices)) / 1e6
+
+
+def turn_route(route, turn_i):
+    """Route for call number turn_i of a tool loop: after tool results, an opening or reply continues as 'tool_continuation'"""
+    return 'tool_continuation' if turn_i > 0 and route in ('opening', 'reply') else route
+
+
+def count_tokens(messages, tools=None, system_prompt=None):
+    """Exact input tokens of a request, counted by the API. Like the usage of a response, this includes the system
+    prompt and tools"""
+    params = dict(model=MODEL_ROUTES['reply']['model'], messages=get_request_messages(messages))
+    if tools:
+        params['tools'] = tools
+    if system_prompt:
+        params['system'] = system_prompt
+    response = call_api_with_retries(get_client().beta.messages.count_tokens, **params)
     return response.input_tokens
 
 
-def get_notes(student_name_safe, note_topic):
+def estimate_message_tokens(message):
+    """Rough local estimate of the tokens in one message"""
+    content = message['content']
+    if isinstance(content, str):
+        chars = len(content)
+    else:
+        chars = 0
+        for item in content:
+            if hasattr(item, 'model_dump'):
+                item = item.model_dump()
+            chars += len(item.get('text') or '') + len(str(item.get('content') or ''))
+            if item.get('input'):
+                chars += len(json.dumps(item['input']))
+    return int(chars / CHARS_PER_TOKEN) + 1
+
+
+def estimate_request_tokens(system_prompt, messages, tools=None):
+    """Rough local estimate of the input tokens of a whole request (system prompt, tools and messages), comparable
+    to the usage reported by the API"""
+    overhead = len(system_prompt or '') + (len(json.dumps(tools)) if tools else 0)
+    return int(overhead / CHARS_PER_TOKEN) + sum(estimate_message_tokens(message) for message in get_request_messages(messages))
+
+
+class TokenEstimator:
+    """Running input token count for one chat session. Starts from the exact usage reported by the last
+    messages.create call and adds local estimates for the messages appended since then. Counts are for the whole
+    request, including the system prompt and tools"""
+
+    def __init__(self):
+        self.known_tokens = 0
+        self.known_message_count = 0
+
+    def update(self, response, message_count):
+        """Record the usage of a response. message_count is the number of messages it covers: the request's messages,
+        plus the response itself once it has been appended"""
+        usage = response.usage
+        self.known_tokens = (usage.input_tokens + (usage.cache_creation_input_tokens or 0)
+                             + (usage.cache_read_input_tokens or 0) + usage.output_tokens)
+        self.known_message_count = message_count
+
+    def set_exact_count(self, token_count, message_count):
+        self.known_tokens = token_count
+        self.known_message_count = message_count
+
+    def estimate(self, messages, system_prompt=None, tools=None):
+        if len(messages) < self.known_message_count:
+            # History was replaced, so start over
+            self.known_tokens = 0
+            self.known_message_count = 0
+        if self.known_message_count == 0:
+            # No usage recorded yet (e.g. the chat was last used in another worker process): estimate the request as
+            # it would be sent, without the messages an earlier compaction replaced with a summary
+            return estimate_request_tokens(system_prompt, messages, tools)
+        return self.known_tokens + sum(estimate_message_tokens(message) for message in messages[self.known_message_count:])
+
+
+def get_token_estimator(student_name_safe, chat_id):
+    key = (student_name_safe, chat_id)
+    if key in _token_estimators:
+        _token_estimators.move_to_end(key)
+    else:
+        _token_estimators[key] = TokenEstimator()
+        if len(_token_estimators) > TOKEN_ESTIMATOR_CACHE_SIZE:
+            _token_estimators.popitem(last=False)
+    return _token_estimators[key]
+
+
+def get_request_messages(messages):
+    """Get the messages to send to the LLM. If the history has been compacted, this is the first user message
+    (the notes preamble) plus the latest summary, followed by the messages kept verbatim"""
+    compaction_index = None
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i]['role'] == 'compaction':
+            compaction_index = i
+            break
+    if compaction_index is None:
+        # Only role and content are sent; other keys (such as usage) are kept in the chat history only
+        return [{"role": message['role'], "content": message['content']} for message in messages]
+
+    compaction = messages[compaction_index]
+    kept = [message for message in messages[compaction['keep_from']:] if message['role'] != 'compaction']
+    # kept[0] is always a plain student message, so it can be merged into the first user message
+    first_message = {"role": "user", "content": [
+        {"type": "text", "text": messages[0]['content']},
+        {"type": "text", "text": f"<summary_of_earlier_conversation>\n{compaction['content']}\n</summary_of_earlier_conversation>",
+         "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": kept[0]['content']},
+    ]}
+    return [first_message] + [{"role": message['role'], "content": message['content']} for message in kept[1:]]
+
+
+def format_messages_for_summary(messages):
+    """Plain text version of messages, for the summarization prompt"""
+    lines = []
+    for message in messages:
+        content = message['content']
+        if isinstance(content, str):
+            lines.append(f"{message['role']}: {content}")
+            continue
+        for item in content:
+            if hasattr(item, 'model_dump'):
+                item = item.model_dump()
+            if item.get('type') == 'text':
+                lines.append(f"{message['role']}: {item['text']}")
+            elif item.get('type') == 'tool_use':
+                lines.append(f"{message['role']} called tool {item['name']}: {json.dumps(item['input'])}")
+            elif item.get('type') == 'tool_result':
+                lines.append(f"tool result: {str(item['content'])[:COMPACTION_TOOL_RESULT_CHARS]}")
+    return '\n\n'.join(lines)
+
+
+def summarize_messages(previous_summary, messages):
+    prompt = f"""Below is part of a conversation between a tutor (assistant) and a student, which is being removed from the tutor's context to save space. Write a concise summary for the tutor to continue from: the problems given, the student's answers and mistakes, hints already given, and anything the tutor said it would do next. Tool calls that edited notes do not need to be summarized in detail, since the notes are saved.
+
+<earlier_summary>
+{previous_summary or 'None'}
+</earlier_summary>
+
+<conversation>
+{format_messages_for_summary(messages)}
+</conversation>"""
+    start_time = time.perf_counter()
+    response = call_api_with_retries(
+        get_client().messages.create,
+        model=MODEL_ROUTES['summary']['model'],
+        max_tokens=MODEL_ROUTES['summary']['max_tokens'],
+        messages=[{"role": "user", "content": prompt}]
+    )
+    record_usage(None, response, time.perf_counter() - start_time, route='summary')
+    return ''.join(block.text for block in response.content if block.type == 'text')
+
+
+def compact_messages(messages, keep_tokens, token_estimator=None, system_prompt=None, tools=None):
+    """Summarize older messages so the request stays small. The full history stays in messages; a 'compaction'
+    entry is appended that get_request_messages uses to build the request. Returns True if compaction happened"""
+    previous = next((message for message in reversed(messages) if message['role'] == 'compaction'), None)
+    start = previous['keep_from'] if previous else 1
+
+    # Walk back from the end, keeping recent messages verbatim until keep_tokens is reached. The first kept
+    # message has to be a plain student message so no tool_result is separated from its tool_use
+    keep_from = None
+    recent_tokens = 0
+    for i in range(len(messages) - 1, start, -1):
+        message = messages[i]
+        if message['role'] == 'compaction':
+            continue
+        recent_tokens += estimate_message_tokens(message)
+        if message['role'] == 'user' and isinstance(message['content'], str):
+            keep_from = i
+            if recent_tokens >= keep_tokens:
+                break
+    if keep_from is None:
+        return False
+
+    to_summarize = [message for message in messages[start:keep_from] if message['role'] != 'compaction']
     try:
-        with open(f'data/{student_name_safe}_{note_topic}.txt', 'r') as f:
-            return f.read()
+        summary = summarize_messages(previous['content'] if previous else None, to_summarize)
+    except Exception as e:
+        # The compaction entry is saved in the append-only chat log, so don't drop the messages for good; the next
+        # turn tries again
+        print(colored(f'Error summarizing messages, not compacting this turn: {e}', 'red'))
+        return False
+
+    messages.append({"role": "compaction", "content": summary, "keep_from": keep_from})
+    print(colored(f'Compacted chat history: summarized {len(to_summarize)} messages, kept {len(messages) - keep_from - 1} verbatim', 'yellow'))
+    if token_estimator is not None:
+        token_estimator.set_exact_count(estimate_request_tokens(system_prompt, messages, tools), len(messages))
+    return True
+
+
+@contextmanager
+def notes_draft(student_name_safe, notes=None):
+    """Make the note tools read and write a draft copy of a student's notes instead of the notes files, for work
+    that may be thrown away. notes: draft texts to start from (topic -> text). Yields the draft, which holds the
+    text of each note changed so far"""
+    draft = dict(notes or {})
+    token = _notes_draft.set((student_name_safe, draft))
+    try:
+        yield draft
+    finally:
+        _notes_draft.reset(token)
+
+
+def _get_draft(student_name_safe):
+    entry = _notes_draft.get()
+    return entry[1] if entry is not None and entry[0] == student_name_safe else None
+
+
+def _read_notes(student_name_safe, note_topic):
+    draft = _get_draft(student_name_safe)
+    if draft is not None and note_topic in draft:
+        return draft[note_topic]
+    return read_notes(student_name_safe, note_topic)
+
+
+def _write_notes(student_name_safe, note_topic, text):
+    draft = _get_draft(student_name_safe)
+    if draft is not None:
+        draft[note_topic] = text
+    else:
+        write_notes(student_name_safe, note_topic, text)
+
+
+def apply_notes_draft(student_name_safe, notes, base_hashes):
+    """Write the notes of a draft (see notes_draft) to the notes files. base_hashes maps topics to their notes_hash
+    when the draft was started; if any note in the draft changed since, nothing is written and False is returned"""
+    with notes_lock(student_name_safe):
+        if any(notes_hash(student_name_safe, note_topic) != base_hashes.get(note_topic) for note_topic in notes):
+            return False
+        for note_topic, text in notes.items():
+            write_notes(student_name_safe, note_topic, text)
+    return True
+
+
+def get_notes(student_name_safe, note_topic, section=None):
+    try:
+        notes = _read_notes(student_name_safe, note_topic)
     except FileNotFoundError:
         return f"Error: No notes found for {note_topic}"
+    if section is None:
+        return notes
+    section_text = get_section(notes, section)
+    if section_text is None:
+        return f"Error: No section named \"{section}\" in {note_topic} notes. Sections: {', '.join(list_sections(notes)) or 'none'}"
+    return section_text
+
+
+def edit_notes(student_name_safe, note_topic, old_excerpt=None, new_excerpt=None, section=None):
+    """Apply one edit (see notes_sections.apply_edit). Returns a short confirmation with a diff, not the whole notes"""
+    return edit_notes_batch(student_name_safe, [{"note_topic": note_topic, "old_excerpt": old_excerpt, "new_excerpt": new_excerpt, "section": section}])
 
 
-def edit_notes(student_name_safe, note_topic, old_excerpt=None, new_excerpt=None):
+def edit_notes_batch(student_name_safe, edits, expected_hashes=None):
+    """Apply several edits in order. If any edit fails, no notes are changed. expected_hashes maps note topics to
+    the notes_hash the edits were made against; if any of those notes changed since, nothing is saved"""
+    if not edits:
+        return "Error: No edits given"
     try:
-        # Return error if both excerpts are empty
-        if not old_excerpt and not new_excerpt:
-            return "Error: Both old_excerpt and new_excerpt cannot be empty"
-            
-        current_notes = get_notes(student_name_safe, note_topic)
-        if not old_excerpt:  # If no old_excerpt, replace the entire note
-            new_notes = new_excerpt
-        else:
-            if old_excerpt not in current_notes:
-                return f"Error: Could not find the exact text to replace in {note_topic} notes"
-            # Replace old_excerpt with new_excerpt if new_excerpt is not empty, otherwise just remove old_excerpt
-            new_notes = current_notes.replace(old_excerpt, new_excerpt if new_excerpt else "")
-        
-        with open(f'data/{student_name_safe}_{note_topic}.txt', 'w') as f:
-            f.write(new_notes)
-        return f"Changes saved. New version of {note_topic} notes:\n{new_notes}"
+        with notes_lock(student_name_safe):
+            for note_topic, expected_hash in (expected_hashes or {}).items():
+                if notes_hash(student_name_safe, note_topic) != expected_hash:
+                    return f"Error: {note_topic} notes changed since the edits were made. No changes were saved."
+            old_notes = {}
+            new_notes = {}
+            for i, edit in enumerate(edits):
+                note_topic = edit.get('note_topic')
+                if note_topic not in new_notes:
+                    try:
+                        old_notes[note_topic] = new_notes[note_topic] = _read_notes(student_name_safe, note_topic)
+                    except FileNotFoundError:
+                        return f"Error: No notes found for {note_topic}"
+                try:
+                    new_notes[note_topic] = apply_edit(new_notes[note_topic], edit.get('old_excerpt'), edit.get('new_excerpt'), edit.get('section'))
+                except ValueError as e:
+                    where = f' (edit {i + 1})' if len(edits) > 1 else ''
+                    return f"Error: {e} in {note_topic} notes{where}. No changes were saved."
+
+            for note_topic, text in new_notes.items():
+                if text != old_notes[note_topic]:
+                    _write_notes(student_name_safe, note_topic, text)
+        return '\n'.join(describe_change(note_topic, old_notes[note_topic], text) for note_topic, text in new_notes.items())
     except Exception as e:
         return f"Error: {str(e)}"
 
 
+def search_history(student_name_safe, query, limit=5):
+    results = history_search.search(student_name_safe, query, max(1, min(int(limit), MAX_SEARCH_RESULTS)))
+    if not results:
+        return f"No past sessions or notes match \"{query}\""
+    speakers = {'user': 'student', 'assistant': 'tutor'}
+    return '\n'.join(f'[{f"chat {chat_id:06d}" if chat_id is not None else "notes"}, {speakers.get(role, role)}] {snippet}' for chat_id, role, snippet in results)
+
+
 def finish_question(student_name_safe, reason):
     return ("FINISH_QUESTION: " + reason)
 
 
-def calculator(student_name_safe, expression):
-    expression = re.sub(r'[^0-9.+*/() -]', '', expression)
+def calculate(expression, number_type='float'):
     try:
-        return eval(expression)
+        return format_result(evaluate(expression, number_type))
     except Exception as e:
         return f"Error: {str(e)}"
 
 
-def call_llm_with_tools(student_name_safe, system_prompt, messages, tools=None, max_turns=10, verbose_output=False):
+def calculator(student_name_safe, expression=None, expressions=None, number_type='float'):
+    if expressions is None:
+        if expression is None:
+            return "Error: expression or expressions is required"
+        return calculate(expression, number_type)
+    if len(expressions) > MAX_CALCULATOR_EXPRESSIONS:
+        return f"Error: at most {MAX_CALCULATOR_EXPRESSIONS} expressions per call"
+    return '\n'.join(f'{expression} = {calculate(expression, number_type)}' for expression in expressions)
+
+
+def build_request(system_prompt, messages, tools=None, route='reply'):
+    """Build the Messages API parameters for a route (see MODEL_ROUTES), with prompt-cache breakpoints after the
+    tools, the system prompt and the first user message (the notes preamble), which stay the same for the whole session"""
+    messages = get_request_messages(messages)
+    cache_control = {"type": "ephemeral"}
+    system = [{"type": "text", "text": system_prompt, "cache_control": cache_control}]
+
+    if tools:
+        tools = tools[:-1] + [{**tools[-1], "cache_control": cache_control}]
+
+    if messages and messages[0]['role'] == 'user' and isinstance(messages[0]['content'], str):
+        first_message = {"role": "user", "content": [{"type": "text", "text": messages[0]['content'], "cache_control": cache_control}]}
+        messages = [first_message] + messages[1:]
+
+    return dict(
+        model=MODEL_ROUTES[route]['model'],
+        max_tokens=MODEL_ROUTES[route]['max_tokens'],
+        system=system,
+        tools=tools,
+        messages=messages
+    )
+
+
+def get_usage(response):
+    """Model and token usage of an LLM response, including prompt cache reads and writes"""
+    usage = response.usage
+    return {
+        'model': response.model,
+        'input_tokens': usage.input_tokens,
+        'cache_creation_input_tokens': usage.cache_creation_input_tokens or 0,
+        'cache_read_input_tokens': usage.cache_read_input_tokens or 0,
+        'output_tokens': usage.output_tokens,
+    }
+
+
+def record_usage(student_name_safe, response, latency, time_to_first_token=None, route='reply', batch=False):
+    """Log the token usage and cost of an LLM call, including prompt cache reads and writes. For a response from the
+    Message Batches API (batch=True), latency is the time from submitting the batch until it ended"""
+    record = {
+        'timestamp': get_timestamp(),
+        'student': student_name_safe,
+        'route': route,
+        **get_usage(response),
+        'latency_seconds': round(latency, 3),
+        'time_to_first_token_seconds': round(time_to_first_token, 3) if time_to_first_token is not None else None,
+    }
+    if batch:
+        record['batch'] = True
+    cost = estimate_cost(response.model, record)
+    if cost is not None and batch:
+        cost *= BATCH_PRICE_FACTOR
+    record['cost_usd'] = round(cost, 6) if cost is not None else None
+    if not batch:
+        # Batch turnaround (up to hours) would swamp the live request latency histogram
+        LLM_REQUEST_SECONDS.observe(latency, model=response.model, route=route)
+    LLM_REQUESTS.inc(model=response.model, route=route, stop_reason=response.stop_reason)
+    for token_type in ('input_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens', 'output_tokens'):
+        LLM_TOKENS.inc(record[token_type], model=response.model, route=route, type=token_type)
+    if cost is not None:
+        LLM_COST.inc(cost, model=response.model, route=route)
+    print(colored(f"Tokens ({route}, {response.model}): {record['input_tokens']} input, {record['cache_read_input_tokens']} cache read, "
+                  f"{record['cache_creation_input_tokens']} cache write, {record['output_tokens']} output. "
+                  f"Latency {record['latency_seconds']}s" + (f", cost ${cost:.4f}" if cost is not None else ''), 'cyan'))
+    try:
+        os.makedirs(os.path.dirname(USAGE_LOG_FILE), exist_ok=True)
+        with open(USAGE_LOG_FILE, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as e:
+        print(colored(f'Error writing usage log: {e}', 'red'))
+
+
+def create_message(student_name_safe, system_prompt, messages, tools=None, on_text=None, route='reply'):
+    """Call the Messages API with the model for route, once a slot is free (see admission.py). If on_text is given,
+    stream the response and pass each text delta to it"""
+    request_params = build_request(system_prompt, messages, tools, route)
+    with span('llm_call', route=route), llm_calls.slot():
+        start_time = time.perf_counter()
+        if on_text is None:
+            response = get_client().messages.create(**request_params)
+            record_usage(student_name_safe, response, time.perf_counter() - start_time, route=route)
+            return response
+
+        time_to_first_token = None
+        with get_client().messages.stream(**request_params) as stream:
+            for text in stream.text_stream:
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start_time
+                on_text(text)
+            response = stream.get_final_message()
+    record_usage(student_name_safe, response, time.perf_counter() - start_time, time_to_first_token, route)
+    return response
+
+
+def retry_delay(attempt):
+    """Seconds to wait before retrying a failed LLM call: exponential backoff with full jitter"""
+    return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+
+
+def is_retryable(error):
+    """True for the errors the SDK would retry: connection errors and timeouts, 408, 409, 429 and 5xx responses"""
+    import anthropic
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    return isinstance(error, anthropic.APIStatusError) and (status_code in (408, 409, 429) or status_code >= 500)
+
+
+def call_api_with_retries(func, *args, retries=3, admit=True, **kwargs):
+    """Call an Anthropic API method, retrying retryable errors with backoff. The clients don't retry by themselves
+    (see get_client), so this is the retry loop for API calls outside call_llm_with_tools. If admit is True, each
+    attempt waits for an LLM call slot (see admission.py)"""
+    for attempt in range(retries):
+        try:
+            if not admit:
+                return func(*args, **kwargs)
+            with llm_calls.slot():
+                return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries - 1 or not is_retryable(e):
+                raise
+            print(colored(f'Error calling API (attempt {attempt + 1}): {e}', 'red'))
+            LLM_RETRIES.inc(error=type(e).__name__)
+            if retry_after_seconds(e) is not None:
+                llm_calls.pause(retry_after_seconds(e))
+            time.sleep(retry_delay(attempt))
+
+
+def run_tool(student_name_safe, tool_use, tools, verbose_output=False):
+    """Run the function for a tool_use block. Returns the tool_result content block"""
+    tool_name = tool_use.name
+    tool_input = tool_use.input
+    start_time = time.perf_counter()
+
+    if verbose_output:
+        print(f"\n{colored(f'Tool Used: {tool_name}', 'green')}")
+        print(f"  {colored('Tool Input:', 'yellow')}")
+        print(colored(json.dumps(tool_input, indent=2), 'yellow'))
+    
+    with span('tool', tool=tool_name):
+        try:
+            if tool_name in globals() and tools and any(tool['name'] == tool_name for tool in tools):
+                tool_function = globals()[tool_name]
+                tool_result = tool_function(
+                    student_name_safe,  # Always pass student_name_safe as first arg
+                    **tool_input  # Unpack remaining parameters from tool input
+                )
+            else:
+                tool_result = f'Error: Tool {tool_name} not found'
+            if verbose_output:
+                print(f'  {colored(f"Tool Result: {tool_result}", "blue")}')
+        except Exception as e:
+            if verbose_output:
+                print(f'  {colored(f"Error: {e}", "red")}')
+            tool_result = f'Error: {e}'
+
+    TOOL_SECONDS.observe(time.perf_counter() - start_time, tool=tool_name)
+    if str(tool_result).startswith('Error'):
+        TOOL_ERRORS.inc(tool=tool_name)
+    return {
+        "type": "tool_result",
+        "tool_use_id": tool_use.id,
+        "content": str(tool_result),
+    }
+
+
+def append_turn(messages, response, user_content_list, turn_i, max_turns, token_estimator=None):
+    """Add the assistant response and the tool results for one turn to messages, and record the response's usage
+    in token_estimator"""
+    if turn_i == max_turns-1:
+        user_content_list.append({
+            "type": "text",
+            "text": "WARNING: Maximum number of turns reached. You get one more response. Do not call any more tools."
+        })
+
+    if response.content != []:
+        # The usage is saved with the message for analytics (see export.py), but not sent back to the API
+        messages.append({"role": "assistant", "content": response.content, "usage": get_usage(response)})
+    if token_estimator is not None:
+        # An empty response isn't appended, so its usage covers only the request's messages
+        token_estimator.update(response, len(messages))
+
+    if user_content_list:
+        messages.append({
+            "role": "user",
+            "content": user_content_list,
+        })
+
+
+def call_llm_with_tools(student_name_safe, system_prompt, messages, tools=None, max_turns=10, verbose_output=False, on_text=None, token_estimator=None, route='reply'):
+    """Call the LLM and run the tools it calls until it stops calling tools. route picks the model (see MODEL_ROUTES)"""
+    from anthropic import AuthenticationError
     turn_i = 0
     first_turn = True
     while first_turn or response.stop_reason == "tool_use":
@@ -77,13 +764,7 @@ def call_llm_with_tools(student_name_safe, system_prompt, messages, tools=None,
         retries = 3
         for attempt in range(retries):
             try:
-                response = anthropic_client.messages.create(
-                    model=MODEL_NAME,
-                    max_tokens=8192,
-                    system=system_prompt,
-                    tools=tools,
-                    messages=messages
-                )
+                response = create_message(student_name_safe, system_prompt, messages, tools, on_text=on_text, route=turn_route(route, turn_i))
                 break
             except AuthenticationError as e:
                 print(colored(f'Error calling LLM (attempt {attempt + 1}): {e}', 'red'))
@@ -95,6 +776,10 @@ def call_llm_with_tools(student_name_safe, system_prompt, messages, tools=None,
                 return messages
             except Exception as e:
                 print(colored(f'Error calling LLM (attempt {attempt + 1}): {e}', 'red'))
+                LLM_RETRIES.inc(error=type(e).__name__)
+                if retry_after_seconds(e) is not None:
+                    # Rate limited: hold back new calls in every worker until retry-after has passed
+                    llm_calls.pause(retry_after_seconds(e))
                 if attempt == retries - 1:  # If it's the last attempt
                     error_message = {
                         "role": "assistant", 
@@ -102,6 +787,7 @@ def call_llm_with_tools(student_name_safe, system_prompt, messages, tools=None,
                     }
                     messages.append(error_message)
                     return messages
+                time.sleep(retry_delay(attempt))
         
         if turn_i >= max_turns:
             if verbose_output:
@@ -109,55 +795,11 @@ def call_llm_with_tools(student_name_safe, system_prompt, messages, tools=None,
             return messages
             #raise ValueError(f'Max turns reached ({max_turns})')
 
-        user_content_list = []
-        finish_question_tool_called = False
-        for tool_use in [block for block in response.content if block.type == "tool_use"]:
-            tool_name = tool_use.name
-            tool_input = tool_use.input
+        tool_uses = [block for block in response.content if block.type == "tool_use"]
+        user_content_list = run_tools(student_name_safe, tool_uses, tools, verbose_output)
+        finish_question_tool_called = any(tool_use.name == 'finish_question' for tool_use in tool_uses)
 
-            if verbose_output:
-                print(f"\n{colored(f'Tool Used: {tool_name}', 'green')}")
-                print(f"  {colored('Tool Input:', 'yellow')}")
-                print(colored(json.dumps(tool_input, indent=2), 'yellow'))
-            
-            try:
-                if tool_name in globals() and tools and any(tool['name'] == tool_name for tool in tools):
-                    tool_function = globals()[tool_name]
-                    tool_result = tool_function(
-                        student_name_safe,  # Always pass student_name_safe as first arg
-                        **tool_input  # Unpack remaining parameters from tool input
-                    )
-                    if tool_name == 'finish_question':
-                        finish_question_tool_called = True
-                else:
-                    tool_result = f'Error: Tool {tool_name} not found'
-                if verbose_output:
-                    print(f'  {colored(f"Tool Result: {tool_result}", "blue")}')
-            except Exception as e:
-                if verbose_output:
-                    print(f'  {colored(f"Error: {e}", "red")}')
-                tool_result = f'Error: {e}'
-
-            user_content_list.append({
-                "type": "tool_result",
-                "tool_use_id": tool_use.id,
-                "content": str(tool_result),
-            })
-
-        if turn_i == max_turns-1:
-            user_content_list.append({
-                "type": "text",
-                "text": "WARNING: Maximum number of turns reached. You get one more response. Do not call any more tools."
-            })
-
-        if response.content != []:
-            messages.append({"role": "assistant", "content": response.content})
-
-        if user_content_list:
-            messages.append({
-                "role": "user",
-                "content": user_content_list,
-            })
+        append_turn(messages, response, user_content_list, turn_i, max_turns, token_estimator)
 
         if finish_question_tool_called:
             break
@@ -167,19 +809,77 @@ def call_llm_with_tools(student_name_safe, system_prompt, messages, tools=None,
     return messages
 
 
-def format_html_w_tailwind(html_text):
-    """Format HTML text to be more readable by adding Tailwind CSS classes"""
-    html_text = html_text.replace('<ul>', '<ul class="list-disc ml-4">')
-    html_text = html_text.replace('<a ', '<a target="_blank" class="text-indigo-600 hover:underline" ')
-    html_text = html_text.replace('<p>', '<p class="mt-2">')
-    html_text = html_text.replace('<h1>', '<h1 class="text-2xl font-bold mt-4">')
-    html_text = html_text.replace('<h2>', '<h2 class="text-xl font-bold mt-4">')
-    html_text = html_text.replace('<h3>', '<h3 class="text-lg font-bold mt-4">')
-    html_text = html_text.replace('<h4>', '<h4 class="text-base font-bold mt-4">')
-    html_text = html_text.replace('<strong>', '<strong class="font-bold">')
-    html_text = html_text.replace('<em>', '<em class="italic">')
-    html_text = html_text.replace('<blockquote>', '<blockquote class="border-l-4 border-gray-300 pl-4 italic">')
-    html_text = html_text.replace('<code>', '<code class="bg-gray-200 p-1 rounded">')
-    html_text = html_text.replace('<pre>', '<pre class="bg-gray-200 p-2 rounded overflow-x-auto whitespace-pre-wrap">')    
-    return html_text
+def get_client():
+    """Get the Anthropic client, creating it (and importing the SDK) on first use"""
+    global anthropic_client
+    if anthropic_client is None:
+        with _client_lock:
+            if anthropic_client is None:
+                import anthropic
+                # Retries are done by call_llm_with_tools and call_api_with_retries, so that they go through the admission controller
+                anthropic_client = anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY',"no_key_supplied"), timeout=30, max_retries=0)
+    return anthropic_client
+
+
+def tool_dependency_key(tool_use):
+    """Tool calls with the same key must run in order; calls with different keys can run at the same time"""
+    if 'note_topic' in tool_use.input or 'edits' in tool_use.input:
+        return ('notes',)
+    return ('independent', tool_use.id)
+
+
+def run_tools(student_name_safe, tool_uses, tools, verbose_output=False):
+    """Run the tool calls from one response, at the same time where they don't depend on each other (see
+    tool_dependency_key). Returns the tool_result blocks in the original order"""
+    groups = {}
+    for i, tool_use in enumerate(tool_uses):
+        groups.setdefault(tool_dependency_key(tool_use), []).append((i, tool_use))
+    if len(groups) <= 1:
+        return [run_tool(student_name_safe, tool_use, tools, verbose_output) for tool_use in tool_uses]
+
+    def run_group(group):
+        return [(i, run_tool(student_name_safe, tool_use, tools, verbose_output)) for i, tool_use in group]
+
+    # Each thread gets a copy of the context, so a notes draft (see notes_draft) and the request's trace carry over
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run_group, group) for group in groups.values()]
+        results = sorted(result for future in futures for result in future.result())
+    return [result for _, result in results]
+
+
+class ToStudentFilter:
+    """Incrementally pick out the text inside <to_student> tags from a stream of text deltas"""
+    OPEN_TAG = '<to_student>'
+    CLOSE_TAG = '</to_student>'
+
+    def __init__(self):
+        self.pending = ''
+        self.inside = False
+
+    def feed(self, text):
+        """Returns a list of (event, text) tuples, where event is 'start', 'text' or 'end'"""
+        self.pending += text
+        events = []
+        while self.pending:
+            tag = self.CLOSE_TAG if self.inside else self.OPEN_TAG
+            idx = self.pending.find(tag)
+            if idx >= 0:
+                if self.inside and idx > 0:
+                    events.append(('text', self.pending[:idx]))
+                events.append(('end' if self.inside else 'start', ''))
+                self.inside = not self.inside
+                self.pending = self.pending[idx + len(tag):]
+                continue
+            # Hold back a trailing partial tag until the next delta arrives
+            keep = 0
+            for n in range(min(len(tag) - 1, len(self.pending)), 0, -1):
+                if tag.startswith(self.pending[-n:]):
+                    keep = n
+                    break
+            emit = self.pending[:len(self.pending) - keep]
+            if self.inside and emit:
+                events.append(('text', emit))
+            self.pending = self.pending[len(self.pending) - keep:]
+            break
+        return events
 
@@ -0,0 +1,4 @@
+"""WSGI entry point for running several worker processes, e.g. gunicorn -c gunicorn.conf.py wsgi:app"""
+from tutor import create_app
+
+app = create_app()